@@ -14,17 +14,62 @@ from functools import wraps
 from flask import Flask, render_template, jsonify, request, redirect, url_for, session
 import calendar
 
+from db_generations import GenerationWatcher, database_moved
+
 app = Flask(__name__, template_folder='templates', static_folder='assets', static_url_path='/static')
 app.secret_key = 'sales_dashboard_secret_key_change_in_production'
 
 DB_PATH = Path(__file__).parent / 'db' / 'app.db'
 
+# The ETL swaps in a whole new DB file per load (db_generations). Connections are
+# opened per request, so they follow the swap; the schema check runs once per generation.
+# A write caught by the swap fails with a moved-database error: get_db and the
+# write endpoints (@retry_on_swap) retry it once on a fresh connection.
+_generation = GenerationWatcher(DB_PATH)
+_schema_ready = False
+
 
 def get_db():
     """Get database connection with row factory."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    # Ensure the manual-payment tracking table exists (lightweight, idempotent)
+    global _schema_ready
+    if _generation.changed():
+        app.logger.info(f"DB generation {_generation.generation} swapped in by the ETL")
+        _schema_ready = False
+    for attempt in range(2):
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        if _schema_ready:
+            return conn
+        try:
+            _ensure_schema(conn)
+        except sqlite3.OperationalError as e:
+            conn.close()
+            if attempt or not database_moved(e):
+                raise
+            app.logger.info("DB swapped by the ETL during the schema check, reopening")
+            continue
+        _schema_ready = True
+        return conn
+
+
+def retry_on_swap(f):
+    """Decorator for write endpoints: run the view once more (new connection, new
+    DB file) when its write waited on an ETL swap and hit the moved file."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not database_moved(e):
+                raise
+            app.logger.info(f"{request.path}: DB swapped by the ETL during the write, retrying")
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+def _ensure_schema(conn):
+    """App-owned tables (lightweight, idempotent)."""
+    # Ensure the manual-payment tracking table exists
     conn.execute("""
         CREATE TABLE IF NOT EXISTS fact_factura_pagada (
             cod_cliente   TEXT NOT NULL,
@@ -71,8 +116,30 @@ def get_db():
             UNIQUE(recurrente_id, fecha)
         )
     """)
+    # Daily cube the ETL maintains (etl.py refresh_daily_cube); created empty
+    # here so a DB not yet loaded by it, or rolled back to a generation from
+    # before it, still answers the per-day queries (see _daily_sales_source)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fact_facturacion_diaria (
+            year_month TEXT,
+            cod_vendedor TEXT,
+            cod_cliente TEXT,
+            fecha_emision TEXT,
+            kg REAL,
+            importe REAL,
+            lineas INTEGER,
+            PRIMARY KEY (year_month, cod_vendedor, cod_cliente, fecha_emision)
+        )
+    """)
     conn.commit()
-    return conn
+
+
+def _daily_sales_source(conn):
+    """(table, kg column) for per-day sales: the daily cube, or fact_facturacion
+    while the cube is empty."""
+    if conn.execute("SELECT 1 FROM fact_facturacion_diaria LIMIT 1").fetchone():
+        return 'fact_facturacion_diaria', 'kg'
+    return 'fact_facturacion', 'cantidad'
 
 
 def login_required(f):
@@ -742,13 +809,14 @@ def api_dashboard():
         placeholders = ','.join(['?'] * len(vendor_codes))
         
         # 1. Daily Sales for Burn Chart (Volume in KG)
+        daily_table, kg_col = _daily_sales_source(conn)
         daily_query = f"""
             SELECT 
                 strftime('%d', fecha_emision) as dia,
-                COALESCE(SUM(cantidad), 0) as venta
-            FROM fact_facturacion
+                COALESCE(SUM({kg_col}), 0) as venta
+            FROM {daily_table}
             WHERE cod_vendedor IN ({placeholders}) 
-              AND year_month = (SELECT MAX(year_month) FROM fact_facturacion)
+              AND year_month = (SELECT MAX(year_month) FROM {daily_table})
             GROUP BY dia
             ORDER BY dia
         """
@@ -1118,6 +1186,7 @@ def api_planning():
 
 @app.route('/api/cliente/<cod_cliente>', methods=['GET', 'PUT'])
 @login_required
+@retry_on_swap
 def api_cliente(cod_cliente):
     """Return or update client detail."""
     conn = get_db()
@@ -1472,6 +1541,7 @@ def api_cliente(cod_cliente):
 
 @app.route('/api/cliente/<cod_cliente>/facturas/<fecha_emision>/pagar', methods=['POST'])
 @login_required
+@retry_on_swap
 def api_factura_marcar_pagada(cod_cliente, fecha_emision):
     """Manually mark an invoice date as paid so it disappears from the pending list."""
     conn = get_db()
@@ -1483,6 +1553,8 @@ def api_factura_marcar_pagada(cod_cliente, fecha_emision):
         conn.commit()
         return jsonify({'ok': True})
     except Exception as e:
+        if database_moved(e):
+            raise  # retry_on_swap
         return jsonify({'ok': False, 'error': str(e)}), 500
     finally:
         conn.close()
@@ -1701,8 +1773,10 @@ def api_crm_portfolio():
 
 @app.route('/api/crm/ponderacion/<cod_cliente>', methods=['PUT'])
 @login_required
+@retry_on_swap
 def api_crm_ponderacion(cod_cliente):
     """Set custom ponderación (weight %) for a client. Affects all objectives. Send null to revert to default."""
+    from objective_allocation import allocate_monetary_objectives
     data = request.json or {}
     ponderacion = data.get('ponderacion_pct')
     conn = get_db()
@@ -1738,27 +1812,22 @@ def api_crm_ponderacion(cod_cliente):
 
     if avance_row:
         cod_ven = avance_row['cod_vendedor']
-        # Use fact_avance sum as source of truth (matches portfolio total)
+        # KG objective: the custom share of the vendor's total (fact_avance sum matches portfolio total)
         sum_row = conn.execute("""
-            SELECT SUM(objetivo) as t_kg, SUM(objetivo_pesos) as t_pesos, SUM(objetivo_premium_pesos) as t_premium
+            SELECT SUM(objetivo) as t_kg
             FROM fact_avance_cliente_vendedor_month
             WHERE cod_vendedor = ? AND year_month = ?
         """, (cod_ven, year_month)).fetchone()
-        if sum_row and (sum_row['t_kg'] or 0) > 0:
-            v = dict(sum_row)
-            pct = pond / 100.0
-            t_kg = v.get('t_kg') or 0
-            t_pesos = v.get('t_pesos') or 0
-            t_premium = v.get('t_premium') or 0
-            new_objetivo = t_kg * pct
-            new_pesos = t_pesos * pct if t_pesos else 0
-            new_premium = t_premium * pct if t_premium else 0
+        t_kg = (sum_row['t_kg'] or 0) if sum_row else 0
+        if t_kg > 0:
             conn.execute("""
                 UPDATE fact_avance_cliente_vendedor_month
-                SET objetivo = ?, objetivo_pesos = ?, objetivo_premium_pesos = ?
+                SET objetivo = ?
                 WHERE cod_cliente = ? AND year_month = ?
-            """, (new_objetivo, new_pesos, new_premium, cod_cliente, year_month))
-            conn.commit()
+            """, (t_kg * pond / 100.0, cod_cliente, year_month))
+        # Pesos/premium: re-run the vendor's allocation, which honors the new ponderación
+        allocate_monetary_objectives(conn, year_month, cod_ven)
+        conn.commit()
 
     conn.close()
     return jsonify({'status': 'success', 'ponderacion_pct': pond})
@@ -1766,6 +1835,7 @@ def api_crm_ponderacion(cod_cliente):
 
 @app.route('/api/crm/account/<cod_cliente>', methods=['GET', 'PUT'])
 @login_required
+@retry_on_swap
 def api_crm_account(cod_cliente):
     """Get or update CRM enrichment for a specific account."""
     conn = get_db()
@@ -1806,6 +1876,7 @@ def api_crm_account(cod_cliente):
 
 @app.route('/api/crm/gestiones/<cod_cliente>', methods=['GET', 'POST'])
 @login_required
+@retry_on_swap
 def api_crm_gestiones(cod_cliente):
     """Get or log gestiones (interactions) for a specific account."""
     conn = get_db()
@@ -1830,6 +1901,7 @@ def api_crm_gestiones(cod_cliente):
 
 @app.route('/api/crm/compromisos/<cod_cliente>', methods=['GET', 'POST', 'PUT'])
 @login_required
+@retry_on_swap
 def api_crm_compromisos(cod_cliente):
     """Manage formal commitments for an account."""
     conn = get_db()
@@ -1862,6 +1934,7 @@ def api_crm_compromisos(cod_cliente):
 
 @app.route('/api/crm/planificacion', methods=['GET', 'POST', 'PUT'])
 @login_required
+@retry_on_swap
 def api_crm_planificacion():
     """Executive planning: monthly, weekly, daily."""
     conn = get_db()
@@ -1901,6 +1974,7 @@ def api_crm_planificacion():
 @app.route('/api/crm/planificacion-recurrente', methods=['GET', 'POST'])
 @app.route('/api/crm/planificacion-recurrente/<int:rid>', methods=['PUT', 'DELETE'])
 @login_required
+@retry_on_swap
 def api_crm_planificacion_recurrente(rid=None):
     """Recurring planning rules (e.g. every Friday load orders for MUY BARATO)."""
     conn = get_db()
@@ -1947,6 +2021,7 @@ def api_crm_planificacion_recurrente(rid=None):
 
 @app.route('/api/crm/planificacion-recurrente/<int:rid>/completado', methods=['POST'])
 @login_required
+@retry_on_swap
 def api_crm_planificacion_recurrente_completado(rid):
     """Mark a recurring task as done for a specific date."""
     data = request.json or {}
@@ -1994,6 +2069,7 @@ def api_crm_planificacion_recurrente_para_fecha():
 
 @app.route('/api/crm/pdv/<cod_cliente>', methods=['GET', 'POST'])
 @login_required
+@retry_on_swap
 def api_crm_pdv(cod_cliente):
     """Get or create PDVs for a distributor account."""
     conn = get_db()
@@ -2225,6 +2301,7 @@ def api_mapa_clientes():
 
 
 @app.route('/api/mapa/cliente/<cod_cliente>/geocode', methods=['POST'])
+@retry_on_swap
 def api_save_geocode(cod_cliente):
     """Save geocoded lat/lon for a client."""
     data = request.get_json()
@@ -2332,9 +2409,10 @@ def api_insights():
     projected_kg_linear = fact_kg
     if vendor_codes and elapsed_days > 0:
         ph = ','.join(['?'] * len(vendor_codes))
+        daily_table, kg_col = _daily_sales_source(conn)
         daily_rows = conn.execute(f"""
-            SELECT strftime('%d', fecha_emision) as dia, SUM(cantidad) as kg
-            FROM fact_facturacion
+            SELECT strftime('%d', fecha_emision) as dia, SUM({kg_col}) as kg
+            FROM {daily_table}
             WHERE cod_vendedor IN ({ph}) AND year_month = ?
             GROUP BY dia
         """, vendor_codes + [cur_ym]).fetchall()
@@ -2356,59 +2434,24 @@ def api_insights():
     next_y_num = year if month < 12 else year + 1
     next_ym_fc = f"{next_y_num}-{next_m_num:02d}"
 
-    # Aggregate historical monthly totals for the whole filter scope
-    scope_hist_rows = conn.execute(f"""
-        SELECT h.year_month, SUM(h.kg_vendidos) as kg
-        FROM fact_cliente_historico h
-        JOIN fact_avance_cliente_vendedor_month av
-          ON h.cod_cliente = av.cod_cliente AND av.year_month = ?
-        WHERE {where} AND h.kg_vendidos > 0
-        GROUP BY h.year_month ORDER BY h.year_month
-    """, params + [cur_ym]).fetchall()
-    scope_hist = [(r['year_month'], r['kg']) for r in scope_hist_rows]
-
-    next_forecast_kg = None
-    next_low_kg = None
-    next_high_kg = None
-    next_confidence = None
-
-    if scope_hist:
-        scope_vals = [kg for _, kg in scope_hist]
-        scope_months = [ym2 for ym2, _ in scope_hist]
-
-        # Baseline: trimmed 6M mean
-        r6 = scope_vals[-6:]
-        if len(r6) >= 4:
-            baseline_fc = _stats.mean(sorted(r6)[1:-1])
-        else:
-            baseline_fc = _stats.mean(r6)
-
-        # Trend: slope last 3 months
-        r3 = scope_vals[-3:]
-        n3 = len(r3)
-        if n3 >= 2:
-            xm3 = _stats.mean(range(n3))
-            ym3 = _stats.mean(r3)
-            denom3 = sum((xi - xm3)**2 for xi in range(n3))
-            slope3 = sum((xi-xm3)*(yi-ym3) for xi,yi in zip(range(n3),r3)) / denom3 if denom3 else 0
-            trend_fc = 1.0 + max(-0.30, min(0.30, slope3 / baseline_fc))
-        else:
-            trend_fc = 1.0
-
-        # Seasonality: same month in prior data
-        same_m = [kg for ym2, kg in scope_hist if int(ym2.split('-')[1]) == next_m_num]
-        all_mean_fc = _stats.mean(scope_vals) if scope_vals else baseline_fc
-        season_fc = _stats.mean(same_m) / all_mean_fc if same_m and all_mean_fc > 0 else 1.0
-        season_fc = max(0.65, min(1.50, season_fc))
-
-        # Recency: did the scope sell last month?
-        recency_fc = 1.0 if (scope_vals and scope_vals[-1] > 0) else 0.85
+    # Persisted rollup from the ETL forecast stage; live fallback otherwise
+    from forecast_engine import latest_forecast_run, read_persisted_rollup, scope_next_month
+    if cod_vendedor:
+        nivel, clave = 'vendedor', cod_vendedor
+    elif jefe:
+        nivel, clave = 'jefe', jefe
+    else:
+        nivel, clave = 'zona', zona
+    run_id = latest_forecast_run(conn, cur_ym, next_ym_fc)
+    if run_id:
+        next_fc = read_persisted_rollup(conn, run_id, nivel, clave, next_ym_fc)
+    else:
+        next_fc = scope_next_month(conn, where, params, cur_ym, next_m_num)
 
-        next_forecast_kg = round(max(0, baseline_fc * trend_fc * season_fc * recency_fc), 0)
-        std_fc = _stats.stdev(scope_vals) if len(scope_vals) >= 2 else baseline_fc * 0.20
-        next_low_kg  = round(max(0, next_forecast_kg - std_fc), 0)
-        next_high_kg = round(next_forecast_kg + std_fc, 0)
-        next_confidence = min(85, 30 + 5 * len(scope_vals))
+    next_forecast_kg = next_fc['forecast_kg'] if next_fc else None
+    next_low_kg = next_fc['low_kg'] if next_fc else None
+    next_high_kg = next_fc['high_kg'] if next_fc else None
+    next_confidence = next_fc['confidence'] if next_fc else None
 
     # ── SITUACIÓN: Análisis semanal vs histórico ─────────────────
     situacion = {'semanas': [], 'resumen': '', 'alerta': None}
@@ -3408,22 +3451,8 @@ def api_coberturas_historial_3m():
 
     # Dynamic rules for classifying 'lanzamiento' groups using CASE WHEN
     # Re-maps categories or description patterns to the predefined 10 focus goals
-    sql_classification = """
-        CASE 
-            WHEN UPPER(p.categoria) LIKE '%HAMBURGUESA%' THEN 'HG'
-            WHEN UPPER(p.categoria) LIKE '%SALCHICHA%' THEN 'SCH'
-            WHEN UPPER(p.categoria) LIKE '%REBOZADO%' OR UPPER(p.descripcion) LIKE '%REBOZADO%' THEN 'RB'
-            WHEN UPPER(p.descripcion) LIKE '%SOJA%' OR UPPER(p.categoria) LIKE '%SOJA%' THEN 'SJ'
-            WHEN UPPER(p.descripcion) LIKE '%GRASA%' THEN 'GRASA'
-            WHEN UPPER(p.descripcion) LIKE '%PICADA%' THEN 'CARNE PICADA'
-            WHEN UPPER(p.categoria) LIKE '%PAPA%' THEN 'PAPAS'
-            WHEN UPPER(p.categoria) = 'PESCADOS' OR UPPER(p.descripcion) LIKE '%ATUN%' THEN 'ATUN'
-            WHEN UPPER(p.categoria) = 'EMBUTIDOS' OR UPPER(p.descripcion) LIKE '%CHORIZO%' THEN 'CHORIZOS'
-            WHEN UPPER(p.categoria) = 'UNTABLES' 
-                 AND (UPPER(p.descripcion) LIKE '%JALAPEÑO%' OR UPPER(p.descripcion) LIKE '%JAPALEÑO%' OR UPPER(p.descripcion) LIKE '%CHILE%') THEN 'UNT'
-            ELSE NULL
-        END
-    """
+    from forecast_engine import CATEGORY_CASE_SQL, CATEGORY_OBJECTIVES
+    sql_classification = CATEGORY_CASE_SQL
 
     # Get buyers per launch category per month directly from facts
     rows = conn.execute(f"""
@@ -3455,7 +3484,7 @@ def api_coberturas_historial_3m():
         }
 
     # Ensure all 10 target categories exist in the series dictionary with zeros if no sales
-    target_categories = ['HG', 'SCH', 'UNT', 'RB', 'SJ', 'GRASA', 'CARNE PICADA', 'PAPAS', 'ATUN', 'CHORIZOS']
+    target_categories = list(CATEGORY_OBJECTIVES)
     for lz in target_categories:
         if lz not in series:
             series[lz] = {}
@@ -3499,7 +3528,7 @@ def api_forecast():
     - RECENCY: penalises clients who missed recent months (churn signal)
     Confidence interval: ±1σ of monthly distribution (≈68%)
     """
-    import statistics
+    from forecast_engine import forecast_scope, latest_forecast_run, read_persisted_forecast
 
     cod_vendedor = request.args.get('vendedor', '')
     jefe         = request.args.get('jefe', '')
@@ -3513,12 +3542,15 @@ def api_forecast():
     if cod_vendedor:
         where_av = "av.cod_vendedor = ?"
         av_params = [cod_vendedor]
+        nivel, clave = 'vendedor', cod_vendedor
     elif jefe:
         where_av = "av.jefe = ?"
         av_params = [jefe]
+        nivel, clave = 'jefe', jefe
     else:
         where_av = "av.zona = ?"
         av_params = [zona]
+        nivel, clave = 'zona', zona
 
     cur_ym_row = conn.execute(
         "SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month"
@@ -3532,165 +3564,16 @@ def api_forecast():
     next_y = y_cur if m_cur < 12 else y_cur + 1
     next_ym = f"{next_y}-{next_m:02d}"
 
-    # Clients in scope
-    clients = conn.execute(f"""
-        SELECT av.cod_cliente, av.nom_cliente, av.objetivo, av.venta_actual,
-               s.tier, s.score
-        FROM fact_avance_cliente_vendedor_month av
-        LEFT JOIN fact_client_segmentation s
-            ON av.cod_cliente = s.cod_cliente AND av.year_month = s.year_month
-        WHERE {where_av} AND av.year_month = ?
-    """, av_params + [cur_ym]).fetchall()
-
-    # Zone-level monthly average for benchmark
-    zone_monthly_avgs = conn.execute(f"""
-        SELECT h.year_month, AVG(h.kg_vendidos) as avg_kg
-        FROM fact_cliente_historico h
-        JOIN fact_avance_cliente_vendedor_month av
-            ON h.cod_cliente = av.cod_cliente
-        WHERE {where_av} AND av.year_month = ?
-          AND h.kg_vendidos > 0
-        GROUP BY h.year_month
-        ORDER BY h.year_month
-    """, av_params + [cur_ym]).fetchall()
-    zone_avg_map = {r['year_month']: r['avg_kg'] for r in zone_monthly_avgs}
-
-    # Launch engagement count per client (active in lanzamientos this month)
-    launch_counts = conn.execute(f"""
-        SELECT lz.cod_cliente, COUNT(DISTINCT lz.lanzamiento) as n_launches
-        FROM fact_lanzamiento_cobertura lz
-        JOIN fact_avance_cliente_vendedor_month av
-            ON lz.cod_cliente = av.cod_cliente
-        WHERE {where_av} AND av.year_month = ?
-          AND lz.year_month = ?
-          AND lz.estado = 'COMPRADOR'
-        GROUP BY lz.cod_cliente
-    """, av_params + [cur_ym, cur_ym]).fetchall()
-    launch_map = {r['cod_cliente']: r['n_launches'] for r in launch_counts}
-    max_launches = max(launch_map.values(), default=1)
-
-    forecasts = []
-    for client in clients:
-        cid = client['cod_cliente']
-
-        # Full history from fact_cliente_historico (sorted asc)
-        hist_rows = conn.execute("""
-            SELECT year_month, kg_vendidos FROM fact_cliente_historico
-            WHERE cod_cliente = ? AND kg_vendidos > 0
-            ORDER BY year_month ASC
-        """, (cid,)).fetchall()
-        hist = [(r['year_month'], r['kg_vendidos']) for r in hist_rows]
-
-        if not hist:
-            # No history: use current venta_actual as single data point
-            if client['venta_actual'] and client['venta_actual'] > 0:
-                fc = round(client['venta_actual'], 0)
-                forecasts.append({
-                    'cod_cliente': cid,
-                    'nom_cliente': client['nom_cliente'],
-                    'tier': client['tier'],
-                    'forecast_kg': fc,
-                    'low_kg': round(fc * 0.75, 0),
-                    'high_kg': round(fc * 1.25, 0),
-                    'confidence': 30,
-                    'factors': {'note': 'sin historial — estimado desde mes actual'},
-                    'objetivo_kg': client['objetivo'],
-                    'venta_actual': client['venta_actual'],
-                })
-            continue
-
-        vals = [kg for _, kg in hist]
-        months_list = [ym for ym, _ in hist]
-
-        # ── 1. BASELINE: trimmed 6M mean ──────────────────────────
-        recent_6 = vals[-6:]
-        if len(recent_6) >= 4:
-            s6 = sorted(recent_6)
-            baseline = statistics.mean(s6[1:-1])   # drop min and max
-        else:
-            baseline = statistics.mean(recent_6)
-
-        if baseline <= 0:
-            continue
-
-        # ── 2. TREND: linear slope on last 3 months ───────────────
-        r3 = vals[-3:]
-        n3 = len(r3)
-        if n3 >= 2:
-            x = list(range(n3))
-            xm, ym_ = statistics.mean(x), statistics.mean(r3)
-            denom = sum((xi - xm)**2 for xi in x)
-            slope = sum((xi-xm)*(yi-ym_) for xi, yi in zip(x,r3)) / denom if denom else 0
-            trend_factor = 1.0 + max(-0.30, min(0.30, slope / baseline))
-        else:
-            trend_factor = 1.0
-
-        # ── 3. SEASONALITY: same month in prior data vs overall mean ─
-        target_m_num = next_m
-        same_m_vals = [kg for ym_, kg in hist if int(ym_.split('-')[1]) == target_m_num and kg > 0]
-        all_mean = statistics.mean(vals) if vals else baseline
-        if same_m_vals and all_mean > 0:
-            season_factor = statistics.mean(same_m_vals) / all_mean
-            season_factor = max(0.65, min(1.50, season_factor))
-        else:
-            season_factor = 1.0
-
-        # ── 4. RECENCY: penalise missed recent months ──────────────
-        last_2 = vals[-2:]
-        zeros_recent = sum(1 for v in last_2 if v == 0)
-        recency_factor = 1.0 if zeros_recent == 0 else (0.80 if zeros_recent == 1 else 0.60)
-
-        # ── 5. LAUNCH engagement bonus ─────────────────────────────
-        n_lz = launch_map.get(cid, 0)
-        launch_factor = 1.0 + 0.08 * (n_lz / max(max_launches, 1))  # up to +8% for top buyer
-
-        # ── 6. ZONE benchmark ──────────────────────────────────────
-        # client's last 3M avg relative to zone avg → small corrective weight
-        zone_avg_3m = statistics.mean([
-            zone_avg_map.get(m, 0) for m in months_list[-3:]
-        ]) if zone_avg_map else 0
-        client_avg_3m = statistics.mean(vals[-3:]) if vals else 0
-        if zone_avg_3m > 0:
-            zone_ratio = client_avg_3m / zone_avg_3m
-            zone_factor = 1.0 + 0.05 * max(-1, min(1, zone_ratio - 1))  # ±5% weight
-        else:
-            zone_factor = 1.0
-
-        # ── Combined forecast ──────────────────────────────────────
-        forecast_kg = baseline * trend_factor * season_factor * recency_factor * launch_factor * zone_factor
-        forecast_kg = max(0, round(forecast_kg, 0))
-
-        # ── Confidence interval: ±1σ of historical distribution ───
-        if len(vals) >= 2:
-            std = statistics.stdev(vals)
-        else:
-            std = baseline * 0.20
-        low_kg  = max(0, round(forecast_kg - std, 0))
-        high_kg = round(forecast_kg + std, 0)
-
-        # Confidence: grows with history length (30% for 1M, 85% for 12M+)
-        confidence = min(85, 30 + 5 * len(vals))
-
-        forecasts.append({
-            'cod_cliente': cid,
-            'nom_cliente': client['nom_cliente'],
-            'tier': client['tier'],
-            'forecast_kg': forecast_kg,
-            'low_kg': low_kg,
-            'high_kg': high_kg,
-            'confidence': confidence,
-            'objetivo_kg': client['objetivo'],
-            'venta_actual': client['venta_actual'],
-            'hist_months': len(vals),
-            'factors': {
-                'baseline_kg': round(baseline, 0),
-                'trend': round(trend_factor, 3),
-                'seasonality': round(season_factor, 3),
-                'recency': recency_factor,
-                'launch_engagement': round(launch_factor, 3),
-                'zone_benchmark': round(zone_factor, 3),
-            }
-        })
+    # Persisted per scope by the ETL forecast stage (fact_forecast); compute
+    # live only when no run exists yet for this month or it lacks this scope
+    run_id = latest_forecast_run(conn, cur_ym, next_ym)
+    forecasts = None
+    if run_id:
+        forecasts = read_persisted_forecast(conn, run_id, nivel, clave, where_av, av_params, cur_ym, next_ym)
+    if forecasts is None:
+        # Clients in scope: one history query → clients × months matrix,
+        # every factor computed with array operations (see forecast_engine.py)
+        forecasts = forecast_scope(conn, where_av, av_params, cur_ym, next_m)
 
     conn.close()
 
@@ -3726,6 +3609,55 @@ def api_forecast():
         'clients': forecasts
     })
 
+@app.route('/api/forecast/categorias')
+def api_forecast_categorias():
+    """
+    Next-month forecast per client × focus category (HG, SCH, UNT, RB, SJ,
+    GRASA, CARNE PICADA, PAPAS, ATUN, CHORIZOS) from fact_facturacion, rolled
+    up per vendor against the vendedor_objetivos obj_* targets.
+    Optional: meses (history window, default 24), budget (seconds, default 10).
+    """
+    from forecast_engine import category_forecast
+
+    cod_vendedor = request.args.get('vendedor', '')
+    jefe         = request.args.get('jefe', '')
+    zona         = request.args.get('zona', '')
+    meses        = request.args.get('meses', 24, type=int)
+    budget       = request.args.get('budget', 10.0, type=float)
+
+    if not any([cod_vendedor, jefe, zona]):
+        return jsonify({'error': 'filter required'}), 400
+
+    conn = get_db()
+
+    if cod_vendedor:
+        where_av = "av.cod_vendedor = ?"
+        av_params = [cod_vendedor]
+    elif jefe:
+        where_av = "av.jefe = ?"
+        av_params = [jefe]
+    else:
+        where_av = "av.zona = ?"
+        av_params = [zona]
+
+    cur_ym = conn.execute(
+        "SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month"
+    ).fetchone()[0]
+    if not cur_ym:
+        conn.close()
+        return jsonify({'categorias': [], 'vendedores': [], 'clientes': []})
+    y_cur, m_cur = map(int, cur_ym.split('-'))
+    next_m = m_cur + 1 if m_cur < 12 else 1
+    next_y = y_cur if m_cur < 12 else y_cur + 1
+
+    result = category_forecast(conn, where_av, av_params, cur_ym, next_m,
+                               months_back=meses, budget_s=budget)
+    conn.close()
+
+    result['next_month'] = f"{next_y}-{next_m:02d}"
+    result['current_month'] = cur_ym
+    return jsonify(result)
+
 def _build_deuda_alertas(conn, clientes, dia_string, fecha_visita, tipo_suffix):
     """Build debt/contado anticipado alerts for a list of clients. Returns list with alert_id."""
     alertas = []
@@ -4066,6 +3998,7 @@ def api_alertas_gestion_completo():
 
 @app.route('/api/alertas/dismiss', methods=['POST'])
 @login_required
+@retry_on_swap
 def api_alertas_dismiss():
     """Mark an alert as dismissed so it no longer appears."""
     data = request.get_json() or {}
@@ -4081,12 +4014,15 @@ def api_alertas_dismiss():
         conn.commit()
         return jsonify({'ok': True})
     except Exception as e:
+        if database_moved(e):
+            raise  # retry_on_swap
         return jsonify({'ok': False, 'error': str(e)}), 500
     finally:
         conn.close()
 
 
 @app.route('/api/objetivos/mensual', methods=['GET', 'POST'])
+@retry_on_swap
 def api_objetivos_mensual():
     """
     GET: Devuelve los 13 objetivos globales del vendedor para el mes activo.
@@ -4123,6 +4059,7 @@ def api_objetivos_mensual():
         return jsonify(dict(row))
 
     elif request.method == 'POST':
+        from objective_allocation import allocate_monetary_objectives
         data = request.json
         obj_pesos = float(data.get('objetivo_pesos', 0))
         obj_premium = float(data.get('objetivo_premium_pesos', 0))
@@ -4156,27 +4093,8 @@ def api_objetivos_mensual():
               obj_hg, obj_sch, obj_unt, obj_rb, obj_sj, obj_grasa, obj_picada, obj_papas, obj_atun, obj_chori))
 
         # 2. Recalculate proportional distribution (pesos/premium) for clients of this vendor
-        if obj_kg > 0:
-            clients = conn.execute("""
-                SELECT cod_cliente, objetivo 
-                FROM fact_avance_cliente_vendedor_month
-                WHERE cod_vendedor = ? AND year_month = ?
-            """, (cod_vendedor, cur_ym)).fetchall()
-            
-            for cod_cli, cliente_kg in clients:
-                if not cliente_kg or cliente_kg == 0:
-                    continue
-                # Proportional allocation based on kg
-                proportion = cliente_kg / obj_kg
-                cliente_obj_pesos = obj_pesos * proportion
-                cliente_obj_premium = obj_premium * proportion
-                
-                conn.execute("""
-                    UPDATE fact_avance_cliente_vendedor_month
-                    SET objetivo_pesos = ?, objetivo_premium_pesos = ?
-                    WHERE cod_cliente = ? AND cod_vendedor = ? AND year_month = ?
-                """, (cliente_obj_pesos, cliente_obj_premium, cod_cli, cod_vendedor, cur_ym))
-                
+        allocate_monetary_objectives(conn, cur_ym, cod_vendedor)
+
         conn.commit()
         conn.close()
         return jsonify({'status': 'success', 'message': 'Objetivos guardados correctamente'})
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-client /api/forecast loop vs. forecast_engine (vectorized).
+
+Builds a synthetic zona (default 2,000 clients × 24 months) in a temporary
+SQLite DB — or uses an existing DB with --db-path — runs both
+implementations on the same scope, checks that the payloads are identical
+and prints the timings.
+
+Usage:
+  python benchmarks/bench_forecast.py
+  python benchmarks/bench_forecast.py --clients 5000 --months 36
+  python benchmarks/bench_forecast.py --db-path db/app.db --zona Litoral
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from forecast_engine import forecast_scope  # noqa: E402
+
+
+def legacy_forecast(conn, where_av, av_params, cur_ym, next_m):
+    """The original per-client loop of /api/forecast (one query per client)."""
+    clients = conn.execute(f"""
+        SELECT av.cod_cliente, av.nom_cliente, av.objetivo, av.venta_actual,
+               s.tier, s.score
+        FROM fact_avance_cliente_vendedor_month av
+        LEFT JOIN fact_client_segmentation s
+            ON av.cod_cliente = s.cod_cliente AND av.year_month = s.year_month
+        WHERE {where_av} AND av.year_month = ?
+    """, av_params + [cur_ym]).fetchall()
+
+    zone_monthly_avgs = conn.execute(f"""
+        SELECT h.year_month, AVG(h.kg_vendidos) as avg_kg
+        FROM fact_cliente_historico h
+        JOIN fact_avance_cliente_vendedor_month av
+            ON h.cod_cliente = av.cod_cliente
+        WHERE {where_av} AND av.year_month = ?
+          AND h.kg_vendidos > 0
+        GROUP BY h.year_month
+        ORDER BY h.year_month
+    """, av_params + [cur_ym]).fetchall()
+    zone_avg_map = {r['year_month']: r['avg_kg'] for r in zone_monthly_avgs}
+
+    launch_counts = conn.execute(f"""
+        SELECT lz.cod_cliente, COUNT(DISTINCT lz.lanzamiento) as n_launches
+        FROM fact_lanzamiento_cobertura lz
+        JOIN fact_avance_cliente_vendedor_month av
+            ON lz.cod_cliente = av.cod_cliente
+        WHERE {where_av} AND av.year_month = ?
+          AND lz.year_month = ?
+          AND lz.estado = 'COMPRADOR'
+        GROUP BY lz.cod_cliente
+    """, av_params + [cur_ym, cur_ym]).fetchall()
+    launch_map = {r['cod_cliente']: r['n_launches'] for r in launch_counts}
+    max_launches = max(launch_map.values(), default=1)
+
+    forecasts = []
+    for client in clients:
+        cid = client['cod_cliente']
+        hist_rows = conn.execute("""
+            SELECT year_month, kg_vendidos FROM fact_cliente_historico
+            WHERE cod_cliente = ? AND kg_vendidos > 0
+            ORDER BY year_month ASC
+        """, (cid,)).fetchall()
+        hist = [(r['year_month'], r['kg_vendidos']) for r in hist_rows]
+
+        if not hist:
+            if client['venta_actual'] and client['venta_actual'] > 0:
+                fc = round(client['venta_actual'], 0)
+                forecasts.append({
+                    'cod_cliente': cid,
+                    'nom_cliente': client['nom_cliente'],
+                    'tier': client['tier'],
+                    'forecast_kg': fc,
+                    'low_kg': round(fc * 0.75, 0),
+                    'high_kg': round(fc * 1.25, 0),
+                    'confidence': 30,
+                    'factors': {'note': 'sin historial — estimado desde mes actual'},
+                    'objetivo_kg': client['objetivo'],
+                    'venta_actual': client['venta_actual'],
+                })
+            continue
+
+        vals = [kg for _, kg in hist]
+        months_list = [ym for ym, _ in hist]
+
+        recent_6 = vals[-6:]
+        if len(recent_6) >= 4:
+            s6 = sorted(recent_6)
+            baseline = statistics.mean(s6[1:-1])
+        else:
+            baseline = statistics.mean(recent_6)
+        if baseline <= 0:
+            continue
+
+        r3 = vals[-3:]
+        n3 = len(r3)
+        if n3 >= 2:
+            x = list(range(n3))
+            xm, ym_ = statistics.mean(x), statistics.mean(r3)
+            denom = sum((xi - xm)**2 for xi in x)
+            slope = sum((xi-xm)*(yi-ym_) for xi, yi in zip(x, r3)) / denom if denom else 0
+            trend_factor = 1.0 + max(-0.30, min(0.30, slope / baseline))
+        else:
+            trend_factor = 1.0
+
+        same_m_vals = [kg for ym_, kg in hist if int(ym_.split('-')[1]) == next_m and kg > 0]
+        all_mean = statistics.mean(vals) if vals else baseline
+        if same_m_vals and all_mean > 0:
+            season_factor = statistics.mean(same_m_vals) / all_mean
+            season_factor = max(0.65, min(1.50, season_factor))
+        else:
+            season_factor = 1.0
+
+        last_2 = vals[-2:]
+        zeros_recent = sum(1 for v in last_2 if v == 0)
+        recency_factor = 1.0 if zeros_recent == 0 else (0.80 if zeros_recent == 1 else 0.60)
+
+        n_lz = launch_map.get(cid, 0)
+        launch_factor = 1.0 + 0.08 * (n_lz / max(max_launches, 1))
+
+        zone_avg_3m = statistics.mean([
+            zone_avg_map.get(m, 0) for m in months_list[-3:]
+        ]) if zone_avg_map else 0
+        client_avg_3m = statistics.mean(vals[-3:]) if vals else 0
+        if zone_avg_3m > 0:
+            zone_ratio = client_avg_3m / zone_avg_3m
+            zone_factor = 1.0 + 0.05 * max(-1, min(1, zone_ratio - 1))
+        else:
+            zone_factor = 1.0
+
+        forecast_kg = baseline * trend_factor * season_factor * recency_factor * launch_factor * zone_factor
+        forecast_kg = max(0, round(forecast_kg, 0))
+
+        if len(vals) >= 2:
+            std = statistics.stdev(vals)
+        else:
+            std = baseline * 0.20
+        low_kg = max(0, round(forecast_kg - std, 0))
+        high_kg = round(forecast_kg + std, 0)
+        confidence = min(85, 30 + 5 * len(vals))
+
+        forecasts.append({
+            'cod_cliente': cid,
+            'nom_cliente': client['nom_cliente'],
+            'tier': client['tier'],
+            'forecast_kg': forecast_kg,
+            'low_kg': low_kg,
+            'high_kg': high_kg,
+            'confidence': confidence,
+            'objetivo_kg': client['objetivo'],
+            'venta_actual': client['venta_actual'],
+            'hist_months': len(vals),
+            'factors': {
+                'baseline_kg': round(baseline, 0),
+                'trend': round(trend_factor, 3),
+                'seasonality': round(season_factor, 3),
+                'recency': recency_factor,
+                'launch_engagement': round(launch_factor, 3),
+                'zone_benchmark': round(zone_factor, 3),
+            }
+        })
+    return forecasts
+
+
+def build_synthetic_db(path, n_clients, n_months, seed=7):
+    """One zona with n_clients and up to n_months of history (random gaps)."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE fact_avance_cliente_vendedor_month (
+            year_month TEXT, zona TEXT, jefe TEXT, cod_vendedor TEXT,
+            cod_cliente TEXT, nom_cliente TEXT, venta_actual REAL, objetivo REAL);
+        CREATE TABLE fact_client_segmentation (
+            cod_cliente TEXT, year_month TEXT, tier TEXT, score REAL,
+            PRIMARY KEY (cod_cliente, year_month));
+        CREATE TABLE fact_cliente_historico (
+            cod_cliente TEXT, cod_vendedor TEXT, year_month TEXT, kg_vendidos REAL,
+            PRIMARY KEY (cod_cliente, year_month));
+        CREATE TABLE fact_lanzamiento_cobertura (
+            year_month TEXT, lanzamiento TEXT, cod_cliente TEXT, estado TEXT,
+            PRIMARY KEY (year_month, lanzamiento, cod_cliente));
+        CREATE INDEX idx_av_ym ON fact_avance_cliente_vendedor_month(year_month);
+    """)
+    cur_ym = '2026-03'
+    months = []
+    y, m = 2026, 3
+    for _ in range(n_months):
+        m -= 1
+        if m == 0:
+            y, m = y - 1, 12
+        months.append(f"{y}-{m:02d}")
+    months.reverse()
+
+    av, seg, hist, lz = [], [], [], []
+    for i in range(n_clients):
+        cid = f"1{i:08d}"
+        ven = f"V{i % 12:03d}"
+        scale = rnd.lognormvariate(7, 1.2)
+        av.append((cur_ym, 'ZONA BENCH', 'JEFE', ven, cid, f"CLIENTE {i}",
+                   round(rnd.random() * scale, 2), round(scale, 0)))
+        seg.append((cid, cur_ym, rnd.choice(['AAA', 'AA', 'A', 'B']), rnd.random() * 100))
+        start = rnd.randrange(0, n_months)
+        for ym in months[start:]:
+            if rnd.random() < 0.15:
+                continue
+            hist.append((cid, ven, ym, round(scale * rnd.uniform(0.4, 1.6), 2)))
+        for lanz in ('Papas', 'Chorizos', 'Untables', 'ATUN'):
+            if rnd.random() < 0.3:
+                lz.append((cur_ym, lanz, cid, 'COMPRADOR'))
+
+    conn.executemany("INSERT INTO fact_avance_cliente_vendedor_month VALUES (?,?,?,?,?,?,?,?)", av)
+    conn.executemany("INSERT INTO fact_client_segmentation VALUES (?,?,?,?)", seg)
+    conn.executemany("INSERT INTO fact_cliente_historico VALUES (?,?,?,?)", hist)
+    conn.executemany("INSERT INTO fact_lanzamiento_cobertura VALUES (?,?,?,?)", lz)
+    conn.commit()
+    conn.close()
+    return cur_ym
+
+
+def _timed(fn, repeat):
+    best = None
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark forecast engine vs per-client loop")
+    parser.add_argument("--db-path", help="Existing DB (default: synthetic temp DB)")
+    parser.add_argument("--zona", default="ZONA BENCH", help="Zona to forecast")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = None
+    if args.db_path:
+        db_path = args.db_path
+        conn = sqlite3.connect(db_path)
+        cur_ym = conn.execute("SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month").fetchone()[0]
+        conn.close()
+    else:
+        tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        tmp.close()
+        db_path = tmp.name
+        cur_ym = build_synthetic_db(db_path, args.clients, args.months)
+
+    y, m = map(int, cur_ym.split('-'))
+    next_m = m + 1 if m < 12 else 1
+    where_av, av_params = "av.zona = ?", [args.zona]
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        legacy, t_legacy = _timed(lambda: legacy_forecast(conn, where_av, av_params, cur_ym, next_m), args.repeat)
+        engine, t_engine = _timed(lambda: forecast_scope(conn, where_av, av_params, cur_ym, next_m), args.repeat)
+    finally:
+        conn.close()
+        if tmp:
+            os.unlink(db_path)
+
+    mismatches = [(a['cod_cliente'], a, b) for a, b in zip(legacy, engine) if a != b]
+    print(f"Scope: zona={args.zona} month={cur_ym} → {len(legacy)} client forecasts")
+    print(f"  per-client loop : {t_legacy * 1000:9.1f} ms")
+    print(f"  vectorized      : {t_engine * 1000:9.1f} ms")
+    print(f"  speedup         : {t_legacy / t_engine:9.1f}x")
+    if len(legacy) != len(engine) or mismatches:
+        print(f"  MISMATCH: {len(mismatches)} rows differ (lengths {len(legacy)} vs {len(engine)})")
+        for cid, a, b in mismatches[:5]:
+            print(f"    {cid}\n      loop:   {a}\n      engine: {b}")
+        sys.exit(1)
+    print("  payloads identical ✓")
+
+
+if __name__ == "__main__":
+    main()
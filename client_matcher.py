@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Client Matcher
+In-memory index of dim_clients used to attach source rows (avance, sellout,
+price lists) to a client. Built once per run, then every lookup is a dict hit:
+
+  1. id            — cliente_id
+  2. centralizador — cod_centralizador (first client in dim_clients order)
+  3. name          — normalized cliente_name (first client when several share it)
+  4. fuzzy         — optional: trigram similarity >= fuzzy_threshold on the
+                     normalized name, for near-miss spellings
+
+Names shared by several clients (and fuzzy ties) are collected in
+`ambiguous` so callers can report them in one go instead of row by row.
+
+Usage:
+  matcher = ClientMatcher.from_db(conn)
+  frecuencia, quality = matcher.match(cod_cliente, nom_cliente, cod_centralizador)
+"""
+
+import re
+import unicodedata
+from collections import Counter
+
+import pandas as pd
+
+
+def normalize_text(text):
+    if pd.isna(text): return ""
+    text = str(text).strip().upper()
+    text = re.sub(r'\s+', ' ', text)
+    # Remove accents/special chars for name matching
+    text = "".join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return text
+
+
+def trigrams(name):
+    """Character trigrams of a normalized name, padded so short names still match."""
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ClientMatcher:
+    def __init__(self, clients, fuzzy_threshold=None):
+        """clients: (cliente_id, cod_centralizador, cliente_name, frecuencia)
+        tuples in dim_clients order; earlier clients win ties."""
+        self.fuzzy_threshold = fuzzy_threshold
+        self.by_id = {}
+        self.by_centralizador = {}
+        self.by_name = {}   # normalized name → [(cliente_id, frecuencia), ...]
+        self.ambiguous = [] # (cod_cliente, nom_cliente, quality, [candidate cliente_ids])
+
+        for cliente_id, centralizador, name, frecuencia in clients:
+            self.by_id.setdefault(cliente_id, frecuencia)
+            if centralizador:
+                self.by_centralizador.setdefault(centralizador, frecuencia)
+            self.by_name.setdefault(normalize_text(name), []).append((cliente_id, frecuencia))
+
+        self._names = []    # fuzzy index: position → normalized name
+        self._grams = []
+        self._postings = {} # trigram → positions of the names containing it
+        if fuzzy_threshold:
+            for pos, name in enumerate(n for n in self.by_name if n):
+                grams = trigrams(name)
+                self._names.append(name)
+                self._grams.append(len(grams))
+                for g in grams:
+                    self._postings.setdefault(g, []).append(pos)
+
+    @classmethod
+    def from_db(cls, conn, fuzzy_threshold=None):
+        rows = conn.execute("""
+            SELECT cliente_id, cod_centralizador, cliente_name, frecuencia
+            FROM dim_clients ORDER BY rowid
+        """).fetchall()
+        return cls((tuple(r) for r in rows), fuzzy_threshold)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def match(self, cod_cliente, nom_cliente, cod_centralizador):
+        """(frecuencia, quality) with quality id / centralizador / name / fuzzy / unmatched."""
+        # 1. Primary: ID Match
+        if cod_cliente in self.by_id:
+            return self.by_id[cod_cliente], "id"
+
+        # 2. Secondary: Centralizador Match
+        if cod_centralizador and cod_centralizador in self.by_centralizador:
+            return self.by_centralizador[cod_centralizador], "centralizador"
+
+        # 3. Tertiary: Normalized Name Match
+        norm_name = normalize_text(nom_cliente)
+        if not norm_name:
+            return None, "unmatched"
+        matches = self.by_name.get(norm_name)
+        if matches:
+            if len(matches) > 1:
+                self.ambiguous.append((cod_cliente, nom_cliente, "name", [m[0] for m in matches]))
+            return matches[0][1], "name"
+
+        # 4. Optional: trigram similarity on the normalized name
+        if self.fuzzy_threshold:
+            best = self.fuzzy_candidates(norm_name)
+            if best:
+                candidates = [c for name in best for c in self.by_name[name]]
+                if len(candidates) > 1:
+                    self.ambiguous.append((cod_cliente, nom_cliente, "fuzzy", [c[0] for c in candidates]))
+                return candidates[0][1], "fuzzy"
+
+        return None, "unmatched"
+
+    def fuzzy_candidates(self, norm_name):
+        """Normalized names with the highest trigram Jaccard similarity to
+        norm_name, if it reaches fuzzy_threshold (several on a tie)."""
+        grams = trigrams(norm_name)
+        shared = Counter(pos for g in grams for pos in self._postings.get(g, ()))
+        if not shared:
+            return []
+        scores = {pos: n / (len(grams) + self._grams[pos] - n) for pos, n in shared.items()}
+        top = max(scores.values())
+        if top < self.fuzzy_threshold:
+            return []
+        return [self._names[pos] for pos, s in sorted(scores.items()) if s == top]
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+DB Generations
+The ETL never writes the live database in place: it builds into a shadow copy
+(seeded from the live DB with the SQLite online backup API), validates it and
+renames it over the live file. Every swap is a new generation:
+
+  db/app.db                   live database (generation N)
+  db/app.db.generation        N — rewritten after every swap; the app watches it
+  db/generations/app.db.<n>   previous generations, the last KEEP_GENERATIONS kept
+
+Tables the web app writes while the ETL runs (CRM, manual payments, vendor
+targets, code aliases, geocoded coordinates) are copied from the live DB into the shadow right
+before the swap, with the live DB write-locked, so no edit is lost.
+
+The app opens one connection per request, so new requests read the new file as
+soon as it is renamed; GenerationWatcher tells it when to drop its caches. A
+write that waited on the swap lock fails once the file is renamed under it
+(database_moved); the app reopens the connection and retries it.
+
+Usage:
+  conn = seed_shadow('db/app.db', 'db/app.db.shadow')
+  ...build...
+  publish_shadow(conn, 'db/app.db.shadow', 'db/app.db')
+  rollback('db/app.db', 12)
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+from pathlib import Path
+
+KEEP_GENERATIONS = 3
+
+# Extended result code of a write on a connection whose file was renamed away
+SQLITE_READONLY_DBMOVED = 1032
+
+# Owned by the web app: replaced wholesale with the live content at swap time
+PRESERVED_PREFIXES = ('crm_',)
+PRESERVED_TABLES = ('fact_factura_pagada', 'vendor_alias', 'client_alias')
+# Shared with the ETL, which only seeds missing rows: live rows win, seeded ones stay
+MERGED_TABLES = ('vendedor_objetivos',)
+# ETL-owned tables with app-edited columns: table → (key, columns)
+PRESERVED_COLUMNS = {
+    'dim_clients': ('cliente_id', ('lat', 'lon')),
+}
+# Must exist in every generation; must stay non-empty when the live copy had rows
+REQUIRED_TABLES = (
+    'dim_clients', 'dim_product_classification', 'fact_facturacion',
+    'fact_avance_cliente_vendedor_month', 'fact_cliente_historico', 'etl_run',
+)
+
+
+def database_moved(exc):
+    """True if `exc` is the error of a write through a connection opened on a
+    file that was swapped out since (retry it on a new connection)."""
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    return (getattr(exc, 'sqlite_errorcode', None) == SQLITE_READONLY_DBMOVED
+            or 'readonly database' in str(exc))
+
+
+def generation_file(db_path):
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.name + '.generation')
+
+
+def generations_dir(db_path):
+    return Path(db_path).parent / 'generations'
+
+
+def read_generation(db_path):
+    """Current generation number of db_path (0 before the first swap)."""
+    try:
+        return int(generation_file(db_path).read_text().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_generation(db_path, generation):
+    path = generation_file(db_path)
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(f"{generation}\n")
+    os.replace(tmp, path)
+
+
+def bump_generation(db_path):
+    """Start a new generation without a swap (the DB was loaded in place, or
+    another input of the app changed), so GenerationWatcher tells the app to
+    drop its caches. Returns the new generation."""
+    generation = read_generation(db_path) + 1
+    _write_generation(db_path, generation)
+    return generation
+
+
+def list_generations(db_path):
+    """[(generation, path)] of the archived generations, oldest first."""
+    db_path = Path(db_path)
+    found = []
+    for p in generations_dir(db_path).glob(f"{db_path.name}.*"):
+        suffix = p.name[len(db_path.name) + 1:]
+        if suffix.isdigit():
+            found.append((int(suffix), p))
+    return sorted(found)
+
+
+def seed_shadow(db_path, shadow_path, factory=sqlite3.Connection):
+    """Fresh shadow copy of db_path (online backup: consistent while the app
+    keeps reading and writing it). Returns a connection to the shadow."""
+    shadow_path = Path(shadow_path)
+    if shadow_path.exists():
+        shadow_path.unlink()
+    conn = sqlite3.connect(shadow_path, factory=factory)
+    if Path(db_path).exists():
+        src = sqlite3.connect(db_path)
+        try:
+            src.backup(conn)
+        finally:
+            src.close()
+    return conn
+
+
+def _tables(conn, schema='main'):
+    return {r[0] for r in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")}
+
+
+def _columns(conn, schema, table):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def preserve_app_tables(conn, db_path):
+    """Copy the app-owned data of the live DB (attached as `live`) into the shadow.
+    Returns {table: rows copied}."""
+    live_tables = _tables(conn, 'live')
+    shadow_tables = _tables(conn)
+    copied = {}
+    for table in sorted(live_tables):
+        preserved = table.startswith(PRESERVED_PREFIXES) or table in PRESERVED_TABLES
+        if not (preserved or table in MERGED_TABLES):
+            continue
+        cols = _columns(conn, 'live', table)
+        if table not in shadow_tables:
+            sql = conn.execute("SELECT sql FROM live.sqlite_master WHERE type = 'table' AND name = ?",
+                               (table,)).fetchone()[0]
+            conn.execute(sql)
+        else:
+            shadow_cols = set(_columns(conn, 'main', table))
+            cols = [c for c in cols if c in shadow_cols]
+        col_list = ', '.join(cols)
+        if preserved:
+            conn.execute(f"DELETE FROM main.{table}")
+            verb = "INSERT"
+        else:
+            verb = "INSERT OR REPLACE"
+        cur = conn.execute(f"{verb} INTO main.{table} ({col_list}) SELECT {col_list} FROM live.{table}")
+        copied[table] = cur.rowcount
+
+    # AUTOINCREMENT counters of the preserved tables: never hand out an id twice
+    if 'sqlite_sequence' in live_tables and 'sqlite_sequence' in _tables(conn):
+        names = [t for t in copied if t not in MERGED_TABLES]
+        ph = ','.join('?' * len(names))
+        conn.execute(f"""
+            UPDATE main.sqlite_sequence
+            SET seq = MAX(seq, COALESCE((SELECT l.seq FROM live.sqlite_sequence l
+                                         WHERE l.name = sqlite_sequence.name), 0))
+            WHERE name IN ({ph})
+        """, names)
+
+    for table, (key, cols) in PRESERVED_COLUMNS.items():
+        if table not in live_tables or table not in shadow_tables:
+            continue
+        sets = ', '.join(f"{c} = l.{c}" for c in cols)
+        changed = ' OR '.join(f"{table}.{c} IS NOT l.{c}" for c in cols)
+        conn.execute(f"""
+            UPDATE main.{table} SET {sets}
+            FROM live.{table} l
+            WHERE l.{key} = {table}.{key} AND ({changed})
+        """)
+    return copied
+
+
+def validate_shadow(conn):
+    """Raise ValueError unless the shadow is intact and no required table that
+    has rows in the live DB (attached as `live`) came out empty."""
+    check = conn.execute("PRAGMA main.quick_check").fetchone()[0]
+    if check != 'ok':
+        raise ValueError(f"shadow DB failed quick_check: {check}")
+    shadow_tables = _tables(conn)
+    live_tables = _tables(conn, 'live')
+    for table in REQUIRED_TABLES:
+        if table not in shadow_tables:
+            raise ValueError(f"shadow DB is missing table {table}")
+        if table in live_tables:
+            had_rows = conn.execute(f"SELECT EXISTS (SELECT 1 FROM live.{table})").fetchone()[0]
+            has_rows = conn.execute(f"SELECT EXISTS (SELECT 1 FROM main.{table})").fetchone()[0]
+            if had_rows and not has_rows:
+                raise ValueError(f"shadow DB emptied {table}")
+
+
+def _archive_live(db_path, generation, keep):
+    """Keep the current live file as generations/<name>.<generation> (hard link
+    when possible: instant, no extra space) and prune the oldest ones."""
+    db_path = Path(db_path)
+    if not db_path.exists():
+        return
+    archive_dir = generations_dir(db_path)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    target = archive_dir / f"{db_path.name}.{generation}"
+    if target.exists():
+        target.unlink()
+    try:
+        os.link(db_path, target)
+    except OSError:
+        shutil.copy2(db_path, target)
+    for _, old in list_generations(db_path)[:-keep] if keep else list_generations(db_path):
+        old.unlink()
+
+
+def publish_shadow(conn, shadow_path, db_path, keep=KEEP_GENERATIONS, before_swap=None):
+    """Validate the shadow, preserve the app tables and atomically swap it in.
+
+    The shadow is validated first, without locking the live DB. The live DB is
+    then write-locked (BEGIN IMMEDIATE) only for the table copy and the rename,
+    so no app write lands in the outgoing file. App writes issued meanwhile wait
+    on the lock and then fail with a moved-database error (database_moved): the
+    app retries them on a new connection, which opens the new file.
+    `before_swap(conn)` runs after the copy, inside the lock (e.g. to re-derive
+    data from the preserved tables). Closes `conn`; returns the new generation.
+    """
+    db_path = Path(db_path)
+    conn.commit()  # ATTACH is not allowed inside a transaction
+    live = sqlite3.connect(db_path, timeout=60) if db_path.exists() else None
+    try:
+        if live:
+            conn.execute("ATTACH DATABASE ? AS live", (str(db_path),))
+        else:
+            conn.execute("ATTACH DATABASE ':memory:' AS live")
+        validate_shadow(conn)
+        if live:
+            live.execute("BEGIN IMMEDIATE")
+            copied = preserve_app_tables(conn, db_path)
+            logging.info(f"Shadow DB: preserved {sum(n for n in copied.values() if n > 0)} rows "
+                         f"of {len(copied)} app table(s) from the live DB")
+        if before_swap:
+            before_swap(conn)
+        conn.commit()
+        conn.execute("DETACH DATABASE live")
+        conn.close()
+
+        generation = read_generation(db_path)
+        _archive_live(db_path, generation, keep)
+        os.replace(shadow_path, db_path)
+        _write_generation(db_path, generation + 1)
+    finally:
+        if live:
+            live.rollback()
+            live.close()
+    logging.info(f"Shadow DB: {db_path} is now generation {generation + 1} "
+                 f"(previous kept in {generations_dir(db_path)})")
+    return generation + 1
+
+
+def rollback(db_path, generation, keep=KEEP_GENERATIONS):
+    """Make archived `generation` live again, as a new generation (the current
+    live file is archived like any other swap). Returns the new generation."""
+    db_path = Path(db_path)
+    archived = dict(list_generations(db_path))
+    if generation not in archived:
+        raise ValueError(f"generation {generation} not found; available: {sorted(archived)}")
+    shadow_path = db_path.with_name(db_path.name + '.shadow')
+    # Copy, not link: the restored file will be written to, the archive must not
+    conn = seed_shadow(archived[generation], shadow_path)
+    conn.close()
+    current = read_generation(db_path)
+    _archive_live(db_path, current, keep)
+    os.replace(shadow_path, db_path)
+    _write_generation(db_path, current + 1)
+    logging.info(f"Rolled back {db_path} to the content of generation {generation} "
+                 f"(now generation {current + 1})")
+    return current + 1
+
+
+class GenerationWatcher:
+    """Cheap per-request check for the app: one stat() of the generation file,
+    re-read only when it changed."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.path = generation_file(db_path)
+        self.generation = read_generation(db_path)
+        self._mtime = self._stat()
+
+    def _stat(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        """True (once) when a new generation was swapped in since the last call."""
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        generation = read_generation(self.db_path)
+        if generation == self.generation:
+            return False
+        self.generation = generation
+        return True
@@ -5,6 +5,12 @@ Author: Archi (Antigravity)
 
 Usage:
   python etl.py --data-dir data --db-path db/app.db --log-path logs/etl.log
+  python etl.py --full     # reprocess every file (ignore etl_file_manifest)
+  python etl.py --segment-months 2025-06 2025-12   # recompute past tiers
+  python etl.py --only process_lanzamientos       # run some stages (see --stages)
+  python etl.py --from process_category_sheets    # a stage and everything downstream
+  python etl.py --resume   # continue the last run from the stage that failed
+  python etl.py --watch    # load source files as they land in --data-dir
 
 Required File Naming Patterns in --data-dir:
 - Facturación.txt                          (Semicolon delimited)
@@ -23,11 +29,23 @@ import sqlite3
 import re
 import json
 import hashlib
+import pickle
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import pandas as pd
 import numpy as np
 
+from client_matcher import ClientMatcher
+from objective_allocation import allocate_monetary_objectives
+from db_generations import (KEEP_GENERATIONS, bump_generation, list_generations, publish_shadow,
+                            read_generation, rollback, seed_shadow)
+import facturacion_archive
+from folder_watch import debounced_changes, open_watcher
+
 # --- CONFIGURATION & GLOBALS ---
 REQUIRED_FILES = {
     'facturacion': 'Facturación.txt',
@@ -35,9 +53,14 @@ REQUIRED_FILES = {
     'products': 'CLASIFICACION DE PRODUCTOS AR.xlsx',
     'avance_vendedor': r'Avance x Cliente-Vendedor.*\.xlsx',
     'avance_general': r'Avance General.*\.xlsx',
-    'stock_pendiente': r'Stock vs Pendiente.*\.xlsx'
+    'stock_pendiente': r'Stock vs Pendiente.*\.xlsx',
+    'lanzamientos': r'Compradores Lanzamientos.*\.xlsx'
 }
 
+# National chains are kept out of the strategic tiers (tier 'CN')
+NATIONAL_CHAINS = ['LIBERTAD', 'DIARCO', 'CENCOSUD', 'CARREFOUR', 'WAL-MART',
+                   'CHANGOMAS', 'MAXICONSUMO', 'VITAL', 'MAKRO', 'INC S.A.', 'GDN']
+
 # --- HELPERS ---
 
 def setup_logging(log_path):
@@ -54,15 +77,6 @@ def setup_logging(log_path):
         ]
     )
 
-def normalize_text(text):
-    if pd.isna(text): return ""
-    text = str(text).strip().upper()
-    text = re.sub(r'\s+', ' ', text)
-    # Remove accents/special chars for name matching
-    import unicodedata
-    text = "".join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
-    return text
-
 def normalize_key(text):
     """Normalize vendor/client IDs: strip whitespace, remove trailing .0 from numeric floats."""
     if pd.isna(text): return ""
@@ -82,6 +96,544 @@ def coerce_numeric(val):
     except:
         return 0.0
 
+# --- COLUMN-WISE HELPERS (facturación loaders) ---
+# Whole-column equivalents of the per-cell helpers above. Each one returns
+# exactly what the per-cell function returns for every element.
+
+FACT_INSERT_CHUNK = 50000
+FACT_READ_CHUNK = 100000   # rows per streamed chunk of a Facturación TXT
+_NAT_STRINGS = {'NaT', 'nat', 'NAT', 'nan', 'NaN', 'NAN'}
+
+# Column names of legacy Facturación exports that come without a header row
+LEGACY_HEADERS = [
+    'COD EMPRESA', 'NOM EMPRESA', 'NUM OFICIAL', 'FECHA EMISION', 'DIA', 'HORA', 'FECHA',
+    'COD VENDEDOR', 'NOM VENDEDOR', 'COD CENTRALIZADOR', 'NOM CENTRALIZADOR',
+    'COD CLIENTE', 'NOM CLIENTE', 'COD PRODUCTO VENTA', 'NOM PRODUCTO VENTA',
+    'COD GRUPO COMERCIAL', 'NOM GRUPO COMERCIAL', 'COD SUBGRUPO COMERCIAL',
+    'NOM SUBGRUPO COMERCIAL', 'COD CLASE COMERCIAL', 'NOM CLASE COMERCIAL',
+    'COD FAMILIA COMERCIAL', 'NOM FAMILIA COMERCIAL', 'COD PRODUCTO DOCUMENTO',
+    'NOM PRODUCTO DOCUMENTO', 'UNIDAD MEDIDA', 'CANTIDAD DOCUMENTO', 'CANTIDAD KG',
+    'VALOR', 'VALOR NETO GRAVADO', 'MONEDA', 'COD TIPO NATUREZA', 'NOM TIPO NATUREZA',
+    'ORIGEN DOCUMENTO', 'NOM TEMPLATE', 'PESO PADRON', 'NUM PEDIDO', 'COD.DEPOSITO',
+    'NOMBRE DEPOSITO', 'VENCIMIENTO', 'DESC. CONDICION DE PAGO', 'CONDICION DE PAGO',
+    'CANTIDAD KG BRUTO', 'PRECIO PEDIDO', 'PRECIO TABELA', 'COD. TABELA PRECO',
+    'NOM. TABELA PRECO', 'ORIGEN PEDIDO', 'XCONTENT NRO PUNTO REMITO',
+    'XCONTENT NRO OFICIAL REMITO', 'XCONTENT FECHA DE RENDICIÓN',
+    'COD. TRANSPORTISTA', 'NOM. TRANSPORTISTA', 'UNNAMED: 53'
+]
+
+# Minerva product family / description keywords → internal categoria, in
+# priority order (the first keyword found wins)
+MINERVA_FAMILY_MAP = {
+    'PAPAS':        'PAPAS',
+    'HAMBURGUESA':  'HAMBURGUESAS',
+    'MEDALLON':     'HAMBURGUESAS',
+    'CHORIZO':      'EMBUTIDOS',
+    'SALCHICHA':    'EMBUTIDOS',
+    'EMBUTIDO':     'EMBUTIDOS',
+    'REBOZADO':     'REBOZADOS',
+    'MILANESA':     'REBOZADOS',
+    'BOCADITO':     'REBOZADOS',
+    'VEGGIE':       'VEGGIES',
+    'VEGETAL':      'VEGGIES',
+    'UNTABLE':      'UNTABLES',
+    'PICADILLO':    'UNTABLES',
+    'ATUN':         'PESCADOS',
+    'PESCADO':      'PESCADOS',
+    'GRASA':        'BOVINOS',
+    'HUESO':        'BOVINOS',
+    'LOMO':         'BOVINOS',
+    'CARNE':        'BOVINOS',
+    'CUERO':        'BOVINOS',
+}
+# Every keyword occurrence, overlapping ones included (zero-width lookahead)
+MINERVA_FAMILY_RE = re.compile('(?=(' + '|'.join(map(re.escape, MINERVA_FAMILY_MAP)) + '))')
+_MINERVA_PRIORITY = {kw: i for i, kw in enumerate(MINERVA_FAMILY_MAP)}
+
+# Source groups tracked in etl_file_manifest → tables each group feeds
+SOURCE_GROUPS = {
+    'dimensions':   ['dim_clients', 'dim_product_classification'],
+    'facturacion':  ['fact_facturacion'],
+    'avance':       ['fact_cliente_historico', 'fact_avance_cliente_vendedor_month'],
+    'lanzamientos': ['fact_lanzamiento_cobertura'],
+}
+
+# REQUIRED_FILES keys of each group (facturación: every Factu*.txt, see facturacion_files)
+SOURCE_FILE_KEYS = {
+    'dimensions':   ['clients', 'products'],
+    'avance':       ['avance_vendedor'],
+    'lanzamientos': ['lanzamientos'],
+}
+
+# Alias tables: old/duplicate codes → current code. Applied by the loaders as
+# each row is normalized; when an alias changes, apply_aliases() re-keys the
+# rows already stored (the raw code is kept in <column>_orig, the raw name in
+# <name column>_orig).
+ALIAS_TABLES = {
+    'vendor': "SELECT alias_code, cod_vendedor, nom_vendedor FROM vendor_alias",
+    'client': "SELECT alias_code, cod_cliente, NULL FROM client_alias",
+}
+# Stored columns each kind re-keys: (table, code column, name column); the
+# name column keeps the name the file had in <name column>_orig
+ALIAS_COLUMNS = {
+    'vendor': [('fact_facturacion', 'cod_vendedor', None),
+               ('fact_avance_cliente_vendedor_month', 'cod_vendedor', 'nom_vendedor')],
+    'client': [('fact_facturacion', 'cod_cliente', None),
+               ('fact_avance_cliente_vendedor_month', 'cod_cliente', None)],
+}
+# Seeded into a new vendor_alias table (Perotti, Vacante Santa Fe → Gentile)
+DEFAULT_VENDOR_ALIASES = [
+    ('100075864', '100067806', 'GENTILE NICOLAS', 'Perotti'),
+    ('100075865', '100067806', 'GENTILE NICOLAS', 'Perotti'),
+    ('100089597', '100067806', 'GENTILE NICOLAS', 'VACANTE SANTA FE IND'),
+]
+
+def resolve_aliases(rows):
+    """{alias: (code, name)} from (alias, code, name) rows, codes normalized like
+    the loaders' and chains followed (a → b → c maps a to c, with the last name
+    given on the way). Aliases in a cycle are left out."""
+    direct = {}
+    for alias, code, name in rows:
+        alias, code = normalize_key(alias), normalize_key(code)
+        if alias and code and alias != code:
+            direct[alias] = (code, name)
+    resolved = {}
+    for alias, (code, name) in direct.items():
+        seen = {alias}
+        while code in direct and code not in seen:
+            seen.add(code)
+            code, name = direct[code][0], direct[code][1] or name
+        if code in seen:
+            logging.warning(f"Alias cycle through {alias}: ignored")
+            continue
+        resolved[alias] = (code, name)
+    return resolved
+
+def remap_codes(codes, aliases):
+    """(codes, originals) for a column of normalized codes: aliases resolved by
+    one dict lookup per distinct code; originals holds the raw code of each
+    remapped row, None elsewhere. aliases: {alias: code}."""
+    codes = np.asarray(codes, dtype=object)
+    if not aliases or not len(codes):
+        return codes.tolist(), [None] * len(codes)
+    mapped = pd.Series(codes, dtype=object).map(aliases).to_numpy(dtype=object)
+    hit = pd.notna(mapped)
+    return np.where(hit, mapped, codes).tolist(), np.where(hit, codes, None).tolist()
+
+def source_group(name):
+    """SOURCE_GROUPS group of a file in --data-dir, None if the ETL does not load it."""
+    if re.search(r'[Ff]actu.*\.txt$', name) and not name.startswith('.'):
+        return 'facturacion'
+    for group, keys in SOURCE_FILE_KEYS.items():
+        if any(re.search(REQUIRED_FILES[k], name, re.I) for k in keys):
+            return group
+    return None
+
+
+def file_digest(path, block_size=1 << 20):
+    """sha256 of a file's content, streamed in 1 MB blocks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def sniff_facturacion(path, probe_bytes=4096):
+    """(encoding, layout) of a Facturación TXT from its first KB.
+
+    layout is 'minerva', 'legacy' or 'headerless'. Files are read as latin-1
+    unless they carry a UTF-8/UTF-16 BOM: row_hash is computed on the decoded
+    text, so decoding an already loaded BOM-less UTF-8 file differently would
+    make INSERT OR IGNORE store its rows a second time.
+    """
+    import codecs
+    with open(path, 'rb') as fh:
+        head = fh.read(probe_bytes)
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    elif head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = 'utf-16'
+    else:
+        encoding = 'latin-1'
+        try:
+            head.decode('utf-8')
+            if any(b > 0x7F for b in head):
+                logging.info(f"  {Path(path).name}: UTF-8 text without BOM, read as latin-1 (row_hash compatibility)")
+        except UnicodeDecodeError:
+            pass
+
+    text = head.decode(encoding, errors='ignore')
+    first = text.splitlines()[0] if text else ''
+    cols = [c.strip().strip('"').strip().upper() for c in first.split(';')]
+    if 'COD_VENDEDOR' in cols and 'VAL_TOTAL_ITEM' in cols:
+        return encoding, 'minerva'
+    if any('EMPRESA' in c for c in cols[:5]):
+        return encoding, 'legacy'
+    return encoding, 'headerless'
+
+def sniff_field_count(path, encoding):
+    """Number of ';' fields on the first line of a file."""
+    with open(path, encoding=encoding, errors='ignore') as fh:
+        return len(fh.readline().rstrip('\r\n').split(';'))
+
+def row_hashes(values):
+    """MD5 of "".join(str(cell)) per row of a 2-D array — df.values, i.e. the
+    cells df.iterrows() yields. This is fact_facturacion.row_hash."""
+    if not len(values):
+        return []
+    cols = [values[:, j].astype(str) for j in range(values.shape[1])]
+    md5 = hashlib.md5
+    return [md5("".join(t).encode()).hexdigest() for t in zip(*cols)]
+
+# Natural key of an invoice line (fact_facturacion.line_key): document number,
+# line, product and date. The first column of each list the file has is used;
+# without a document number rows get no line_key and only row_hash dedups them.
+LINE_KEY_COLUMNS = {
+    'doc':  ('NUM OFICIAL', 'NUM_OFICIAL', 'NUM_NF', 'NUM_DOCUMENTO', 'NRO_DOCUMENTO'),
+    'line': ('NUM LINEA', 'NUM_LINEA', 'NUM_ITEM', 'SEQ_ITEM'),
+}
+FNV64_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV64_PRIME = np.uint64(0x100000001B3)
+
+def fnv1a_64(strings):
+    """64-bit FNV-1a of the UTF-8 bytes of each string, as signed int64 (fits a
+    SQLite INTEGER). Plain byte arithmetic, one NumPy pass per byte position:
+    the value depends on the string only, not on the pandas/NumPy version."""
+    data = [s.encode('utf-8') for s in strings]
+    h = np.full(len(data), FNV64_OFFSET, dtype=np.uint64)
+    if not data:
+        return h.view(np.int64)
+    lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
+    width = max(int(lengths.max()), 1)
+    buf = np.frombuffer(b''.join(d.ljust(width, b'\0') for d in data), dtype=np.uint8).reshape(len(data), width)
+    for j in range(width):
+        h = np.where(lengths > j, (h ^ buf[:, j]) * FNV64_PRIME, h)
+    return h.view(np.int64)
+
+def line_keys(df, col, isos, cod_producto, counts):
+    """line_key of each row: fnv1a_64 of document, line, product and date, all
+    normalized (float-typed codes, date formats and column order do not change
+    it). Without a line column the line is the occurrence of (document,
+    product, date) in the file so far; `counts` carries it across the chunks
+    of one file. None where the file or the row has no document number."""
+    doc_col = next((c for c in LINE_KEY_COLUMNS['doc'] if c in df.columns), None)
+    if doc_col is None:
+        return [None] * len(df)
+    docs = normalize_keys(col(doc_col))
+    line_col = next((c for c in LINE_KEY_COLUMNS['line'] if c in df.columns), None)
+    if line_col:
+        lines = normalize_keys(col(line_col))
+    else:
+        base = pd.Series(fnv1a_64([f"{d}\x1f{p}\x1f{f or ''}" for d, p, f in zip(docs, cod_producto, isos)]))
+        occurrence = base.groupby(base, sort=False).cumcount().to_numpy()
+        lines = (occurrence + base.map(counts).fillna(0).to_numpy(dtype=np.int64)).tolist()
+        for k, n in base.value_counts(sort=False).items():
+            counts[k] = counts.get(k, 0) + n
+    keys = fnv1a_64([f"{d}\x1f{n}\x1f{p}\x1f{f or ''}"
+                     for d, n, p, f in zip(docs, lines, cod_producto, isos)]).tolist()
+    return [k if d.strip('0') else None for k, d in zip(keys, docs)]
+
+def normalize_keys(values):
+    """normalize_key() over a column."""
+    vals = np.asarray(values, dtype=object)
+    na = pd.isna(vals)
+    # IDs repeat a lot: normalize each distinct str() once
+    codes, uniques = pd.factorize(vals.astype(str))
+    s = pd.Series(uniques, dtype=object).str.strip()
+    s = s.where(~s.str.endswith('.0'), s.str[:-2])
+    digit = s.str.isdigit().astype(bool)
+    s = s.where(~digit, s.str.zfill(5)).where(digit, s.str.upper())
+    out = s.to_numpy(dtype=object)[codes]
+    out[na] = ""
+    return out.tolist()
+
+def coerce_numerics(values):
+    """coerce_numeric() over a column: numpy parses the strings in bulk and
+    anything it rejects goes through coerce_numeric() itself."""
+    vals = np.asarray(values, dtype=object)
+    out = np.zeros(len(vals))
+    is_str = np.fromiter((isinstance(v, str) for v in vals), dtype=bool, count=len(vals))
+    is_num = np.fromiter((isinstance(v, (int, float, np.number)) for v in vals), dtype=bool, count=len(vals))
+    if is_str.any():
+        cleaned = np.char.replace(np.char.replace(vals[is_str].astype(str), '.', ''), ',', '.')
+        try:
+            out[is_str] = cleaned.astype(np.float64)
+        except ValueError:
+            out[is_str] = [coerce_numeric(v) for v in vals[is_str]]
+    if is_num.any():
+        out[is_num] = vals[is_num].astype(np.float64)
+    other = ~(is_str | is_num)
+    if other.any():
+        out[other] = [coerce_numeric(v) for v in vals[other]]
+    return out
+
+def first_non_null(values):
+    """First value pd.to_datetime would infer a format from, or None."""
+    for v in values:
+        if isinstance(v, str):
+            if not v or v in _NAT_STRINGS: continue
+            return v
+        if not pd.isna(v):
+            return v
+    return None
+
+def guess_date_format(values):
+    """strftime format of the first non-null string, the way pd.to_datetime
+    infers it (dayfirst). None when it cannot be guessed."""
+    from pandas.tseries.api import guess_datetime_format
+    v = first_non_null(values)
+    return guess_datetime_format(v, dayfirst=True) if isinstance(v, str) else None
+
+def parse_dates(values, per_cell=False, fmt='infer'):
+    """pd.to_datetime(values, dayfirst=True, errors='coerce') with explicit formats.
+
+    Column mode pins the format pandas would infer from the first value (or
+    `fmt`, when the caller inferred it from an earlier chunk; None = no format).
+    per_cell=True reproduces one pd.to_datetime call per cell (legacy loader):
+    every distinct value gets its own guessed format, and the values sharing a
+    format are parsed together with it.
+    """
+    from pandas.tseries.api import guess_datetime_format
+    vals = np.asarray(values, dtype=object)
+    if not per_cell:
+        if fmt == 'infer':
+            fmt = guess_date_format(vals)
+        if fmt is None:
+            return pd.to_datetime(pd.Series(vals), dayfirst=True, errors='coerce')
+        return pd.to_datetime(pd.Series(vals), format=fmt, errors='coerce')
+
+    codes, uniques = pd.factorize(pd.Series(vals, dtype=object))
+    uniques = np.asarray(uniques, dtype=object)
+    fmts = np.array([guess_datetime_format(u, dayfirst=True) if isinstance(u, str) else None
+                     for u in uniques], dtype=object)
+    parsed = pd.Series([pd.NaT] * len(uniques), dtype='datetime64[ns]')
+    for fmt in {f for f in fmts if f is not None}:
+        sel = fmts == fmt
+        parsed[sel] = pd.to_datetime(pd.Series(uniques[sel]), format=fmt, errors='coerce').to_numpy()
+    rest = np.array([f is None for f in fmts], dtype=bool)
+    if rest.any():
+        parsed[rest] = [pd.to_datetime(u, dayfirst=True, errors='coerce') for u in uniques[rest]]
+
+    out = parsed.to_numpy()[codes]
+    out[codes < 0] = np.datetime64('NaT')
+    return pd.Series(out, dtype='datetime64[ns]')
+
+def format_days(dt):
+    """(['YYYY-MM-DD', ...], ['YYYY-MM', ...]) for a datetime Series, formatting
+    each distinct day once. NaT → None."""
+    codes, uniques = pd.factorize(dt)
+    isos = np.asarray(pd.DatetimeIndex(uniques).strftime('%Y-%m-%d'), dtype=object)
+    out = np.empty(len(dt), dtype=object)
+    out[codes >= 0] = isos[codes[codes >= 0]]
+    isos = out.tolist()
+    return isos, [d[:7] if d is not None else None for d in isos]
+
+def normalize_estados(values):
+    """Lanzamiento ESTADO labels → 'COMPRADOR', 'SIN COMPRA', 'NO COMPRADOR', or
+    the label itself (str(), stripped; 'DESCONOCIDO' when empty)."""
+    estado = np.char.strip(np.asarray(values, dtype=object).astype(str))
+    upper = np.char.upper(estado)
+    has = lambda word: np.char.find(upper, word) >= 0
+    out = np.where(estado == '', 'DESCONOCIDO', estado).astype(object)
+    out[has('NO COMPRADOR')] = 'NO COMPRADOR'
+    out[has('SIN COMPRA')] = 'SIN COMPRA'
+    out[has('COMPRADOR') & ~has('SIN') & ~has('NO')] = 'COMPRADOR'
+    return out
+
+# --- FACTURACIÓN PARSING (process-pool workers, no DB access) ---
+
+def raw_column(df, raw):
+    """col(name, default) → column of `raw` (df.values), or the default for
+    every row when the column is missing (like row.get(name, default))."""
+    positions = {c: j for j, c in enumerate(df.columns)}
+    def col(name, default=None):
+        if name in positions:
+            return raw[:, positions[name]]
+        out = np.empty(len(raw), dtype=object)
+        out[:] = [default] * len(raw)
+        return out
+    return col
+
+
+def scan_facturacion(f_fact, read_kw, is_minerva):
+    """First streaming pass: (dtypes, months, date_fmt).
+
+    dtypes unifies the per-chunk guesses the way one read of the whole file
+    would type each column (int < float < text). For Minerva files it also
+    collects the months present and pins the date format on the file's
+    first date, as a whole-file pd.to_datetime would."""
+    kinds = {}
+    months = []
+    date_fmt = 'infer'
+    for df in pd.read_csv(f_fact, chunksize=FACT_READ_CHUNK, low_memory=False, **read_kw):
+        for c in df.columns:
+            kinds.setdefault(c, set()).add(df[c].dtype.kind)
+        if not is_minerva:
+            continue
+        df.columns = [str(c).strip().upper() for c in df.columns]
+        date_col = 'DTA_ENTRADA' if 'DTA_ENTRADA' in df.columns else 'DATA_EMISSAO'
+        vals = df[date_col].to_numpy(dtype=object)
+        if date_fmt == 'infer' and first_non_null(vals) is not None:
+            date_fmt = guess_date_format(vals)
+        if date_fmt != 'infer':
+            dt = parse_dates(vals, fmt=date_fmt)
+            for ym in dt.dropna().dt.strftime('%Y-%m').unique():
+                if ym not in months:
+                    months.append(ym)
+
+    dtypes = {}
+    for c, k in kinds.items():
+        if k <= {'i'}:
+            dtypes[c] = 'int64'
+        elif k <= {'i', 'f'}:
+            dtypes[c] = 'float64'
+        elif k == {'b'}:
+            dtypes[c] = 'bool'
+        else:
+            dtypes[c] = 'str'
+    return dtypes, months, date_fmt
+
+
+def normalize_legacy_chunk(df, line_counts=None, aliases=None):
+    """fact_facturacion rows of one legacy chunk (COD EMPRESA, FECHA EMISION,
+    CANTIDAD KG, VALOR). Column-wise: hashes, dates, keys and amounts are
+    computed per column. line_counts: see line_keys(); aliases: {'vendor':
+    {alias: code}, 'client': {...}}."""
+    raw = df.values  # the cells iterrows() used to yield, row by row
+    col = raw_column(df, raw)
+
+    hashes = row_hashes(raw)
+    dt = parse_dates(col('FECHA EMISION'), per_cell=True)
+    keep = dt.notna().to_numpy()
+    isos, yms = format_days(dt)
+    aliases = aliases or {}
+    cod_cliente, cliente_orig = remap_codes(normalize_keys(col('COD CENTRALIZADOR')), aliases.get('client'))
+    cod_vendedor, vendedor_orig = remap_codes(normalize_keys(col('COD VENDEDOR')), aliases.get('vendor'))
+    cod_producto = normalize_keys(col('COD PRODUCTO VENTA'))
+    cantidad = coerce_numerics(col('CANTIDAD KG')).tolist()
+    importe = coerce_numerics(col('VALOR')).tolist()
+    deposito = [v.strip() for v in col('NOMBRE DEPOSITO', '').astype(str)]
+    keys = line_keys(df, col, isos, cod_producto, {} if line_counts is None else line_counts)
+
+    return [
+        (hashes[i], isos[i], cod_cliente[i], cod_vendedor[i], cod_producto[i],
+         cantidad[i], importe[i], deposito[i], yms[i], keys[i], vendedor_orig[i], cliente_orig[i])
+        for i in np.flatnonzero(keep)
+    ]
+
+
+def normalize_minerva_chunk(df, date_fmt='infer', line_counts=None, aliases=None):
+    """fact_facturacion rows of one Minerva chunk (COD_VENDEDOR, DTA_ENTRADA,
+    QTD_KG_FATURADA, VAL_TOTAL_ITEM). Adds the parsed _dt column to df."""
+    date_col = 'DTA_ENTRADA' if 'DTA_ENTRADA' in df.columns else 'DATA_EMISSAO'
+    df['_dt'] = parse_dates(df[date_col].to_numpy(dtype=object), fmt=date_fmt).to_numpy()
+
+    raw = df.values  # the cells iterrows() used to yield (including _dt)
+    col = raw_column(df, raw)
+
+    hashes = row_hashes(raw)
+    dt = df['_dt']
+    cantidad = coerce_numerics(col('QTD_KG_FATURADA', 0))
+    importe = coerce_numerics(col('VAL_TOTAL_ITEM', 0))
+    keep = dt.notna().to_numpy() & (importe != 0)  # skip lines with no value
+    isos, yms = format_days(dt)
+    aliases = aliases or {}
+    cod_cliente, cliente_orig = remap_codes(normalize_keys(col('COD_CENTRALIZADOR')), aliases.get('client'))
+    cod_vendedor, vendedor_orig = remap_codes(normalize_keys(col('COD_VENDEDOR', '').astype(str)),
+                                              aliases.get('vendor'))
+    cod_item = normalize_keys(col('COD_ITEM', '').astype(str))
+    deposito = [v.strip() for v in col('DEPOSITO', '').astype(str)]
+    cantidad, importe = cantidad.tolist(), importe.tolist()
+    keys = line_keys(df, col, isos, cod_item, {} if line_counts is None else line_counts)
+
+    return [
+        (hashes[i], isos[i], cod_cliente[i], cod_vendedor[i], cod_item[i],
+         cantidad[i], importe[i], deposito[i], yms[i], keys[i], vendedor_orig[i], cliente_orig[i])
+        for i in np.flatnonzero(keep)
+    ]
+
+
+def minerva_product_candidates(df, seen):
+    """First (cod, descripcion, familia) of each COD_ITEM of a Minerva chunk not
+    in `seen` (the codes of earlier chunks of the same file)."""
+    if 'COD_ITEM' not in df.columns or 'DES_ITEM' not in df.columns:
+        return []
+    col = raw_column(df, df.values)
+    cods = normalize_keys(col('COD_ITEM').astype(str))
+    first = {}
+    for i, cod in enumerate(cods):
+        if cod and cod not in seen:
+            first.setdefault(cod, i)
+    seen.update(first)
+    desc, familia = col('DES_ITEM'), col('FAMILIA_COMERCIAL', '')
+    return [(cod, str(desc[i]).strip().upper(), str(familia[i]).strip().upper())
+            for cod, i in first.items()]
+
+
+def classify_minerva_products(products):
+    """categoria of each (cod, descripcion, familia): the highest-priority
+    MINERVA_FAMILY_MAP keyword found in the description or the family, else None."""
+    if not products:
+        return []
+    # '\n' keeps a keyword from spanning description and family
+    text = pd.Series([f"{desc}\n{familia}" for _, desc, familia in products], dtype=object)
+    found = text.str.findall(MINERVA_FAMILY_RE)
+    return [MINERVA_FAMILY_MAP[min(kws, key=_MINERVA_PRIORITY.get)] if kws else None for kws in found]
+
+
+def parse_facturacion(f_fact, spool_dir, aliases=None):
+    """Parse and normalize one Facturación TXT without touching the database.
+
+    Runs in the process pool of SalesETL.process_facturacion. The file is
+    streamed in FACT_READ_CHUNK-row chunks; each normalized chunk (rows, new
+    product candidates) is pickled to spool_dir, so memory does not depend on
+    the file size. Returns the summary the writer applies in file order.
+    """
+    f_fact = Path(f_fact)
+    t0 = time.perf_counter()
+
+    # --- Detect encoding and format from the first KB ---
+    encoding, layout = sniff_facturacion(f_fact)
+    read_kw = {'sep': ';', 'encoding': encoding}
+    if layout == 'headerless':
+        # Legacy format with missing headers
+        logging.warning(f"  ⚠️  {f_fact.name} missing headers, adding standard headers")
+        read_kw.update(header=None, names=LEGACY_HEADERS[:sniff_field_count(f_fact, encoding)])
+    is_minerva = layout == 'minerva'
+
+    # Pass 1: whole-file column types (a chunk alone may guess int where the
+    # file has text further down, which would change row_hash), plus the
+    # months a Minerva file replaces (a legacy file's are collected in pass 2)
+    dtypes, months, date_fmt = scan_facturacion(f_fact, read_kw, is_minerva)
+
+    # Pass 2: normalize chunk by chunk
+    batches = []
+    rows_read = 0
+    seen_products = set()
+    line_counts = {}
+    for n, df in enumerate(pd.read_csv(f_fact, dtype=dtypes, chunksize=FACT_READ_CHUNK, **read_kw)):
+        df.columns = [str(c).strip().upper() for c in df.columns]
+        if is_minerva:
+            rows = normalize_minerva_chunk(df, date_fmt, line_counts, aliases)
+            products = minerva_product_candidates(df, seen_products)
+        else:
+            rows, products = normalize_legacy_chunk(df, line_counts, aliases), []
+            for ym in dict.fromkeys(r[8] for r in rows):
+                if ym not in months:
+                    months.append(ym)
+        batch_path = os.path.join(spool_dir, f"{f_fact.name}.{n:05d}.pkl")
+        with open(batch_path, 'wb') as fh:
+            pickle.dump((rows, products), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        batches.append(batch_path)
+        rows_read += len(df)
+
+    return {
+        'name': f_fact.name, 'layout': layout, 'months': months, 'batches': batches,
+        'rows_read': rows_read, 'seconds': time.perf_counter() - t0,
+    }
+
+
 def parse_date_from_filename(filename, year_override=None):
     """Detects DD, MM from filename pattern 'Something 06-02.xlsx'.
     Falls back to current month if no date pattern found."""
@@ -101,55 +653,507 @@ def clean_header(s):
     s = str(s).upper().replace('_', ' ').replace('\n', ' ').strip()
     return re.sub(r'\s+', ' ', s)
 
-def robust_read_excel(path, required_cols):
-    """Searches first 20 rows for headers. Normalizes underscores/spaces for matching."""
+def robust_read_excel(path, required_cols, scan_rows=20, workbooks=None):
+    """Searches first `scan_rows` rows for headers. Normalizes underscores/spaces for matching.
+
+    The sheet is parsed once (header=None, raw cells; through `workbooks` when
+    given); the header row is found in memory and the rows below it go through
+    pandas' TextParser, so the result is the same frame
+    pd.read_excel(path, header=i) returns.
+    """
+    from pandas.io.parsers import TextParser
     norm_required = [clean_header(c) for c in required_cols]
     logging.info(f"Searching for columns: {norm_required} in {path}")
-    
-    for i in range(20):
-        try:
-            df = pd.read_excel(path, header=i)
-            # Normalize found columns for comparison
-            found_cols = {clean_header(c): c for c in df.columns if not pd.isna(c)}
-            
-            if all(req in found_cols for req in norm_required):
-                logging.info(f"Found headers at row {i}")
-                return df
-                
-            if i == 0:
-                logging.info(f"Row 0 headers: {list(found_cols.keys())[:10]}...")
-        except Exception as e:
-            continue
-    
+
+    if workbooks is not None:
+        raw = workbooks.parse(path, header=None, dtype=object)
+    else:
+        raw = pd.read_excel(path, header=None, dtype=object)
+    # Empty cells back to '' as the Excel reader hands them to TextParser
+    cells = [['' if pd.isna(v) else v for v in row] for row in raw.itertuples(index=False)]
+
+    for i, row in enumerate(cells[:scan_rows]):
+        found_cols = {clean_header(c): c for c in row if c != ''}
+        if all(req in found_cols for req in norm_required):
+            logging.info(f"Found headers at row {i}")
+            return TextParser(cells[i:], header=0, skip_blank_lines=False).read()
+        if i == 0:
+            logging.info(f"Row 0 headers: {list(found_cols.keys())[:10]}...")
+
     # Final failure log
-    all_found = []
-    try:
-        df_top = pd.read_excel(path, nrows=1)
-        all_found = [clean_header(c) for c in df_top.columns]
-    except: pass
-    
+    all_found = [clean_header(c) for c in cells[0] if c != ''] if cells else []
     raise ValueError(f"Could not find {norm_required} in {path}. Found: {all_found[:15]}...")
 
+# --- DIMENSION HELPERS (clients / products masters) ---
+
+def fold_accents(s):
+    """Upper-case s without accents ('DIRECCIÓN' → 'DIRECCION')."""
+    import unicodedata
+    return ''.join(ch for ch in unicodedata.normalize('NFKD', s) if not unicodedata.combining(ch)).upper()
+
+def text_values(values):
+    """Dimension cells as stored: NaN / empty / 0 → None, else str(v).strip()."""
+    vals = np.asarray(values, dtype=object)
+    na = pd.isna(vals)
+    return [None if n or not v else str(v).strip() for v, n in zip(vals, na)]
+
+def canal_from_lista(listas):
+    """canal per LISTA PRECIO value (None when there is no list or no rule matches)."""
+    lu = pd.Series(listas, dtype=object).fillna('').str.upper()
+    canal = np.select(
+        [lu.str.contains('SUBDIST', regex=False),
+         lu.str.contains('DIST', regex=False),
+         lu.str.contains('MAYORIST', regex=False),
+         lu.str.contains('SUPER|MERCADO|LIBERTAD')],
+        ['subdistribuidor', 'distribuidor', 'mayorista', 'supermercado'],
+        default=None,
+    )
+    return canal.tolist()
+
+def content_hash(values):
+    """MD5 of a dimension row's stored values, used to skip unchanged upserts."""
+    text = '\x1f'.join('\x00' if v is None else str(v) for v in values)
+    return hashlib.md5(text.encode()).hexdigest()
+
+class WorkbookCache:
+    """Excel workbooks opened once per ETL run and shared by all stages.
+
+    Each workbook is opened a single time (pd.ExcelFile) and each
+    (sheet, header) is parsed at most once; parse() hands out a copy, so a
+    stage can rename or add columns without affecting the next one.
+    engine=None is pandas' default (openpyxl); 'calamine' uses the
+    python-calamine reader when it is installed. Sheets parsed ahead by worker
+    processes (parse_workbook) are handed in with store().
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self._books = {}
+        self._frames = {}
+        self._sheet_names = {}
+
+    def book(self, path):
+        key = str(path)
+        if key not in self._books:
+            self._books[key] = pd.ExcelFile(path, engine=self.engine)
+        return self._books[key]
+
+    def sheet_names(self, path):
+        if str(path) not in self._sheet_names:
+            self._sheet_names[str(path)] = self.book(path).sheet_names
+        return self._sheet_names[str(path)]
+
+    def parse(self, path, sheet_name=0, header=0, **kw):
+        key = (str(path), sheet_name, header, tuple(sorted(kw.items())))
+        if key not in self._frames:
+            self._frames[key] = self.book(path).parse(sheet_name=sheet_name, header=header, **kw)
+        return self._frames[key].copy()
+
+    def store(self, path, sheet_names, frames, header=0, **kw):
+        """Add sheets parsed elsewhere: frames is {sheet_name: DataFrame}."""
+        self._sheet_names[str(path)] = sheet_names
+        for sheet_name, df in frames.items():
+            self._frames[(str(path), sheet_name, header, tuple(sorted(kw.items())))] = df
+
+    def close(self):
+        for book in self._books.values():
+            book.close()
+        self._books.clear()
+        self._frames.clear()
+        self._sheet_names.clear()
+
+def parse_workbook(path, engine=None, sheets=0, header=0, skip=(), **kw):
+    """Parse sheets of one workbook in a worker process (WorkbookCache.store()
+    takes the result). sheets: a sheet name/index, a list of names (those
+    missing from the book are left out) or None for all but `skip`.
+    Returns (sheet_names, {sheet: DataFrame})."""
+    with pd.ExcelFile(path, engine=engine) as book:
+        names = book.sheet_names
+        if sheets is None:
+            skip = {s.upper() for s in skip}
+            wanted = [s for s in names if s.upper() not in skip]
+        elif isinstance(sheets, (list, tuple)):
+            wanted = [s for s in sheets if s in names]
+        else:
+            wanted = [sheets]
+        return names, {s: book.parse(sheet_name=s, header=header, **kw) for s in wanted}
+
+# --- STAGE GRAPH ---
+
+CATEGORY_SHEETS = ['HB', 'SCH', 'UNT', 'RB', 'SJ', 'GRASA', 'PICADA', 'CHORIZOS', 'PAPAS', 'ATUN', 'CORTES CARNE']
+LANZAMIENTO_SKIP_SHEETS = ('DINAMICA ENERO 26', 'DINAMICA') # summary/dynamic sheets
+
+# ETL stages in pipeline order. A stage runs after every earlier stage that writes
+# what it reads or writes, or reads what it writes (stage_dependencies):
+#   sources   — SOURCE_GROUPS whose changes make it run (None: every run;
+#               'aliases': vendor_alias/client_alias changed, see alias_changes)
+#   reads     — tables and run state ('target_month', 'changed_cells') it reads
+#   writes    — tables and run state it writes
+#   workbooks — parse_workbook() arguments of the sheets it reads, parsed ahead
+#               by worker processes ('file' is a REQUIRED_FILES key)
+#   when      — SalesETL attribute that enables the stage
+STAGES = {
+    'process_dimensions': dict(
+        sources=('dimensions',),
+        reads=(),
+        writes=('dim_clients', 'dim_product_classification', 'etl_unclassified_products'),
+        workbooks=(dict(file='clients', header=None, dtype=object), dict(file='products', header=6))),
+    'apply_aliases': dict(
+        sources=('aliases',),
+        reads=(),
+        writes=('fact_facturacion', 'fact_avance_cliente_vendedor_month', 'changed_cells')),
+    'process_facturacion': dict(
+        sources=('facturacion',),
+        reads=('dim_product_classification',),
+        writes=('fact_facturacion', 'dim_product_classification', 'etl_unclassified_products',
+                'etl_facturacion_duplicates', 'changed_cells')),
+    'refresh_daily_cube': dict(
+        sources=('facturacion', 'aliases'),
+        reads=('fact_facturacion', 'changed_cells'),
+        writes=('fact_facturacion_diaria',)),
+    'process_avance_vendedor': dict(
+        sources=('avance',),
+        reads=('dim_clients', 'fact_facturacion', 'changed_cells'), # facturación: _sales_removed()
+        writes=('fact_cliente_historico', 'fact_avance_cliente_vendedor_month', 'etl_unmatched_clients',
+                'target_month'),
+        workbooks=(dict(file='avance_vendedor', header=1),)),
+    'sync_facturacion_to_avance': dict(
+        sources=('avance', 'facturacion'),
+        reads=('fact_facturacion', 'target_month'),
+        writes=('fact_avance_cliente_vendedor_month',)),
+    'update_premium_flag': dict(
+        sources=('dimensions', 'facturacion'),
+        reads=('dim_product_classification',),
+        writes=('fact_facturacion',)),
+    'seed_objetivos': dict(
+        sources=('avance',),
+        reads=('target_month',),
+        writes=('vendedor_objetivos',)),
+    'process_category_sheets': dict(
+        sources=('avance',),
+        reads=('target_month', 'vendedor_objetivos', 'crm_cliente_ponderacion'),
+        writes=('fact_avance_cliente_vendedor_month',),
+        workbooks=(dict(file='avance_vendedor', sheets=CATEGORY_SHEETS, header=2),)),
+    'process_lanzamientos': dict(
+        sources=('lanzamientos', 'avance', 'facturacion', 'dimensions'),
+        reads=('target_month', 'fact_facturacion', 'dim_product_classification'),
+        writes=('fact_lanzamiento_cobertura',),
+        workbooks=(dict(file='lanzamientos', sheets=None, skip=LANZAMIENTO_SKIP_SHEETS, header=1),)),
+    'calculate_segmentation': dict(
+        sources=tuple(SOURCE_GROUPS),
+        reads=('target_month', 'fact_avance_cliente_vendedor_month', 'fact_cliente_historico', 'fact_facturacion',
+               'dim_product_classification', 'fact_lanzamiento_cobertura'),
+        writes=('fact_client_segmentation',)),
+    'compute_forecasts': dict(
+        sources=tuple(SOURCE_GROUPS),
+        reads=('target_month', 'fact_avance_cliente_vendedor_month', 'fact_cliente_historico', 'fact_facturacion',
+               'dim_product_classification', 'fact_lanzamiento_cobertura', 'fact_client_segmentation',
+               'vendedor_objetivos'),
+        writes=('fact_forecast', 'fact_forecast_rollup')),
+    'update_facturacion_archive': dict(
+        sources=None,
+        reads=('fact_facturacion', 'dim_clients', 'dim_product_classification', 'changed_cells'),
+        writes=(),
+        when='archive_dir'),
+}
+
+def stage_dependencies(stages=STAGES):
+    """{stage: set of earlier stages it must wait for} (read-after-write,
+    write-after-write and write-after-read on the declared resources)."""
+    deps = {}
+    names = list(stages)
+    for i, name in enumerate(names):
+        reads, writes = set(stages[name]['reads']), set(stages[name]['writes'])
+        deps[name] = {
+            prev for prev in names[:i]
+            if set(stages[prev]['writes']) & (reads | writes) or set(stages[prev]['reads']) & writes
+        }
+    return deps
+
+STAGE_DEPENDENCIES = stage_dependencies()
+
+# --incremental: cell-scoped variant (method, kwargs) of a stage, used while the
+# avance is not reloaded (only the changed facturación cells moved)
+INCREMENTAL_VARIANTS = {
+    'sync_facturacion_to_avance': ('sync_facturacion_to_avance', dict(only_changed=True)),
+    'compute_forecasts': ('refresh_forecasts', {}),
+}
+
+def downstream_stages(name, deps=STAGE_DEPENDENCIES):
+    """`name` and every stage that depends on it, directly or not."""
+    found = {name}
+    for stage in deps:  # pipeline order: dependencies come first
+        if deps[stage] & found:
+            found.add(stage)
+    return found
+
+# --- STAGE METRICS (etl_stage_metrics) ---
+
+def process_cpu_seconds():
+    """User + system CPU of this process and of its finished worker processes."""
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def reset_peak_rss():
+    """Restart the peak-RSS counter (Linux: VmHWM via /proc/self/clear_refs) so
+    peak_rss_mb() reports the peak of the next stage only. No-op elsewhere."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """Peak resident memory in MB since reset_peak_rss() (Linux), else since start."""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def stage_report(conn, runs=10, threshold=0.25, min_seconds=1.0):
+    """Wall time per stage over the last `runs` successful runs.
+
+    A stage regressed when its wall time in the latest run it was not skipped
+    exceeds the median of its earlier runs by more than `threshold` (and by at
+    least `min_seconds`).
+    Returns (run_ids oldest first, [{stage, wall_s: [...], rows_read, rows_written,
+    peak_rss_mb, baseline_s, regression}]).
+    """
+    run_ids = [r[0] for r in conn.execute("""
+        SELECT DISTINCT m.run_id FROM etl_stage_metrics m
+        JOIN etl_run r ON r.run_id = m.run_id
+        WHERE r.status = 'SUCCESS'
+        ORDER BY m.run_id DESC LIMIT ?
+    """, (runs,))][::-1]
+    if not run_ids:
+        return [], []
+    ph = ','.join('?' * len(run_ids))
+    by_stage = {}
+    for stage, run_id, seq, status, wall, rows_read, rows_written, rss in conn.execute(f"""
+        SELECT stage, run_id, seq, status, wall_s, rows_read, rows_written, peak_rss_mb
+        FROM etl_stage_metrics WHERE run_id IN ({ph}) ORDER BY run_id, seq
+    """, run_ids):
+        entry = by_stage.setdefault(stage, {'stage': stage, 'seq': seq, 'runs': {}})
+        if status == 'OK':
+            entry['runs'][run_id] = (wall, rows_read, rows_written, rss)
+
+    report = []
+    for entry in sorted(by_stage.values(), key=lambda e: e['seq']):
+        # Latest run the stage actually ran in vs. the earlier ones (skipped runs don't count)
+        runs_ok = entry['runs']
+        ran = [r for r in run_ids if r in runs_ok]
+        earlier = sorted(runs_ok[r][0] for r in ran[:-1])
+        baseline = float(np.median(earlier)) if earlier else None
+        last = runs_ok[ran[-1]] if ran else None
+        regression = bool(last and baseline is not None
+                          and last[0] > baseline * (1 + threshold)
+                          and last[0] - baseline >= min_seconds)
+        report.append({
+            'stage': entry['stage'],
+            'wall_s': [runs_ok[r][0] if r in runs_ok else None for r in run_ids],
+            'rows_read': last[1] if last else None,
+            'rows_written': last[2] if last else None,
+            'peak_rss_mb': last[3] if last else None,
+            'baseline_s': baseline,
+            'regression': regression,
+        })
+    return run_ids, report
+
+class StageConnection(sqlite3.Connection):
+    """sqlite3 connection of shadow builds: while `deferred` is set (bulk-load mode), commit()
+    is a no-op, so the commits scattered through a stage collapse into the single
+    transaction SalesETL.stage_transaction() commits (or rolls back) at the end."""
+    deferred = False
+
+    def commit(self):
+        if not self.deferred:
+            super().commit()
+
 # --- ETL CORE ---
 
 class SalesETL:
-    def __init__(self, data_dir, db_path, year_override=None):
+    def __init__(self, data_dir, db_path, year_override=None, workers=None, full=False, excel_engine=None,
+                 fuzzy_threshold=None, bulk=False, shadow=False, keep_generations=None, archive_dir=None,
+                 resume=False):
         self.data_dir = Path(data_dir)
         self.db_path = Path(db_path)
+        self.archive_dir = Path(archive_dir) if archive_dir else None # Parquet copy of fact_facturacion
         self.year = year_override or datetime.now().year
+        self.workers = workers or os.cpu_count() or 1
         self.os_created_dirs()
-        self.conn = sqlite3.connect(self.db_path)
+        # Shadow build: the run writes a copy of the live DB that publish_shadow()
+        # validates and swaps in (db_generations), so the app never sees a half load.
+        # Bulk-load mode (always on a shadow) adds relaxed durability, one
+        # transaction per stage and deferred indexes.
+        self.bulk = bulk
+        self.shadow = shadow or bulk
+        self.keep_generations = KEEP_GENERATIONS if keep_generations is None else keep_generations
+        self.shadow_path = self.db_path.with_name(self.db_path.name + '.shadow') if self.shadow else None
+        self.work_path = self.shadow_path if self.shadow else self.db_path # file this run writes to
+        self.resume = resume # continue the last failed run (etl_run_checkpoint)
+        if self.shadow:
+            self.conn = self.open_shadow(reuse=resume)
+        else:
+            self.conn = sqlite3.connect(self.db_path)
         self.conn.row_factory = sqlite3.Row
 
         self.run_id = None
         self.target_month = None # YYYY-MM
         self.processed_files = []
+        self.changed_cells = set() # (year_month, cod_vendedor, cod_cliente) touched by this run
+        self.full = full           # ignore etl_file_manifest and reprocess every source file
+        self.manifest = {}         # path → etl_file_manifest row of the last successful run
+        self.manifest_pending = {} # path → row to store once this run succeeds
+        self._digests = {}         # path → content hash computed during this run
+        self._loaded_months = set()
+        self.workbooks = WorkbookCache(excel_engine) # parsed Excel sheets shared by the stages of a run
+        self.fuzzy_threshold = fuzzy_threshold       # trigram similarity for near-miss client names (None: off)
+        self.client_matcher = None
+        self._product_codes = None # dim_product_classification codes, loaded on first Minerva classification
+        self.aliases = {}          # kind → {alias: (code, name)} of the alias tables, see load_aliases()
+        self.rows_read = 0         # source rows parsed so far (etl_stage_metrics)
+        self._stage_seq = 0
+        self.forced = set()        # stages run whatever their inputs (--only / --from)
+        self.incremental = False   # run_incremental: INCREMENTAL_VARIANTS replace their stages
+        self.checkpoint = self.load_checkpoint() if resume else None
 
     def os_created_dirs(self):
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
 
+    def open_shadow(self, reuse=False):
+        """Seed shadow_path from the live DB (online backup API, consistent while the
+        app keeps using it). In bulk-load mode the copy runs with synchronous=OFF and
+        an in-memory rollback journal: a crash only loses the shadow file.
+        reuse=True opens the shadow a failed run left behind (--resume)."""
+        if reuse:
+            if not self.shadow_path.exists():
+                raise ValueError(f"nothing to resume: no shadow copy of a failed run ({self.shadow_path})")
+            conn = sqlite3.connect(self.shadow_path, factory=StageConnection)
+        else:
+            conn = seed_shadow(self.db_path, self.shadow_path, factory=StageConnection)
+        if self.bulk:
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("PRAGMA journal_mode=MEMORY")
+        logging.info(f"Building on shadow copy {self.shadow_path}" + (" (bulk-load mode)" if self.bulk else ""))
+        return conn
+
+    def publish(self):
+        """Shadow build: validate the shadow and atomically swap it in as a new
+        generation. App-owned tables (CRM, vendor targets...) are re-copied from the
+        live DB first and the monetary objectives re-allocated from them, so edits
+        made in the app during the run survive. Bulk-load mode also refreshes the
+        planner statistics (ANALYZE). self.conn is then reopened on the published
+        DB, where the run's end is recorded."""
+        if not self.shadow:
+            bump_generation(self.db_path)  # loaded in place: still tell the app
+            return
+        t0 = time.perf_counter()
+        if self.bulk:
+            self.conn.execute("ANALYZE")
+
+        def reallocate(conn):
+            if self.target_month:
+                allocate_monetary_objectives(conn, self.target_month)
+
+        publish_shadow(self.conn, self.shadow_path, self.db_path,
+                       keep=self.keep_generations, before_swap=reallocate)
+        self.conn = sqlite3.connect(self.db_path, factory=StageConnection)
+        self.conn.row_factory = sqlite3.Row
+        logging.info(f"Shadow DB published in {time.perf_counter() - t0:.1f}s")
+
+    def connection_open(self):
+        """False once publish_shadow closed the shadow connection (a failed publish)."""
+        try:
+            self.conn.total_changes
+        except sqlite3.ProgrammingError:
+            return False
+        return True
+
+    def abandon_shadow(self, message=""):
+        """Leave the shadow of a failed run unpublished. The live DB keeps its data;
+        only the failure is logged in its etl_run. The shadow file stays for
+        --resume (the next regular run seeds a fresh one over it)."""
+        if not self.shadow or not self.shadow_path.exists():
+            return
+        if not self.connection_open():
+            # publish_shadow got past closing it: the run is still RUNNING in the shadow
+            shadow = sqlite3.connect(self.shadow_path)
+            try:
+                shadow.execute("UPDATE etl_run SET status = 'FAILED', message = ? WHERE run_id = ?",
+                               (message, self.run_id))
+                shadow.commit()
+            finally:
+                shadow.close()
+        self.conn.close()
+        logging.error(f"Run failed, shadow copy not published ({self.db_path} unchanged; "
+                      f"{self.shadow_path} kept for --resume)")
+        live = sqlite3.connect(self.db_path)
+        try:
+            live.execute("INSERT INTO etl_run (status, message) VALUES ('FAILED', ?)", (f"[shadow] {message}",))
+            live.commit()
+        except sqlite3.OperationalError:
+            pass  # first load: no etl_run yet
+        finally:
+            live.close()
+
+    @contextmanager
+    def stage_transaction(self):
+        """Bulk-load mode: run the block as one transaction (commits inside are deferred)."""
+        if not self.bulk:
+            yield
+            return
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")  # DDL of the stage included
+        self.conn.deferred = True
+        try:
+            yield
+        except BaseException:
+            self.conn.deferred = False
+            self.conn.rollback()
+            raise
+        self.conn.deferred = False
+        self.conn.commit()
+
+    @contextmanager
+    def deferred_indexes(self, table):
+        """Bulk-load mode: drop the secondary indexes of `table` for the block and
+        rebuild them once at the end instead of maintaining them row by row.
+        PRIMARY KEY / UNIQUE indexes stay: INSERT OR IGNORE relies on them."""
+        if not self.bulk:
+            yield
+            return
+        indexes = self.conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL "
+            "AND sql NOT LIKE 'CREATE UNIQUE%'", (table,)).fetchall()
+        for name, _ in indexes:
+            self.conn.execute(f"DROP INDEX {name}")
+        try:
+            yield
+        finally:
+            t0 = time.perf_counter()
+            for _, sql in indexes:
+                self.conn.execute(sql)
+            if indexes:
+                logging.info(f"  → Rebuilt {len(indexes)} index(es) on {table} in {time.perf_counter() - t0:.1f}s")
+
     def init_db(self):
         cursor = self.conn.cursor()
+        new_alias_table = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vendor_alias'").fetchone() is None
+        # fact_forecast keyed by client only (one row per primary vendor): rebuilt
+        # below with the vendedor/jefe/zona scope in the key
+        forecast_cols = {r[1] for r in cursor.execute("PRAGMA table_info(fact_forecast)")}
+        old_forecast = bool(forecast_cols) and 'nivel' not in forecast_cols
+        if old_forecast:
+            cursor.execute("ALTER TABLE fact_forecast RENAME TO fact_forecast_by_client")
         cursor.executescript("""
             CREATE TABLE IF NOT EXISTS etl_run (
                 run_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -192,6 +1196,73 @@ class SalesETL:
                 subcategoria TEXT,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            -- Per-stage cost of each run (etl.py --report): capacity planning / regressions
+            CREATE TABLE IF NOT EXISTS etl_stage_metrics (
+                run_id INTEGER,
+                stage TEXT,
+                seq INTEGER,
+                status TEXT,            -- OK, SKIPPED, FAILED
+                wall_s REAL,
+                cpu_s REAL,             -- this process + worker processes
+                rows_read INTEGER,      -- source rows parsed (files/sheets)
+                rows_written INTEGER,   -- rows inserted/updated/deleted
+                peak_rss_mb REAL,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, stage)
+            );
+            -- Stages done and run state of the current run, for etl.py --resume
+            -- after a failure; cleared when a run succeeds
+            CREATE TABLE IF NOT EXISTS etl_run_checkpoint (
+                run_id INTEGER PRIMARY KEY,
+                generation INTEGER,     -- live DB generation the shadow copy was seeded from
+                state_json TEXT,        -- {"completed": [...], "dirty": [...], "target_month": ...}
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            -- Invoice lines already loaded (same line_key, different row_hash):
+            -- skipped, listed here for review
+            CREATE TABLE IF NOT EXISTS etl_facturacion_duplicates (
+                run_id INTEGER,
+                source_file TEXT,
+                stored_file TEXT,       -- file of the line kept (= source_file: repeated within
+                                        -- the file; NULL: loaded before source_file was tracked)
+                line_key INTEGER,
+                fecha_emision TEXT,
+                cod_cliente TEXT,
+                cod_producto TEXT,
+                cantidad REAL,
+                importe REAL,
+                same_amounts INTEGER    -- 1: same kg and importe as the stored line
+            );
+            -- Old/duplicate codes and the code they load as (see ALIAS_TABLES)
+            CREATE TABLE IF NOT EXISTS vendor_alias (
+                alias_code TEXT PRIMARY KEY,
+                cod_vendedor TEXT NOT NULL,
+                nom_vendedor TEXT,      -- set on the avance rows remapped to it (NULL: keep)
+                nota TEXT
+            );
+            CREATE TABLE IF NOT EXISTS client_alias (
+                alias_code TEXT PRIMARY KEY,
+                cod_cliente TEXT NOT NULL,
+                nota TEXT
+            );
+            -- Resolved aliases the stored rows reflect; diffed with the alias tables each run
+            CREATE TABLE IF NOT EXISTS etl_alias_applied (
+                kind TEXT,              -- vendor, client
+                alias_code TEXT,
+                code TEXT,
+                name TEXT,
+                PRIMARY KEY (kind, alias_code)
+            );
+            -- Minerva products no category keyword matched; cleared once classified
+            CREATE TABLE IF NOT EXISTS etl_unclassified_products (
+                cod_producto TEXT PRIMARY KEY,
+                descripcion TEXT,
+                familia TEXT,
+                source_file TEXT,
+                run_id INTEGER,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
             CREATE TABLE IF NOT EXISTS fact_facturacion (
                 row_hash TEXT PRIMARY KEY,
                 fecha_emision TEXT,
@@ -202,7 +1273,11 @@ class SalesETL:
                 importe REAL,
                 deposito TEXT,
                 year_month TEXT,
-                es_premium INTEGER DEFAULT 0
+                es_premium INTEGER DEFAULT 0,
+                line_key INTEGER,       -- natural key of the invoice line, see line_keys()
+                cod_vendedor_orig TEXT, -- raw code when an alias remapped it (else NULL)
+                cod_cliente_orig TEXT,
+                source_file TEXT        -- Facturación file the row was loaded from
             );
             CREATE TABLE IF NOT EXISTS fact_avance_cliente_vendedor_month (
                 year_month TEXT,
@@ -221,7 +1296,10 @@ class SalesETL:
                 objetivo_pesos REAL DEFAULT 0,
                 objetivo_premium_pesos REAL DEFAULT 0,
                 frecuencia TEXT,
-                match_quality TEXT
+                match_quality TEXT,
+                cod_vendedor_orig TEXT, -- raw code when an alias remapped it (else NULL)
+                cod_cliente_orig TEXT,
+                nom_vendedor_orig TEXT  -- name in the Excel when the alias renamed the vendor
             );
             CREATE TABLE IF NOT EXISTS fact_cliente_historico (
                 cod_cliente TEXT,
@@ -416,6 +1494,72 @@ class SalesETL:
                 usuario TEXT,
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            -- Next-month forecast per client of each vendedor/jefe/zona scope (the
+            -- zone benchmark and launch factors depend on the scope), recomputed
+            -- after every ETL run. Previous runs are kept so forecasts can be
+            -- compared with actuals.
+            CREATE TABLE IF NOT EXISTS fact_forecast (
+                run_id INTEGER,
+                target_month TEXT,       -- month being forecast (YYYY-MM)
+                base_month TEXT,         -- last avance month the forecast is built on
+                nivel TEXT,              -- vendedor, jefe, zona (as in fact_forecast_rollup);
+                                         -- primario: runs from before the scopes, one row per
+                                         -- client from its primary vendor (not served)
+                clave TEXT,
+                cod_cliente TEXT,
+                forecast_kg REAL,
+                low_kg REAL,
+                high_kg REAL,
+                confidence INTEGER,
+                hist_months INTEGER,
+                baseline_kg REAL,
+                trend REAL,
+                seasonality REAL,
+                recency REAL,
+                launch_engagement REAL,
+                zone_benchmark REAL,
+                note TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, target_month, nivel, clave, cod_cliente)
+            );
+            CREATE TABLE IF NOT EXISTS fact_forecast_rollup (
+                run_id INTEGER,
+                target_month TEXT,
+                base_month TEXT,
+                nivel TEXT,              -- vendedor, jefe, zona
+                clave TEXT,
+                forecast_kg REAL,        -- scope-level BASELINE × TREND × SEASONALITY × RECENCY
+                low_kg REAL,
+                high_kg REAL,
+                confidence INTEGER,
+                clientes_forecast_kg REAL, -- sum of the per-client forecasts
+                n_clientes INTEGER,
+                PRIMARY KEY (run_id, target_month, nivel, clave)
+            );
+            -- Daily cube of fact_facturacion per (month, vendor, client, day).
+            -- Maintained incrementally: only cells touched by a load are rebuilt.
+            CREATE TABLE IF NOT EXISTS fact_facturacion_diaria (
+                year_month TEXT,
+                cod_vendedor TEXT,
+                cod_cliente TEXT,
+                fecha_emision TEXT,
+                kg REAL,
+                importe REAL,
+                lineas INTEGER,
+                PRIMARY KEY (year_month, cod_vendedor, cod_cliente, fecha_emision)
+            );
+            -- Source files loaded by the last successful run. Unchanged files
+            -- (same size + mtime, or same content hash) are skipped next time.
+            CREATE TABLE IF NOT EXISTS etl_file_manifest (
+                path TEXT PRIMARY KEY,   -- file name inside --data-dir
+                size INTEGER,
+                mtime REAL,
+                content_hash TEXT,       -- sha256
+                source_group TEXT,       -- key of SOURCE_GROUPS
+                produces_json TEXT,      -- {"tables": [...], "months": [...], ...}
+                run_id INTEGER,
+                loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
             CREATE TABLE IF NOT EXISTS dim_zones (
                 provincia TEXT,
                 zona TEXT PRIMARY KEY,
@@ -424,12 +1568,47 @@ class SalesETL:
             );
 
         """);
+        # Columns added after the tables were first created
+        added = {'fact_facturacion': [('line_key', 'INTEGER'), ('cod_vendedor_orig', 'TEXT'), ('cod_cliente_orig', 'TEXT'),
+                                      ('source_file', 'TEXT')],
+                 'fact_avance_cliente_vendedor_month': [('cod_vendedor_orig', 'TEXT'), ('cod_cliente_orig', 'TEXT'),
+                                                        ('nom_vendedor_orig', 'TEXT')],
+                 'etl_facturacion_duplicates': [('stored_file', 'TEXT')]}
+        for table, columns in added.items():
+            existing = {r[1] for r in cursor.execute(f"PRAGMA table_info({table})")}
+            for name, decl in columns:
+                if name not in existing:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+        if old_forecast:
+            # Past runs kept for accuracy tracking; /api/forecast computes live until the next run
+            cursor.execute("""
+                INSERT OR IGNORE INTO fact_forecast
+                (run_id, target_month, base_month, nivel, clave, cod_cliente,
+                 forecast_kg, low_kg, high_kg, confidence, hist_months,
+                 baseline_kg, trend, seasonality, recency, launch_engagement, zone_benchmark, note, created_at)
+                SELECT run_id, target_month, base_month, 'primario', cod_vendedor, cod_cliente,
+                       forecast_kg, low_kg, high_kg, confidence, hist_months,
+                       baseline_kg, trend, seasonality, recency, launch_engagement, zone_benchmark, note, created_at
+                FROM fact_forecast_by_client
+            """)
+            cursor.execute("DROP TABLE fact_forecast_by_client")
         # Indexes
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_ym ON fact_facturacion(year_month)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fact_fact_line_key ON fact_facturacion(line_key) "
+                       "WHERE line_key IS NOT NULL")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_avance_ym ON fact_avance_cliente_vendedor_month(year_month)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_vendedor ON fact_facturacion(cod_vendedor)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_cell ON fact_facturacion(year_month, cod_vendedor, cod_cliente)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_source ON fact_facturacion(source_file, year_month)")
+        # Alias re-keys (apply_aliases): rows by code, and the few remapped ones by raw code
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_cliente ON fact_facturacion(cod_cliente)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_vendedor_orig ON fact_facturacion(cod_vendedor_orig) "
+                       "WHERE cod_vendedor_orig IS NOT NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_fact_cliente_orig ON fact_facturacion(cod_cliente_orig) "
+                       "WHERE cod_cliente_orig IS NOT NULL")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_crm_inter_cli ON crm_interactions(cod_cliente)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_sku_canal ON prices_list(sku, canal, periodo)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fact_forecast_target ON fact_forecast(target_month, base_month)")
         
         # Initial data for channels
         cursor.executemany("INSERT OR IGNORE INTO canales (id, nombre, tipo) VALUES (?, ?, ?)", [
@@ -439,7 +1618,31 @@ class SalesETL:
             ('SUP', 'Supermercados Regionales', 'supermercado'),
             ('RV', 'Retail Vanguardia', 'supermercado')
         ])
+        if new_alias_table:
+            cursor.executemany("INSERT OR IGNORE INTO vendor_alias (alias_code, cod_vendedor, nom_vendedor, nota) "
+                               "VALUES (?, ?, ?, ?)", DEFAULT_VENDOR_ALIASES)
         self.conn.commit()
+        self.load_aliases()
+
+    def load_aliases(self):
+        """Resolve vendor_alias/client_alias into self.aliases (resolve_aliases)."""
+        self.aliases = {kind: resolve_aliases(self.conn.execute(sql)) for kind, sql in ALIAS_TABLES.items()}
+
+    def alias_codes(self, kind):
+        """{alias: code} of one kind, as the loaders take it."""
+        return {alias: code for alias, (code, _) in self.aliases.get(kind, {}).items()}
+
+    def alias_changes(self):
+        """{kind: {alias: (code, name) or None if removed}} of the aliases that differ
+        from the ones the stored rows were loaded or re-keyed with (etl_alias_applied)."""
+        applied = {kind: {} for kind in ALIAS_TABLES}
+        for kind, alias, code, name in self.conn.execute("SELECT kind, alias_code, code, name FROM etl_alias_applied"):
+            applied.setdefault(kind, {})[alias] = (code, name)
+        changes = {}
+        for kind, current in self.aliases.items():
+            before = applied.get(kind, {})
+            changes[kind] = {a: current.get(a) for a in current.keys() | before.keys() if current.get(a) != before.get(a)}
+        return changes
 
     def start_run(self):
         cursor = self.conn.cursor()
@@ -462,6 +1665,314 @@ class SalesETL:
                 return f
         return None
 
+    def facturacion_files(self):
+        """All Facturación*.txt files (monthly/daily), in load order."""
+        # Search for all variations of facturacion files
+        txt_patterns = [
+            '*facturación*.txt', '*Facturación*.txt', '*facturacion*.txt',
+            '*Factu*.txt', '*factu*.txt'  # Added for FactuNov25, FactuDic25, etc
+        ]
+        txt_files = []
+        for pattern in txt_patterns:
+            txt_files.extend(self.data_dir.glob(pattern))
+        return sorted(set(txt_files))
+
+    def source_files(self, group):
+        """Files of a SOURCE_GROUPS group present in data_dir."""
+        if group == 'facturacion':
+            return self.facturacion_files()
+        return [f for f in (self.find_file(REQUIRED_FILES[k]) for k in SOURCE_FILE_KEYS[group]) if f]
+
+    # --- File manifest (incremental runs) ---
+
+    def load_manifest(self):
+        self.manifest = {r['path']: dict(r) for r in self.conn.execute("SELECT * FROM etl_file_manifest")}
+
+    def _fingerprint(self, f):
+        """(size, mtime, content_hash) of f, hashed at most once per run."""
+        if f.name not in self._digests:
+            st = f.stat()
+            self._digests[f.name] = (st.st_size, st.st_mtime, file_digest(f))
+        return self._digests[f.name]
+
+    def is_unchanged(self, f):
+        """True when f matches its manifest entry: same size and mtime, or same
+        content hash (file touched/copied but not edited). False with --full."""
+        if self.full:
+            return False
+        entry = self.manifest.get(f.name)
+        if not entry:
+            return False
+        st = f.stat()
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return True
+        if entry['size'] != st.st_size or self._fingerprint(f)[2] != entry['content_hash']:
+            return False
+        # Same content, new mtime: refresh the entry so the next check is a stat
+        self.record_source(f, entry['source_group'], **json.loads(entry['produces_json'] or '{}'))
+        return True
+
+    def manifest_produces(self, f):
+        """What f produced on its last successful load (pending entry first)."""
+        if f.name in self.manifest_pending:
+            return self.manifest_pending[f.name]['produces']
+        entry = self.manifest.get(f.name)
+        return json.loads(entry['produces_json'] or '{}') if entry else {}
+
+    def record_source(self, f, group, **produces):
+        """Queue f's manifest entry; written by save_manifest() when the run succeeds,
+        so a failed run reprocesses the file and everything downstream of it."""
+        size, mtime, digest = self._fingerprint(f)
+        produces.setdefault('tables', SOURCE_GROUPS[group])
+        self.manifest_pending[f.name] = {
+            'path': f.name, 'size': size, 'mtime': mtime, 'content_hash': digest,
+            'source_group': group, 'produces': produces,
+        }
+
+    def record_sources(self, group, **produces):
+        for f in self.source_files(group):
+            self.record_source(f, group, **produces)
+
+    def save_manifest(self):
+        self.conn.executemany("""
+            INSERT INTO etl_file_manifest (path, size, mtime, content_hash, source_group, produces_json, run_id, loaded_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(path) DO UPDATE SET
+                size=excluded.size, mtime=excluded.mtime, content_hash=excluded.content_hash,
+                source_group=excluded.source_group, produces_json=excluded.produces_json,
+                run_id=excluded.run_id, loaded_at=CURRENT_TIMESTAMP
+        """, [
+            (e['path'], e['size'], e['mtime'], e['content_hash'], e['source_group'],
+             json.dumps(e['produces'], ensure_ascii=False), self.run_id)
+            for e in self.manifest_pending.values()
+        ])
+        self.conn.commit()
+        logging.info(f"Manifest: {len(self.manifest_pending)} file(s) recorded")
+
+    def detect_source_changes(self):
+        """SOURCE_GROUPS with a new or modified file since the last successful run."""
+        self.load_manifest()
+        changed = set()
+        for group in SOURCE_GROUPS:
+            files = self.source_files(group)
+            stale = [f.name for f in files if not self.is_unchanged(f)]
+            if stale:
+                changed.add(group)
+                logging.info(f"Manifest: {group} changed ({', '.join(stale)})")
+            else:
+                logging.info(f"Manifest: {group} unchanged ({len(files)} file(s))")
+        return changed
+
+    def _sales_removed(self):
+        """True when a facturación cell changed in this run has no positive kg left
+        for the avance month. sync_facturacion_to_avance only overwrites rows that
+        still have sales, so the Excel venta_actual must be reloaded first."""
+        ym = self.conn.execute("SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month").fetchone()[0]
+        cells = [c for c in self.changed_cells if c[0] == ym]
+        if not cells:
+            return False
+        self._stage_changed_cells()
+        return self.conn.execute("""
+            SELECT 1 FROM _changed_cells c
+            WHERE c.year_month = ? AND NOT EXISTS (
+                SELECT 1 FROM fact_facturacion f
+                WHERE f.year_month = c.year_month AND f.cod_vendedor = c.cod_vendedor
+                  AND f.cod_cliente = c.cod_cliente AND f.cantidad > 0)
+            LIMIT 1
+        """, (ym,)).fetchone() is not None
+
+    # --- Stage scheduler (STAGES) ---
+
+    def stage_due(self, name, dirty):
+        """True if stage `name` has to run: forced, --full, or an input group changed."""
+        sources = STAGES[name]['sources']
+        return sources is None or self.full or name in self.forced or bool(dirty & set(sources))
+
+    def run_stages(self, dirty, plan, completed=()):
+        """Run the `plan` stages not `completed` yet, each once the stages it depends
+        on (STAGE_DEPENDENCIES) are done.
+
+        The database has a single writer, so stages write one at a time; meanwhile
+        worker processes parse the workbooks of the pending stages. Among the stages
+        whose dependencies are done, the first whose sheets are parsed goes next.
+        A checkpoint after each stage lets --resume continue a failed run.
+        """
+        completed = set(completed)
+        pending = [name for name in STAGES if name in plan and name not in completed]
+        done = set(STAGES) - set(pending)
+        pool, futures = self._prefetch_workbooks([name for name in pending if self.stage_due(name, dirty)])
+        try:
+            while pending:
+                ready = [name for name in pending if STAGE_DEPENDENCIES[name] <= done]
+                parsed = [name for name in ready if all(f.done() for f, _, _ in futures.get(name, ()))]
+                if not parsed:
+                    wait([f for name in ready for f, _, _ in futures[name]], return_when=FIRST_COMPLETED)
+                    continue
+                name = parsed[0]
+                self._store_prefetched(futures.pop(name, ()))
+                completed.add(name)
+                self._run_scheduled(name, dirty, plan, completed)
+                pending.remove(name)
+                done.add(name)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+    def _run_scheduled(self, name, dirty, plan, completed):
+        spec = STAGES[name]
+        if spec.get('when') and not getattr(self, spec['when']):
+            self.save_checkpoint(dirty, plan, completed)
+            return
+        if name == 'process_avance_vendedor' and 'avance' not in dirty and self._sales_removed():
+            logging.info("Manifest: facturación removed sales of the avance month, reloading avance")
+            dirty.add('avance')
+        if not self.stage_due(name, dirty):
+            logging.info(f"Skipping {name}: inputs unchanged ({', '.join(spec['sources'])})")
+            self.record_stage(name, 'SKIPPED')
+            self._after_stage(name, ran=False)
+            self.save_checkpoint(dirty, plan, completed)
+            return
+        method, kwargs = name, {}
+        if self.incremental and 'avance' not in dirty:
+            method, kwargs = INCREMENTAL_VARIANTS.get(name, (name, {}))
+        with self.measure(name), self.stage_transaction():
+            getattr(self, method)(**kwargs)
+            self._after_stage(name, ran=True)
+            self.save_checkpoint(dirty, plan, completed)
+
+    def _after_stage(self, name, ran):
+        """Run state the next stages rely on: manifest entries of the loaded files
+        and, when the avance was not reloaded, the target month already stored."""
+        if name == 'process_dimensions' and ran:
+            self.record_sources('dimensions')
+        elif name == 'process_avance_vendedor':
+            if ran:
+                self.record_sources('avance', months=[self.target_month])
+            else:
+                self.target_month = self.conn.execute(
+                    "SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month"
+                ).fetchone()[0]
+        elif name == 'process_lanzamientos' and ran:
+            self.record_sources('lanzamientos', months=[self.target_month])
+
+    def _prefetch_workbooks(self, stages):
+        """Submit the workbooks of `stages` to a process pool (none with a single
+        worker). Returns (pool, {stage: [(future, path, parse_workbook kwargs)]})."""
+        jobs = []
+        for name in stages:
+            for spec in STAGES[name].get('workbooks', ()):
+                spec = dict(spec)
+                path = self.find_file(REQUIRED_FILES[spec.pop('file')])
+                if path:
+                    jobs.append((name, path, spec))
+        if self.workers < 2 or not jobs:
+            return None, {}
+        pool = ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)))
+        futures = {}
+        for name, path, spec in jobs:
+            future = pool.submit(parse_workbook, path, self.workbooks.engine, **spec)
+            futures.setdefault(name, []).append((future, path, spec))
+        logging.info(f"Parsing {len(jobs)} workbook(s) of {len(futures)} stage(s) ahead "
+                     f"on {min(self.workers, len(jobs))} worker(s)")
+        return pool, futures
+
+    def _store_prefetched(self, jobs):
+        for future, path, spec in jobs:
+            try:
+                sheet_names, frames = future.result()
+            except Exception as e:
+                logging.warning(f"Parsing {path.name} ahead failed ({e}); the stage reads it itself")
+                continue
+            kw = {k: v for k, v in spec.items() if k not in ('sheets', 'skip', 'header')}
+            self.workbooks.store(path, sheet_names, frames, spec.get('header', 0), **kw)
+
+    def save_checkpoint(self, dirty, plan, completed):
+        """Store the progress of the run (in the stage's transaction in bulk-load mode)."""
+        state = {
+            'plan': sorted(plan), 'forced': sorted(self.forced), 'full': self.full,
+            'completed': sorted(completed), 'dirty': sorted(dirty),
+            'target_month': self.target_month,
+            'changed_cells': sorted(self.changed_cells),
+            'processed_files': self.processed_files,
+            'manifest_pending': self.manifest_pending,
+        }
+        self.conn.execute(
+            "INSERT OR REPLACE INTO etl_run_checkpoint (run_id, generation, state_json) VALUES (?, ?, ?)",
+            (self.run_id, read_generation(self.db_path), json.dumps(state, ensure_ascii=False)))
+        self.conn.commit()
+
+    def load_checkpoint(self):
+        """Checkpoint of the last run, which must have failed (ValueError otherwise)."""
+        try:
+            row = self.conn.execute("""
+                SELECT r.run_id, r.status, c.generation, c.state_json
+                FROM etl_run r LEFT JOIN etl_run_checkpoint c ON c.run_id = r.run_id
+                ORDER BY r.run_id DESC LIMIT 1
+            """).fetchone()
+        except sqlite3.OperationalError:
+            row = None  # no run with checkpoints yet
+        if not row or row['status'] != 'FAILED' or not row['state_json']:
+            raise ValueError(f"nothing to resume: the last run in {self.work_path} did not fail in a stage")
+        generation = read_generation(self.db_path)
+        if self.shadow and row['generation'] != generation:
+            raise ValueError(f"{self.db_path} is generation {generation} now, run {row['run_id']} was built on "
+                             f"generation {row['generation']}: start a new run")
+        return dict(json.loads(row['state_json']), run_id=row['run_id'])
+
+    def restore_checkpoint(self, state):
+        """Pick up the run of `state` (load_checkpoint). Returns (dirty, plan, completed)."""
+        self.run_id = state['run_id']
+        self.full = state['full']
+        self.forced = set(state['forced'])
+        self.target_month = state['target_month']
+        self.changed_cells = {tuple(cell) for cell in state['changed_cells']}
+        self.processed_files = state['processed_files']
+        self.manifest_pending = state['manifest_pending']
+        self.load_manifest()
+        self._stage_seq = self.conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM etl_stage_metrics WHERE run_id = ?", (self.run_id,)).fetchone()[0]
+        self.conn.execute("UPDATE etl_run SET status = 'RUNNING', message = NULL WHERE run_id = ?", (self.run_id,))
+        self.conn.commit()
+        completed = set(state['completed'])
+        logging.info(f"Resuming run {self.run_id}: {len(completed)} of {len(state['plan'])} stage(s) already done")
+        return set(state['dirty']), set(state['plan']), completed
+
+    @contextmanager
+    def measure(self, name):
+        """Record wall/CPU time, rows read/written and peak RSS of the block in etl_stage_metrics."""
+        reset_peak_rss()
+        rows_read, changes = self.rows_read, self.conn.total_changes
+        wall, cpu = time.perf_counter(), process_cpu_seconds()
+        status = 'FAILED'
+        try:
+            yield
+            status = 'OK'
+        finally:
+            self.record_stage(name, status,
+                              wall_s=time.perf_counter() - wall,
+                              cpu_s=process_cpu_seconds() - cpu,
+                              rows_read=self.rows_read - rows_read,
+                              rows_written=self.conn.total_changes - changes,
+                              peak_rss_mb=peak_rss_mb())
+
+    def record_stage(self, name, status, wall_s=0.0, cpu_s=0.0, rows_read=0, rows_written=0, peak_rss_mb=None):
+        if self.run_id is None:
+            return
+        self._stage_seq += 1
+        try:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO etl_stage_metrics
+                (run_id, stage, seq, status, wall_s, cpu_s, rows_read, rows_written, peak_rss_mb)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (self.run_id, name, self._stage_seq, status, round(wall_s, 3), round(cpu_s, 3),
+                  rows_read, rows_written, peak_rss_mb))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not record metrics of {name}: {e}")
+        if status != 'SKIPPED':
+            logging.info(f"  ⏱ {name}: {wall_s:.2f}s wall, {cpu_s:.2f}s CPU, {rows_read:,} read, "
+                         f"{rows_written:,} written, peak RSS {peak_rss_mb} MB")
+
     def process_dimensions(self):
         logging.info("Processing Dimensions...")
         
@@ -469,127 +1980,94 @@ class SalesETL:
         f_clients = self.find_file(REQUIRED_FILES['clients'])
         if f_clients:
             logging.info(f"Loading Clients Master from {f_clients.name}")
-            df = robust_read_excel(f_clients, ["CLIENTEID", "CLIENTE"])
+            df = robust_read_excel(f_clients, ["CLIENTEID", "CLIENTE"], workbooks=self.workbooks)
             df.columns = [str(c).strip().upper() for c in df.columns]
-
-            # Normalize column name variants
-            col_map = {
-                'CLIENTEID': 'CLIENTEID', 'CLIENTE': 'CLIENTE',
-                'COD CENTRALIZADOR': 'COD CENTRALIZADOR',
-                'FRECUENCIA': 'FRECUENCIA',
-                'CIUDAD': 'CIUDAD', 'PROVINCIA': 'PROVINCIA',
-                'DIRECCIÓN': 'DIRECCIÓN', 'DIRECCION': 'DIRECCIÓN',
-                'TEL': 'TEL', 'CORREO': 'CORREO',
-                'CONTACTO': 'CONTACTO', 'PLAZO': 'PLAZO', 'ACTIVO': 'ACTIVO'
-            }
-            # Normalize accented column names
-            import unicodedata
-            norm_cols = {}
-            for c in df.columns:
-                norm = ''.join(ch for ch in unicodedata.normalize('NFKD', c) if not unicodedata.combining(ch))
-                norm_cols[norm.upper()] = c
-
-            def get_col(key):
-                # Try exact, then normalized
-                if key in df.columns: return key
-                norm_key = ''.join(ch for ch in unicodedata.normalize('NFKD', key) if not unicodedata.combining(ch)).upper()
-                return norm_cols.get(norm_key)
-
-            for _, row in df.iterrows():
-                cid = normalize_key(row.get('CLIENTEID'))
-                if not cid: continue
-
-                def v(key):
-                    col = get_col(key)
-                    if col is None: return None
-                    val = row.get(col)
-                    if pd.isna(val): return None
-                    return str(val).strip() if val else None
-
-                lista = v('LISTA PRECIO') or v('LISTA_PRECIO')
-                canal = None
-                if lista:
-                    lu = lista.upper()
-                    if 'SUBDIST' in lu: canal = 'subdistribuidor'
-                    elif 'DIST' in lu: canal = 'distribuidor'
-                    elif 'MAYORIST' in lu: canal = 'mayorista'
-                    elif 'SUPER' in lu or 'MERCADO' in lu or 'LIBERTAD' in lu: canal = 'supermercado'
-
-                self.conn.execute("""
-                    INSERT INTO dim_clients (
-                        cliente_id, cliente_name, cod_centralizador, frecuencia,
-                        ciudad, provincia, direccion, telefono, correo,
-                        contacto, plazo, activo, canal
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(cliente_id) DO UPDATE SET
-                        cliente_name=excluded.cliente_name,
-                        cod_centralizador=excluded.cod_centralizador,
-                        frecuencia=excluded.frecuencia,
-                        ciudad=excluded.ciudad,
-                        provincia=excluded.provincia,
-                        direccion=excluded.direccion,
-                        telefono=excluded.telefono,
-                        correo=excluded.correo,
-                        contacto=excluded.contacto,
-                        plazo=excluded.plazo,
-                        activo=excluded.activo,
-                        canal=excluded.canal,
-                        updated_at=CURRENT_TIMESTAMP
-                """, (
-                    cid,
-                    v('CLIENTE'),
-                    normalize_key(row.get('COD CENTRALIZADOR')),
-                    v('FRECUENCIA'),
-                    v('CIUDAD'),
-                    v('PROVINCIA'),
-                    v('DIRECCIÓN'),
-                    v('TEL'),
-                    v('CORREO'),
-                    v('CONTACTO'),
-                    v('PLAZO'),
-                    v('ACTIVO'),
-                    canal,
-                ))
+            self.rows_read += len(df)
+
+            # Map each field to its column once: exact name, else accent-insensitive
+            norm_cols = {fold_accents(c): c for c in df.columns}
+
+            def col(key):
+                name = key if key in df.columns else norm_cols.get(fold_accents(key))
+                return text_values(df[name]) if name is not None else [None] * len(df)
+
+            lista_precio, lista_precio_alt = col('LISTA PRECIO'), col('LISTA_PRECIO')
+            canal = canal_from_lista([a or b for a, b in zip(lista_precio, lista_precio_alt)])
+            fields = zip(
+                col('CLIENTE'),
+                normalize_keys(df['COD CENTRALIZADOR']) if 'COD CENTRALIZADOR' in df.columns else [''] * len(df),
+                col('FRECUENCIA'), col('CIUDAD'), col('PROVINCIA'), col('DIRECCIÓN'),
+                col('TEL'), col('CORREO'), col('CONTACTO'), col('PLAZO'), col('ACTIVO'),
+                canal,
+            )
+            ids = normalize_keys(df['CLIENTEID']) if 'CLIENTEID' in df.columns else [''] * len(df)
+            # Last row of a repeated ID wins, at the position of its first row
+            clients = {}
+            for cid, values in zip(ids, fields):
+                if cid:
+                    clients[cid] = values
+            self._upsert_dimension('dim_clients', 'cliente_id', [
+                'cliente_name', 'cod_centralizador', 'frecuencia', 'ciudad', 'provincia',
+                'direccion', 'telefono', 'correo', 'contacto', 'plazo', 'activo', 'canal',
+            ], clients)
             self.processed_files.append(f_clients.name)
 
         # 2. Product Classification - Header is at row 6
         f_prod = self.find_file(REQUIRED_FILES['products'])
         if f_prod:
             logging.info(f"Loading Product Classification from {f_prod.name}")
-            df = pd.read_excel(f_prod, header=6)
+            df = self.workbooks.parse(f_prod, header=6)
             df.columns = [str(c).strip().upper() for c in df.columns]
+            self.rows_read += len(df)
             logging.info(f"Product columns: {list(df.columns)[:10]}")
-            
-            for _, row in df.iterrows():
-                pid = normalize_key(row.get('COD PRODUCTO'))
-                if not pid: continue
-                self.conn.execute("""
-                    INSERT INTO dim_product_classification (cod_producto, descripcion, categoria, subcategoria)
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(cod_producto) DO UPDATE SET
-                        descripcion=excluded.descripcion,
-                        categoria=excluded.categoria,
-                        subcategoria=excluded.subcategoria,
-                        updated_at=CURRENT_TIMESTAMP
-                """, (pid, row.get('NOM PRODUCTO'), row.get('NOM CATEGORIA'), row.get('NOM CLASE COMERCIAL')))
+
+            def col(key):
+                if key not in df.columns:
+                    return [None] * len(df)
+                vals = df[key].to_numpy(dtype=object)
+                return [None if n else v for v, n in zip(vals, pd.isna(vals))]
+
+            ids = normalize_keys(df['COD PRODUCTO']) if 'COD PRODUCTO' in df.columns else [''] * len(df)
+            products = {}
+            for pid, values in zip(ids, zip(col('NOM PRODUCTO'), col('NOM CATEGORIA'), col('NOM CLASE COMERCIAL'))):
+                if pid:
+                    products[pid] = values
+            self._upsert_dimension('dim_product_classification', 'cod_producto',
+                                   ['descripcion', 'categoria', 'subcategoria'], products)
+            self._product_codes = None
+            self.conn.execute("""
+                DELETE FROM etl_unclassified_products
+                WHERE cod_producto IN (SELECT cod_producto FROM dim_product_classification)
+            """)
             self.processed_files.append(f_prod.name)
-        
+
         self.conn.commit()
 
+    def _upsert_dimension(self, table, key, columns, rows):
+        """Upsert {key: (column values)} into a dimension table with one executemany,
+        skipping keys whose stored values already hash the same (updated_at untouched)."""
+        cols = ', '.join(columns)
+        stored = {r[0]: content_hash(r[1:]) for r in self.conn.execute(f"SELECT {key}, {cols} FROM {table}")}
+        changed = [(k, *values) for k, values in rows.items() if stored.get(k) != content_hash(values)]
+        updates = ',\n'.join(f"{c}=excluded.{c}" for c in columns)
+        self.conn.executemany(f"""
+            INSERT INTO {table} ({key}, {cols})
+            VALUES ({', '.join(['?'] * (len(columns) + 1))})
+            ON CONFLICT({key}) DO UPDATE SET
+                {updates},
+                updated_at=CURRENT_TIMESTAMP
+        """, changed)
+        logging.info(f"{table}: {len(changed)} new/changed of {len(rows)} rows ({len(rows) - len(changed)} unchanged skipped)")
+        return len(changed)
+
     def process_facturacion(self):
-        """Process all Facturación*.txt files (supports multiple monthly/daily files)."""
-        # Search for all variations of facturacion files
-        txt_patterns = [
-            '*facturación*.txt', '*Facturación*.txt', '*facturacion*.txt',
-            '*Factu*.txt', '*factu*.txt'  # Added for FactuNov25, FactuDic25, etc
-        ]
-        txt_files = []
-        for pattern in txt_patterns:
-            txt_files.extend(self.data_dir.glob(pattern))
-        
-        # Remove duplicates
-        txt_files = list(set(txt_files))
+        """Process all Facturación*.txt files (supports multiple monthly/daily files).
+
+        Files unchanged since the last successful run (etl_file_manifest) are
+        skipped, unless a Minerva file reloaded before them in this run cleared
+        one of their months: a full run would have re-inserted them afterwards.
+        """
+        txt_files = self.facturacion_files()
         
         if not txt_files:
             logging.warning("No Facturación TXT files found. Skipping.")
@@ -597,238 +2075,292 @@ class SalesETL:
         
         logging.info(f"Found {len(txt_files)} Facturación file(s): {[f.name for f in txt_files]}")
         
-        total_rows = 0
-        for f_fact in sorted(txt_files):
-            rows = self._process_single_facturacion(f_fact)
-            total_rows += rows
+        # Changed files are parsed in a process pool; this process is the only
+        # writer and applies them in sorted order, so the final state (Minerva
+        # month replacement, INSERT OR IGNORE) does not depend on the worker count
+        changed = [f for f in txt_files if not self.is_unchanged(f)]
+        n_workers = min(self.workers, len(changed))
+        total_rows = skipped = 0
+        replaced = set()  # months cleared by Minerva files reloaded in this run
+        defer = self.deferred_indexes('fact_facturacion') if changed else nullcontext()
+        with tempfile.TemporaryDirectory(prefix='etl_fact_') as spool, defer:
+            pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+            try:
+                aliases = {kind: self.alias_codes(kind) for kind in ALIAS_TABLES}
+                futures = {f: pool.submit(parse_facturacion, f, spool, aliases) for f in changed} if pool else {}
+                if pool:
+                    logging.info(f"Parsing {len(changed)} Facturación file(s) on {n_workers} worker(s)")
+                for f_fact in txt_files:
+                    if f_fact not in changed:
+                        overlap = replaced & set(self.manifest_produces(f_fact).get('months', []))
+                        if not overlap:
+                            skipped += 1
+                            logging.info(f"Skipping {f_fact.name}: unchanged since run {self.manifest[f_fact.name]['run_id']}")
+                            continue
+                        logging.info(f"Reloading unchanged {f_fact.name}: months {sorted(overlap)} were replaced by a Minerva file")
+                    parsed = futures[f_fact].result() if f_fact in futures else parse_facturacion(f_fact, spool, aliases)
+                    total_rows += self._apply_facturacion(f_fact, parsed)
+                    if parsed['layout'] == 'minerva':
+                        replaced.update(parsed['months'])
+            finally:
+                if pool:
+                    pool.shutdown(cancel_futures=True)
         
-        logging.info(f"Facturacion TOTAL: {total_rows} rows processed from {len(txt_files)} file(s)")
+        logging.info(f"Facturacion TOTAL: {total_rows} rows processed from {len(txt_files) - skipped} file(s)"
+                     f" ({skipped} unchanged skipped)")
+
+    def _cell_fingerprints(self, months):
+        """Row hashes of fact_facturacion per (year_month, cod_vendedor, cod_cliente)
+        for the given months. Two snapshots differ for a cell iff its rows changed."""
+        months = list(months)
+        if not months: return {}
+        ph = ','.join(['?'] * len(months))
+        cells = {}
+        for ym, ven, cli, h in self.conn.execute(f"""
+            SELECT year_month, cod_vendedor, cod_cliente, row_hash
+            FROM fact_facturacion WHERE year_month IN ({ph})
+        """, months):
+            cells.setdefault((ym, ven, cli), set()).add(h)
+        return cells
+
+    def _stage_changed_cells(self):
+        """Load self.changed_cells into the temp table _changed_cells for set-based refreshes."""
+        self.conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS _changed_cells (
+                year_month TEXT, cod_vendedor TEXT, cod_cliente TEXT,
+                PRIMARY KEY (year_month, cod_vendedor, cod_cliente)
+            )
+        """)
+        self.conn.execute("DELETE FROM _changed_cells")
+        self.conn.executemany("INSERT OR IGNORE INTO _changed_cells VALUES (?, ?, ?)", sorted(self.changed_cells))
 
-    def _process_single_facturacion(self, f_fact):
-        """Process a single Facturación TXT file.
+    def _apply_facturacion(self, f_fact, parsed):
+        """Writer side of a Facturación load: apply the normalized batches of
+        parse_facturacion() to SQLite in one transaction.
         Supports two formats:
         - Legacy: COD EMPRESA, FECHA EMISION, CANTIDAD KG, VALOR, COD CENTRALIZADOR
         - Minerva: COD_VENDEDOR, DTA_ENTRADA, QTD_KG_FATURADA, VAL_TOTAL_ITEM, COD_CENTRALIZADOR
         """
-        logging.info(f"Processing Facturacion file: {f_fact.name}")
-
-        try:
-            df = pd.read_csv(f_fact, sep=';', encoding='latin-1', low_memory=False)
-        except Exception:
-            df = pd.read_csv(f_fact, sep=';', encoding='utf-8', low_memory=False)
-
-        df.columns = [str(c).strip().upper() for c in df.columns]
-
-        # --- Detect format ---
-        is_minerva = 'COD_VENDEDOR' in df.columns and 'VAL_TOTAL_ITEM' in df.columns
-        is_legacy  = any('EMPRESA' in col for col in df.columns[:5])
-
-        if not is_minerva and not is_legacy:
-            # Legacy format with missing headers
-            logging.warning(f"  ⚠️  {f_fact.name} missing headers, adding standard headers")
-            standard_headers = [
-                'COD EMPRESA', 'NOM EMPRESA', 'NUM OFICIAL', 'FECHA EMISION', 'DIA', 'HORA', 'FECHA',
-                'COD VENDEDOR', 'NOM VENDEDOR', 'COD CENTRALIZADOR', 'NOM CENTRALIZADOR',
-                'COD CLIENTE', 'NOM CLIENTE', 'COD PRODUCTO VENTA', 'NOM PRODUCTO VENTA',
-                'COD GRUPO COMERCIAL', 'NOM GRUPO COMERCIAL', 'COD SUBGRUPO COMERCIAL',
-                'NOM SUBGRUPO COMERCIAL', 'COD CLASE COMERCIAL', 'NOM CLASE COMERCIAL',
-                'COD FAMILIA COMERCIAL', 'NOM FAMILIA COMERCIAL', 'COD PRODUCTO DOCUMENTO',
-                'NOM PRODUCTO DOCUMENTO', 'UNIDAD MEDIDA', 'CANTIDAD DOCUMENTO', 'CANTIDAD KG',
-                'VALOR', 'VALOR NETO GRAVADO', 'MONEDA', 'COD TIPO NATUREZA', 'NOM TIPO NATUREZA',
-                'ORIGEN DOCUMENTO', 'NOM TEMPLATE', 'PESO PADRON', 'NUM PEDIDO', 'COD.DEPOSITO',
-                'NOMBRE DEPOSITO', 'VENCIMIENTO', 'DESC. CONDICION DE PAGO', 'CONDICION DE PAGO',
-                'CANTIDAD KG BRUTO', 'PRECIO PEDIDO', 'PRECIO TABELA', 'COD. TABELA PRECO',
-                'NOM. TABELA PRECO', 'ORIGEN PEDIDO', 'XCONTENT NRO PUNTO REMITO',
-                'XCONTENT NRO OFICIAL REMITO', 'XCONTENT FECHA DE RENDICIÓN',
-                'COD. TRANSPORTISTA', 'NOM. TRANSPORTISTA', 'UNNAMED: 53'
-            ]
-            df.columns = standard_headers[:len(df.columns)]
-            is_legacy = True
+        logging.info(f"Processing Facturacion file: {f_fact.name} (parsed in {parsed['seconds']:.1f}s)")
+        is_minerva = parsed['layout'] == 'minerva'
+        months = parsed['months']
 
+        before = None
         if is_minerva:
             logging.info(f"  → Detected MINERVA format for {f_fact.name}")
-            return self._process_minerva_facturacion(df, f_fact.name)
-        else:
-            return self._process_legacy_facturacion(df, f_fact.name)
-
-    def _process_legacy_facturacion(self, df, fname):
-        """Insert rows from legacy format (COD EMPRESA, FECHA EMISION, CANTIDAD KG, VALOR)."""
-        rows_inserted = 0
-        for _, row in df.iterrows():
-            raw_vals = [str(v) for v in row.values]
-            row_hash = hashlib.md5("".join(raw_vals).encode()).hexdigest()
-
-            fecha = row.get('FECHA EMISION')
-            if pd.isna(fecha): continue
-
-            try:
-                dt = pd.to_datetime(fecha, dayfirst=True, errors='coerce')
-                if pd.isna(dt): continue
-                ym = dt.strftime('%Y-%m')
-                iso_date = dt.strftime('%Y-%m-%d')
-            except Exception:
-                continue
-
-            self.conn.execute("""
-                INSERT OR IGNORE INTO fact_facturacion
-                (row_hash, fecha_emision, cod_cliente, cod_vendedor, cod_producto, cantidad, importe, deposito, year_month)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                row_hash, iso_date,
-                normalize_key(row.get('COD CENTRALIZADOR')),
-                normalize_key(row.get('COD VENDEDOR')),
-                normalize_key(row.get('COD PRODUCTO VENTA')),
-                coerce_numeric(row.get('CANTIDAD KG')),
-                coerce_numeric(row.get('VALOR')),
-                str(row.get('NOMBRE DEPOSITO', '')).strip(),
-                ym
-            ))
-            rows_inserted += 1
-
+            before = self._cell_fingerprints(months)
+            for ym in months:
+                logging.info(f"  → MINERVA: clearing existing rows for {ym} before reload")
+                self.conn.execute("DELETE FROM fact_facturacion WHERE year_month = ?", (ym,))
+        elif months and self.conn.execute(
+                "SELECT 1 FROM fact_facturacion WHERE source_file = ? LIMIT 1", (f_fact.name,)).fetchone():
+            # Re-exported legacy file (e.g. corrected kg/importe): its new version
+            # replaces the rows the earlier one loaded for the months it covers
+            before = self._cell_fingerprints(months)
+            ph = ','.join(['?'] * len(months))
+            cur = self.conn.execute(f"DELETE FROM fact_facturacion WHERE source_file = ? AND year_month IN ({ph})",
+                                    [f_fact.name] + months)
+            logging.info(f"  → {f_fact.name}: {cur.rowcount} rows of its previous version cleared "
+                         f"({', '.join(sorted(months))})")
+
+        self._loaded_months = set()
+        self._duplicates = []
+        rows_inserted = new_products = 0
+        t0 = time.perf_counter()
+        for batch_path in parsed['batches']:
+            with open(batch_path, 'rb') as fh:
+                rows, products = pickle.load(fh)
+            os.remove(batch_path)
+            rows = self._dedup_facturacion(rows, f_fact.name)
+            if not is_minerva:
+                self._track_new_cells(rows, f_fact.name)
+            self._insert_facturacion(rows, f_fact.name)
+            new_products += self._classify_minerva_products(products, f_fact.name)
+            rows_inserted += len(rows)
         self.conn.commit()
-        logging.info(f"  → {fname}: {rows_inserted} rows inserted/ignored (legacy)")
-        self.processed_files.append(fname)
-        return rows_inserted
+        elapsed = time.perf_counter() - t0
+        self.rows_read += parsed['rows_read']
+        logging.info(f"  → {f_fact.name}: {parsed['rows_read']:,} rows applied in {elapsed:.1f}s "
+                     f"({parsed['rows_read'] / elapsed if elapsed else 0:,.0f} rows/s)")
 
-    def _process_minerva_facturacion(self, df, fname):
-        """Insert rows from Minerva format (COD_VENDEDOR, DTA_ENTRADA, QTD_KG_FATURADA, VAL_TOTAL_ITEM).
-        Minerva files replace the full month — delete existing data first to avoid stale rows.
-        """
-        # Determine months present in the file to clear them first
-        date_col = 'DTA_ENTRADA' if 'DTA_ENTRADA' in df.columns else 'DATA_EMISSAO'
-        df['_dt'] = pd.to_datetime(df[date_col], dayfirst=True, errors='coerce')
-        months_in_file = df['_dt'].dropna().dt.strftime('%Y-%m').unique()
-        for ym in months_in_file:
-            logging.info(f"  → MINERVA: clearing existing rows for {ym} before reload")
-            self.conn.execute("DELETE FROM fact_facturacion WHERE year_month = ?", (ym,))
-        self.conn.commit()
-
-        rows_inserted = 0
-        for _, row in df.iterrows():
-            raw_vals = [str(v) for v in row.values]
-            row_hash = hashlib.md5("".join(raw_vals).encode()).hexdigest()
-
-            # Pick best date field
-            dt = row.get('_dt')
-            if pd.isna(dt): continue
-
-            ym = dt.strftime('%Y-%m')
-            iso_date = dt.strftime('%Y-%m-%d')
-
-            cantidad = coerce_numeric(row.get('QTD_KG_FATURADA', 0))
-            importe  = coerce_numeric(row.get('VAL_TOTAL_ITEM', 0))
-            if importe == 0: continue  # skip lines with no value
+        if is_minerva:
+            logging.info(f"  → {f_fact.name}: {rows_inserted} rows inserted (minerva, full reload)")
+        else:
+            logging.info(f"  → {f_fact.name}: {rows_inserted} rows inserted/ignored (legacy)")
+        if before is not None:
+            after = self._cell_fingerprints(months)
+            changed = {c for c in before.keys() | after.keys() if before.get(c) != after.get(c)}
+            self.changed_cells |= changed
+            logging.info(f"  → {f_fact.name}: {len(changed)} of {len(after)} (month, vendor, client) cells changed")
+        if is_minerva and new_products:
+            logging.info(f"  → Auto-classified {new_products} new products from Minerva file")
+        self._report_duplicates(f_fact.name)
+        self.processed_files.append(f_fact.name)
+        self.record_source(f_fact, 'facturacion', layout=parsed['layout'], rows=rows_inserted,
+                           months=sorted(set(months) | self._loaded_months))
+        return rows_inserted
 
-            self.conn.execute("""
+    def _dedup_facturacion(self, rows, source_file):
+        """Rows of a batch to insert: one per line_key (the first, in memory), none
+        whose line_key a stored row with a different row_hash holds (the same
+        invoice line loaded from another file, e.g. a daily and a monthly export,
+        or from an earlier chunk of this one). The lines skipped are queued for
+        etl_facturacion_duplicates with the file of the line kept."""
+        batch = {}
+        unique, duplicates = [], []
+        for r in rows:
+            key = r[9]
+            if key is None:
+                unique.append(r)
+            elif key not in batch:
+                batch[key] = r
+                unique.append(r)
+            elif batch[key][0] != r[0]:  # same row_hash: INSERT OR IGNORE would skip it anyway
+                duplicates.append(self._duplicate(r, source_file, source_file, batch[key][5:7]))
+        stored = {}
+        keys = list(batch)
+        for lo in range(0, len(keys), 900):
+            chunk = keys[lo:lo + 900]
+            ph = ','.join(['?'] * len(chunk))
+            stored.update((k, (h, cant, imp, src)) for k, h, cant, imp, src in self.conn.execute(
+                f"SELECT line_key, row_hash, cantidad, importe, source_file FROM fact_facturacion "
+                f"WHERE line_key IN ({ph})", chunk))
+
+        kept = []
+        for r in unique:
+            found = stored.get(r[9]) if r[9] is not None else None
+            if found is None or found[0] == r[0]:
+                kept.append(r)  # new, or this very row again (INSERT OR IGNORE skips it)
+                continue
+            duplicates.append(self._duplicate(r, source_file, found[3], found[1:3]))
+        if duplicates:
+            self.conn.executemany("""
+                INSERT INTO etl_facturacion_duplicates
+                (run_id, source_file, stored_file, line_key, fecha_emision, cod_cliente, cod_producto,
+                 cantidad, importe, same_amounts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, duplicates)
+            self._duplicates.extend(duplicates)
+        return kept
+
+    def _duplicate(self, r, source_file, stored_file, kept_amounts):
+        """etl_facturacion_duplicates row of skipped line r; kept_amounts: (cantidad,
+        importe) of the line kept."""
+        same = np.allclose(np.array(kept_amounts, dtype=float), r[5:7], rtol=0, atol=1e-6, equal_nan=True)  # NaN stored as NULL
+        return (self.run_id, source_file, stored_file, r[9], r[1], r[2], r[4], r[5], r[6], int(same))
+
+    def _report_duplicates(self, source_file):
+        """Log the lines _dedup_facturacion skipped for source_file, by where the
+        line kept came from."""
+        if not self._duplicates:
+            return
+        groups = {}
+        for d in self._duplicates:
+            where = ('repeated within the file' if d[2] == source_file
+                     else 'loaded before source files were tracked (--full re-tags them)' if d[2] is None
+                     else 'already loaded from another file')
+            total, differ = groups.get(where, (0, 0))
+            groups[where] = (total + 1, differ + (not d[-1]))
+        for where, (total, differ) in groups.items():
+            logging.warning(f"  → {source_file}: {total} invoice line(s) {where} skipped "
+                            f"({differ} with different kg/importe); listed in etl_facturacion_duplicates")
+
+    def _track_new_cells(self, rows, source_file):
+        """Add the cells of legacy rows not stored yet to changed_cells
+        (INSERT OR IGNORE keeps the existing ones). Stored rows loaded before
+        line_key/source_file existed get them now (etl.py --full backfills every
+        file)."""
+        existing, untagged = set(), set()
+        for lo in range(0, len(rows), 900):
+            chunk = [r[0] for r in rows[lo:lo + 900]]
+            ph = ','.join(['?'] * len(chunk))
+            for h, key, src in self.conn.execute(
+                    f"SELECT row_hash, line_key, source_file FROM fact_facturacion WHERE row_hash IN ({ph})", chunk):
+                existing.add(h)
+                if key is None or src is None:
+                    untagged.add(h)
+        self.changed_cells.update((r[8], r[3], r[2]) for r in rows if r[0] not in existing)
+        self.conn.executemany("""
+            UPDATE OR IGNORE fact_facturacion
+            SET line_key = COALESCE(line_key, ?), source_file = COALESCE(source_file, ?)
+            WHERE row_hash = ?
+        """, [(r[9], source_file, r[0]) for r in rows if r[0] in untagged])
+
+    def _insert_facturacion(self, rows, source_file):
+        """Chunked INSERT OR IGNORE into fact_facturacion; the caller commits."""
+        self._loaded_months.update(r[8] for r in rows)
+        for lo in range(0, len(rows), FACT_INSERT_CHUNK):
+            self.conn.executemany("""
                 INSERT OR IGNORE INTO fact_facturacion
-                (row_hash, fecha_emision, cod_cliente, cod_vendedor, cod_producto, cantidad, importe, deposito, year_month)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                row_hash, iso_date,
-                normalize_key(row.get('COD_CENTRALIZADOR')),
-                normalize_key(str(row.get('COD_VENDEDOR', ''))),
-                normalize_key(str(row.get('COD_ITEM', ''))),
-                cantidad,
-                importe,
-                str(row.get('DEPOSITO', '')).strip(),
-                ym
-            ))
-            rows_inserted += 1
-
-        self.conn.commit()
-        logging.info(f"  → {fname}: {rows_inserted} rows inserted (minerva, full reload)")
-        self.processed_files.append(fname)
-
-        # ── Auto-classify new products found in this Minerva file ─────────────
-        # Map Minerva product family strings to our internal categoria
-        MINERVA_FAMILY_MAP = {
-            'PAPAS':        'PAPAS',
-            'HAMBURGUESA':  'HAMBURGUESAS',
-            'MEDALLON':     'HAMBURGUESAS',
-            'CHORIZO':      'EMBUTIDOS',
-            'SALCHICHA':    'EMBUTIDOS',
-            'EMBUTIDO':     'EMBUTIDOS',
-            'REBOZADO':     'REBOZADOS',
-            'MILANESA':     'REBOZADOS',
-            'BOCADITO':     'REBOZADOS',
-            'VEGGIE':       'VEGGIES',
-            'VEGETAL':      'VEGGIES',
-            'UNTABLE':      'UNTABLES',
-            'PICADILLO':    'UNTABLES',
-            'ATUN':         'PESCADOS',
-            'PESCADO':      'PESCADOS',
-            'GRASA':        'BOVINOS',
-            'HUESO':        'BOVINOS',
-            'LOMO':         'BOVINOS',
-            'CARNE':        'BOVINOS',
-            'CUERO':        'BOVINOS',
-        }
-
-        new_products = 0
-        if 'COD_ITEM' in df.columns and 'DES_ITEM' in df.columns:
-            seen = set()
-            for _, row in df.iterrows():
-                cod = normalize_key(str(row.get('COD_ITEM', '')))
-                if not cod or cod in seen:
-                    continue
-                seen.add(cod)
-                existing = self.conn.execute(
-                    "SELECT 1 FROM dim_product_classification WHERE cod_producto = ?", (cod,)
-                ).fetchone()
-                if existing:
-                    continue
-                desc = str(row.get('DES_ITEM', '')).strip().upper()
-                familia = str(row.get('FAMILIA_COMERCIAL', '')).strip().upper() if 'FAMILIA_COMERCIAL' in df.columns else ''
-                # Determine categoria
-                cat = None
-                for keyword, mapped_cat in MINERVA_FAMILY_MAP.items():
-                    if keyword in desc or keyword in familia:
-                        cat = mapped_cat
-                        break
-                if cat:
-                    self.conn.execute("""
-                        INSERT OR IGNORE INTO dim_product_classification
-                        (cod_producto, descripcion, categoria, subcategoria)
-                        VALUES (?, ?, ?, ?)
-                    """, (cod, desc.title(), cat, 'COMMODITY'))
-                    new_products += 1
-
-            if new_products:
-                self.conn.commit()
-                logging.info(f"  → Auto-classified {new_products} new products from Minerva file")
-
-        return rows_inserted
+                (row_hash, fecha_emision, cod_cliente, cod_vendedor, cod_producto, cantidad, importe, deposito,
+                 year_month, line_key, cod_vendedor_orig, cod_cliente_orig, source_file)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [r + (source_file,) for r in rows[lo:lo + FACT_INSERT_CHUNK]])
+
+    def _classify_minerva_products(self, products, source_file=None):
+        """Auto-classify new products of a Minerva file. `products` holds the first
+        (cod, descripcion, familia) of each code, see minerva_product_candidates().
+        Codes no keyword matches go to etl_unclassified_products for review.
+        Returns products added."""
+        if self._product_codes is None:
+            self._product_codes = {c for (c,) in self.conn.execute("SELECT cod_producto FROM dim_product_classification")}
+        new = [p for p in products if p[0] not in self._product_codes]
+        if not new:
+            return 0
+
+        classified, unclassified = [], []
+        for (cod, desc, familia), cat in zip(new, classify_minerva_products(new)):
+            if cat:
+                classified.append((cod, desc.title(), cat, 'COMMODITY'))
+            else:
+                unclassified.append((cod, desc, familia, source_file, self.run_id))
+        self.conn.executemany("""
+            INSERT OR IGNORE INTO dim_product_classification
+            (cod_producto, descripcion, categoria, subcategoria)
+            VALUES (?, ?, ?, ?)
+        """, classified)
+        self._product_codes.update(r[0] for r in classified)
+        self.conn.executemany("""
+            INSERT INTO etl_unclassified_products (cod_producto, descripcion, familia, source_file, run_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(cod_producto) DO UPDATE SET
+                descripcion=excluded.descripcion,
+                familia=excluded.familia,
+                source_file=excluded.source_file,
+                run_id=excluded.run_id,
+                last_seen=CURRENT_TIMESTAMP
+        """, unclassified)
+        if unclassified:
+            logging.warning(f"  → {len(unclassified)} new product(s) matched no category keyword; "
+                            f"listed in etl_unclassified_products")
+        return len(classified)
 
 
     def match_client(self, cod_cliente, nom_cliente, cod_centralizador):
-        """Robust matching logic as per specs."""
-        cursor = self.conn.cursor()
-        
-        # 1. Primary: ID Match
-        cursor.execute("SELECT frecuencia FROM dim_clients WHERE cliente_id = ?", (cod_cliente,))
-        res = cursor.fetchone()
-        if res: return res[0], "id"
-
-        # 2. Secondary: Centralizador Match
-        if cod_centralizador:
-            cursor.execute("SELECT frecuencia FROM dim_clients WHERE cod_centralizador = ? LIMIT 1", (cod_centralizador,))
-            res = cursor.fetchone()
-            if res: return res[0], "centralizador"
-
-        # 3. Tertiary: Normalized Name Match
-        norm_name = normalize_text(nom_cliente)
-        if norm_name:
-            cursor.execute("SELECT cliente_id, frecuencia, cliente_name FROM dim_clients")
-            all_clients = cursor.fetchall()
-            matches = [c for c in all_clients if normalize_text(c[2]) == norm_name]
-            
-            if len(matches) == 1:
-                return matches[0][1], "name"
-            elif len(matches) > 1:
-                logging.warning(f"AMBIGUOUS_NAME_MATCH for {nom_cliente} ({cod_cliente}). Picking first.")
-                return matches[0][1], "name"
-
-        return None, "unmatched"
+        """Robust matching logic as per specs (see ClientMatcher): id → centralizador
+        → normalized name → optional fuzzy name."""
+        if self.client_matcher is None:
+            self.client_matcher = ClientMatcher.from_db(self.conn, self.fuzzy_threshold)
+        return self.client_matcher.match(cod_cliente, nom_cliente, cod_centralizador)
+
+    def report_ambiguous_matches(self):
+        """Store the ambiguous name matches of this run in etl_unmatched_clients
+        (one executemany) and log a single summary line."""
+        ambiguous = self.client_matcher.ambiguous if self.client_matcher else []
+        if not ambiguous:
+            return
+        self.conn.executemany("""
+            INSERT INTO etl_unmatched_clients (run_id, year_month, cod_cliente, nom_cliente, cod_centralizador, reason)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (self.run_id, self.target_month, cod, nom, cod,
+             f"AMBIGUOUS_{quality.upper()}_MATCH: picked {ids[0]} of {', '.join(ids)}")
+            for cod, nom, quality, ids in ambiguous
+        ])
+        sample = ', '.join(f"{nom} ({cod})" for cod, nom, _, _ in ambiguous[:5])
+        logging.warning(f"AMBIGUOUS_NAME_MATCH for {len(ambiguous)} rows, first candidate picked: {sample}"
+                        + (" ..." if len(ambiguous) > 5 else ""))
+        ambiguous.clear()
 
     def process_avance_vendedor(self):
         f_path = self.find_file(REQUIRED_FILES['avance_vendedor'])
@@ -837,7 +2369,7 @@ class SalesETL:
             return
 
         # ── Phase 1: load historical columns first to derive target_month ──
-        df_pre = pd.read_excel(f_path, header=1)
+        df_pre = self.workbooks.parse(f_path, header=1)
         df_pre.columns = [str(c).strip().upper() for c in df_pre.columns]
         self.process_cliente_historico(df_pre)
 
@@ -864,9 +2396,10 @@ class SalesETL:
 
         logging.info(f"Target Month: {self.target_month} for file {f_path.name}")
 
-        # Header is at row 1
-        df = pd.read_excel(f_path, header=1)
+        # Header is at row 1 (same frame as df_pre, parsed once)
+        df = self.workbooks.parse(f_path, header=1)
         df.columns = [str(c).strip().upper() for c in df.columns]
+        self.rows_read += len(df)
         logging.info(f"Avance columns: {list(df.columns)[:15]}")
         
         self.conn.execute("DELETE FROM fact_avance_cliente_vendedor_month WHERE year_month = ?", (self.target_month,))
@@ -895,12 +2428,22 @@ class SalesETL:
         
         logging.info(f"Using sales column: {sales_col}")
 
+        # Client index built once per load (dim_clients was refreshed by process_dimensions)
+        self.client_matcher = ClientMatcher.from_db(self.conn, self.fuzzy_threshold)
+        logging.info(f"Client matcher: {len(self.client_matcher)} clients indexed"
+                     + (f", fuzzy names >= {self.fuzzy_threshold}" if self.fuzzy_threshold else ""))
+
+        vendor_aliases, client_aliases = self.aliases.get('vendor', {}), self.aliases.get('client', {})
         for _, row in df.iterrows():
-            c_id = normalize_key(row.get('COD CENTRALIZADOR'))
+            c_raw = normalize_key(row.get('COD CENTRALIZADOR'))
             c_name = row.get('NOM CENTRALIZADOR')
             
-            if not c_id or pd.isna(c_id): continue
+            if not c_raw or pd.isna(c_raw): continue
             if c_name and "TOTAL" in str(c_name).upper(): continue
+
+            c_id = client_aliases[c_raw][0] if c_raw in client_aliases else c_raw
+            v_raw = normalize_key(row.get('COD VENDEDOR'))
+            v_id, v_name = vendor_aliases.get(v_raw, (v_raw, None))
             
             frec, quality = self.match_client(c_id, c_name, c_id)
             
@@ -916,22 +2459,27 @@ class SalesETL:
                 str(row.get('CANAL', '')).strip(),
                 str(row.get('ZONA', '')).strip(),
                 str(row.get('JEFE', '')).strip(),
-                normalize_key(row.get('COD VENDEDOR')),
-                row.get('NOM VENDEDOR'),
+                v_id,
+                v_name or row.get('NOM VENDEDOR'),
                 c_id,
                 c_name,
-                c_id,
+                c_raw,
                 coerce_numeric(row.get(sales_col) if sales_col else 0),
                 coerce_numeric(row.get('OBJETIVO')),
                 coerce_numeric(row.get('PENDIENTE')),
                 frec,
-                quality
+                quality,
+                v_raw if v_id != v_raw else None,
+                c_raw if c_id != c_raw else None,
+                row.get('NOM VENDEDOR') if v_id != v_raw else None
             ))
 
+        self.report_ambiguous_matches()
         self.conn.executemany("""
             INSERT INTO fact_avance_cliente_vendedor_month 
-            (year_month, canal, zona, jefe, cod_vendedor, nom_vendedor, cod_cliente, nom_cliente, cod_centralizador, venta_actual, objetivo, pendiente, frecuencia, match_quality)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (year_month, canal, zona, jefe, cod_vendedor, nom_vendedor, cod_cliente, nom_cliente, cod_centralizador, venta_actual, objetivo, pendiente, frecuencia, match_quality,
+             cod_vendedor_orig, cod_cliente_orig, nom_vendedor_orig)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, rows_data)
         
         self.conn.commit()
@@ -950,7 +2498,7 @@ class SalesETL:
 
         # Historical columns were already loaded in Phase 1 (top of this method)
         
-    def sync_facturacion_to_avance(self):
+    def sync_facturacion_to_avance(self, only_changed=False):
         """Update venta_actual in fact_avance_cliente_vendedor_month using the real 
         sum of KG from fact_facturacion for the current target month.
         This fixes discrepancies where the Avance Excel is late compared to the TXT.
@@ -959,12 +2507,21 @@ class SalesETL:
         1. Primary: match by (cod_cliente, cod_vendedor) — handles normal account assignments.
         2. Fallback: match by cod_cliente alone for rows where avance.cod_vendedor is NULL/empty
            (e.g. national chains like INC SA, DIA, CENCOSUD that have no assigned account vendor).
+
+        only_changed: restrict the update to clients with changed facturación cells
+        (incremental refresh; the avance rows were not reloaded).
         """
         ym = self.target_month
-        logging.info(f"Syncing Facturacion KG to Avance table for {ym}")
+        logging.info(f"Syncing Facturacion KG to Avance table for {ym}"
+                     + (" (changed clients only)" if only_changed else ""))
+        scope = ""
+        if only_changed:
+            self._stage_changed_cells()
+            scope = "AND cod_cliente IN (SELECT cod_cliente FROM _changed_cells WHERE year_month = ?)"
+        scope_params = (ym,) if only_changed else ()
 
         # Pass 1: exact (client + vendor) match
-        cur1 = self.conn.execute("""
+        cur1 = self.conn.execute(f"""
             WITH real_sales AS (
                 SELECT cod_cliente, cod_vendedor, ROUND(SUM(cantidad), 2) as total_kg
                 FROM fact_facturacion
@@ -984,11 +2541,12 @@ class SalesETL:
                 WHERE real_sales.cod_cliente = fact_avance_cliente_vendedor_month.cod_cliente
                   AND real_sales.cod_vendedor = fact_avance_cliente_vendedor_month.cod_vendedor
               )
-        """, (ym, ym))
+              {scope}
+        """, (ym, ym) + scope_params)
         logging.info(f"  Pass 1 (client+vendor match): {cur1.rowcount} rows updated")
 
         # Pass 2: client-only match for national chains / rows with no vendor code
-        cur2 = self.conn.execute("""
+        cur2 = self.conn.execute(f"""
             WITH real_sales_by_client AS (
                 SELECT cod_cliente, ROUND(SUM(cantidad), 2) as total_kg
                 FROM fact_facturacion
@@ -1006,12 +2564,52 @@ class SalesETL:
                 SELECT 1 FROM real_sales_by_client
                 WHERE real_sales_by_client.cod_cliente = fact_avance_cliente_vendedor_month.cod_cliente
               )
-        """, (ym, ym))
+              {scope}
+        """, (ym, ym) + scope_params)
         logging.info(f"  Pass 2 (client-only fallback for null vendor): {cur2.rowcount} rows updated")
 
         self.conn.commit()
         logging.info("Facturacion KG synced to Avance table.")
 
+    def refresh_daily_cube(self):
+        """Rebuild the fact_facturacion_diaria cells touched by this run
+        (full rebuild when the cube is empty)."""
+        empty = self.conn.execute("SELECT 1 FROM fact_facturacion_diaria LIMIT 1").fetchone() is None
+        if empty:
+            self.conn.execute("DELETE FROM fact_facturacion_diaria")
+            cur = self.conn.execute("""
+                INSERT INTO fact_facturacion_diaria
+                (year_month, cod_vendedor, cod_cliente, fecha_emision, kg, importe, lineas)
+                SELECT year_month, cod_vendedor, cod_cliente, fecha_emision,
+                       SUM(cantidad), SUM(importe), COUNT(*)
+                FROM fact_facturacion
+                GROUP BY year_month, cod_vendedor, cod_cliente, fecha_emision
+            """)
+            self.conn.commit()
+            logging.info(f"Daily cube rebuilt: {cur.rowcount} rows")
+            return
+        if not self.changed_cells:
+            logging.info("Daily cube: no facturación cells changed")
+            return
+
+        self._stage_changed_cells()
+        self.conn.execute("""
+            DELETE FROM fact_facturacion_diaria
+            WHERE (year_month, cod_vendedor, cod_cliente) IN (SELECT year_month, cod_vendedor, cod_cliente FROM _changed_cells)
+        """)
+        cur = self.conn.execute("""
+            INSERT INTO fact_facturacion_diaria
+            (year_month, cod_vendedor, cod_cliente, fecha_emision, kg, importe, lineas)
+            SELECT f.year_month, f.cod_vendedor, f.cod_cliente, f.fecha_emision,
+                   SUM(f.cantidad), SUM(f.importe), COUNT(*)
+            FROM _changed_cells c
+            JOIN fact_facturacion f
+              ON f.year_month = c.year_month AND f.cod_vendedor = c.cod_vendedor AND f.cod_cliente = c.cod_cliente
+            GROUP BY f.year_month, f.cod_vendedor, f.cod_cliente, f.fecha_emision
+        """)
+        self.conn.commit()
+        logging.info(f"Daily cube: {len(self.changed_cells)} cells refreshed ({cur.rowcount} day rows)")
+
     def process_cliente_historico(self, df):
 
         """Extract historical monthly sales from Avance x Cliente-Vendedor columns."""
@@ -1088,15 +2686,15 @@ class SalesETL:
             logging.warning("Avance x Cliente-Vendedor not found for category processing!")
             return
         
-        # Category sheets to process
-        category_sheets = ['HB', 'SCH', 'UNT', 'RB', 'SJ', 'GRASA', 'PICADA', 'CHORIZOS', 'PAPAS', 'ATUN', 'CORTES CARNE']
-        
         # Dictionary to accumulate facturacion by (cod_cliente, cod_vendedor)
         client_facturacion = {}
+        # Same codes as the avance rows: aliases resolved
+        vendor_aliases, client_aliases = self.alias_codes('vendor'), self.alias_codes('client')
         
-        for sheet in category_sheets:
+        for sheet in CATEGORY_SHEETS:
             try:
-                df = pd.read_excel(f_path, sheet_name=sheet, header=2)
+                df = self.workbooks.parse(f_path, sheet_name=sheet, header=2)
+                self.rows_read += len(df)
                 logging.info(f"Processing sheet: {sheet}")
                 
                 # Find FACTURACIÓN column (should be column AA, index 26)
@@ -1113,6 +2711,8 @@ class SalesETL:
                 for _, row in df.iterrows():
                     cod_cli = normalize_key(row.get('COD CENTRALIZADOR'))
                     cod_ven = normalize_key(row.get('COD VENDEDOR'))
+                    cod_cli = client_aliases.get(cod_cli, cod_cli)
+                    cod_ven = vendor_aliases.get(cod_ven, cod_ven)
                     facturacion = coerce_numeric(row.get(fact_col))
                     
                     if cod_cli and cod_ven and facturacion > 0:
@@ -1150,57 +2750,9 @@ class SalesETL:
         KG targets) as the denominator, NOT objetivo_kg from vendedor_objetivos.
         This is safer because objetivo_kg in vendedor_objetivos may be entered incorrectly
         (e.g. accidentally set to rebozados_kg instead of total KG).
+        Custom crm_cliente_ponderacion overrides win; see objective_allocation.
         """
-        cursor = self.conn.cursor()
-
-        vendors = cursor.execute("""
-            SELECT cod_vendedor, objetivo_pesos, objetivo_premium_pesos, objetivo_kg
-            FROM vendedor_objetivos
-        """).fetchall()
-
-        updates = 0
-        for vendor in vendors:
-            cod_ven, obj_pesos, obj_premium, obj_kg = vendor
-
-            if not obj_pesos or obj_pesos == 0:
-                continue
-
-            # Use SUM of actual client KG objectives as the base — always consistent
-            # with the avance table, regardless of what was entered in vendedor_objetivos.
-            sum_row = cursor.execute("""
-                SELECT SUM(objetivo) as total_kg
-                FROM fact_avance_cliente_vendedor_month
-                WHERE cod_vendedor = ? AND year_month = ? AND objetivo > 0
-            """, (cod_ven, self.target_month)).fetchone()
-            base_kg = sum_row['total_kg'] if sum_row and sum_row['total_kg'] else 0
-
-            # Fall back to objetivo_kg only if no client objectives found
-            if base_kg == 0:
-                base_kg = obj_kg or 0
-            if base_kg == 0:
-                continue
-
-            clients = cursor.execute("""
-                SELECT cod_cliente, objetivo
-                FROM fact_avance_cliente_vendedor_month
-                WHERE cod_vendedor = ? AND year_month = ?
-            """, (cod_ven, self.target_month)).fetchall()
-
-            for cod_cli, cliente_kg in clients:
-                if not cliente_kg or cliente_kg == 0:
-                    continue
-
-                proportion = min(cliente_kg / base_kg, 1.0)  # cap at 100% to prevent overflow
-                cliente_obj_pesos   = (obj_pesos or 0)   * proportion
-                cliente_obj_premium = (obj_premium or 0) * proportion
-
-                cursor.execute("""
-                    UPDATE fact_avance_cliente_vendedor_month
-                    SET objetivo_pesos = ?, objetivo_premium_pesos = ?
-                    WHERE cod_cliente = ? AND cod_vendedor = ? AND year_month = ?
-                """, (cliente_obj_pesos, cliente_obj_premium, cod_cli, cod_ven, self.target_month))
-                updates += cursor.rowcount
-
+        updates = allocate_monetary_objectives(self.conn, self.target_month)
         self.conn.commit()
         logging.info(f"Calculated monetary objectives for {updates} client records")
 
@@ -1218,40 +2770,76 @@ class SalesETL:
         self.conn.commit()
         logging.info(f"Seeded empty objectives for GENTILE NICOLAS ({self.target_month}) if not exists")
 
-    def apply_vendor_aliases(self):
-        """Unify vendor codes: remap Perotti codes to Gentile. Also normalize .0 suffix."""
-        # First normalize all .0 suffixes in fact_facturacion cod_vendedor
-        self.conn.execute("""
-            UPDATE fact_facturacion
-            SET cod_vendedor = SUBSTR(cod_vendedor, 1, LENGTH(cod_vendedor)-2)
-            WHERE cod_vendedor LIKE '%.0' AND CAST(SUBSTR(cod_vendedor, 1, LENGTH(cod_vendedor)-2) AS INTEGER) > 0
-        """)
-        self.conn.commit()
-        logging.info("Normalized .0 suffix in fact_facturacion cod_vendedor")
+    def apply_aliases(self):
+        """Re-key the stored rows of the aliases added, changed or removed since the
+        last run (alias_changes). The loaders resolve aliases as they normalize
+        each row, so only rows loaded under a different alias state are touched:
+        those holding the alias code, or remapped from it (<column>_orig), found
+        through the code indexes. Their facturación cells go to changed_cells."""
+        changes = self.alias_changes()
+        first_run = self.conn.execute("SELECT 1 FROM etl_alias_applied LIMIT 1").fetchone() is None
+        if first_run:
+            # Codes loaded as '123.0' before normalize_key (one-time cleanup)
+            cur = self.conn.execute("""
+                UPDATE fact_facturacion
+                SET cod_vendedor = SUBSTR(cod_vendedor, 1, LENGTH(cod_vendedor)-2)
+                WHERE cod_vendedor LIKE '%.0' AND CAST(SUBSTR(cod_vendedor, 1, LENGTH(cod_vendedor)-2) AS INTEGER) > 0
+            """)
+            if cur.rowcount:
+                logging.info(f"Normalized .0 suffix of {cur.rowcount} fact_facturacion cod_vendedor")
+            # Daily cube cells built before the old remap ran: still under the alias
+            # code, missing from the cell of the code it maps to
+            vendors, clients = self.alias_codes('vendor'), self.alias_codes('client')
+            for kind, column in (('vendor', 'cod_vendedor'), ('client', 'cod_cliente')):
+                codes = list(self.aliases.get(kind, {}))
+                for lo in range(0, len(codes), 900):
+                    chunk = codes[lo:lo + 900]
+                    for ym, ven, cli in self.conn.execute(
+                            f"SELECT DISTINCT year_month, cod_vendedor, cod_cliente FROM fact_facturacion_diaria "
+                            f"WHERE {column} IN ({','.join('?' * len(chunk))})", chunk):
+                        self.changed_cells.update({(ym, ven, cli), (ym, vendors.get(ven, ven), clients.get(cli, cli))})
+        if not any(changes.values()):
+            logging.info("Aliases: no change since the last run")
+            return
 
-        # Then remap aliases (Perotti, Vacante Santa Fe → Gentile)
-        aliases = [
-            ('100075864', '100067806', 'GENTILE NICOLAS'),
-            ('100075865', '100067806', 'GENTILE NICOLAS'),
-            ('100089597', '100067806', 'GENTILE NICOLAS'),  # VACANTE SANTA FE IND
-        ]
-        total_avance = 0
-        total_fact   = 0
-        for src, dst, dst_name in aliases:
-            cur = self.conn.execute(
-                "UPDATE fact_avance_cliente_vendedor_month SET cod_vendedor=?, nom_vendedor=? WHERE cod_vendedor IN (?,?)",
-                (dst, dst_name, src, src + '.0')
-            )
-            total_avance += cur.rowcount
-            cur2 = self.conn.execute(
-                "UPDATE fact_facturacion SET cod_vendedor=? WHERE cod_vendedor IN (?,?)",
-                (dst, src, src + '.0')
-            )
-            total_fact += cur2.rowcount
+        totals = {}
+        for kind, changed in changes.items():
+            if not changed:
+                continue
+            params = []  # (code, orig, name, alias, alias)
+            for alias, target in changed.items():
+                code, name = target or (alias, None)  # removed: the rows get their own code back
+                params.append((code, alias if target else None, name, alias, alias))
+            for table, column, name_column in ALIAS_COLUMNS[kind]:
+                # ?1..?5: (code, orig, name, alias, alias)
+                match = f"{column}_orig = ?4 OR ({column} = ?5 AND {column}_orig IS NULL)"
+                cells = f"SELECT DISTINCT year_month, cod_vendedor, cod_cliente FROM {table} WHERE {match}"
+                track = table == 'fact_facturacion'
+                if track:
+                    for p in params:
+                        self.changed_cells.update(map(tuple, self.conn.execute(cells, p)))
+                # A removed alias (?2 NULL) gives the rows their own name back
+                name_set = f"""
+                    , {name_column} = CASE WHEN ?2 IS NULL THEN COALESCE({name_column}_orig, {name_column})
+                                           ELSE COALESCE(?3, {name_column}) END
+                    , {name_column}_orig = CASE WHEN ?2 IS NULL THEN NULL
+                                                WHEN {column}_orig IS NULL THEN {name_column}
+                                                ELSE {name_column}_orig END""" if name_column else ""
+                changes_before = self.conn.total_changes
+                self.conn.executemany(
+                    f"UPDATE {table} SET {column} = ?1, {column}_orig = ?2{name_set} WHERE {match}", params)
+                totals[table] = totals.get(table, 0) + self.conn.total_changes - changes_before
+                if track:
+                    for p in params:
+                        self.changed_cells.update(map(tuple, self.conn.execute(cells, p)))
+            logging.info(f"Aliases: {len(changed)} {kind} alias(es) added/changed/removed")
+
+        self.conn.execute("DELETE FROM etl_alias_applied")
+        self.conn.executemany("INSERT INTO etl_alias_applied (kind, alias_code, code, name) VALUES (?, ?, ?, ?)",
+                              [(kind, alias, code, name) for kind, aliases in self.aliases.items()
+                               for alias, (code, name) in aliases.items()])
         self.conn.commit()
-        logging.info(f"Vendor aliases: {total_avance} avance, {total_fact} facturacion rows remapped to Gentile")
-
-
+        logging.info("Aliases: re-keyed " + ', '.join(f"{n} {t}" for t, n in totals.items()) + " rows")
 
     def process_lanzamientos(self):
         """Process Compradores Lanzamientos.xlsx — one sheet per launch product.
@@ -1259,17 +2847,15 @@ class SalesETL:
           - Current month (FEB '26): full estado + fact/pend/total/promedio
           - Historical months (ENE '26, DIC '25, etc.): kg per client per month
         """
-        f_path = self.find_file(r'Compradores Lanzamientos.*\.xlsx')
+        f_path = self.find_file(REQUIRED_FILES['lanzamientos'])
         if not f_path:
             logging.warning("Compradores Lanzamientos not found, skipping.")
             return
 
         logging.info(f"Processing Lanzamientos from {f_path.name}")
-        xls = pd.ExcelFile(f_path)
-
         # Sheets to process (skip summary/dynamic sheets)
-        skip = {'DINAMICA ENERO 26', 'DINAMICA'}
-        sheets = [s for s in xls.sheet_names if s.upper() not in {x.upper() for x in skip}]
+        skip = {x.upper() for x in LANZAMIENTO_SKIP_SHEETS}
+        sheets = [s for s in self.workbooks.sheet_names(f_path) if s.upper() not in skip]
 
         # Clear existing data for target month only
         ym = self.target_month or f'{self.year}-{datetime.now().month:02d}'
@@ -1300,8 +2886,19 @@ class SalesETL:
 
         for sheet in sheets:
             try:
-                df = pd.read_excel(xls, sheet_name=sheet, header=1)
+                df = self.workbooks.parse(f_path, sheet_name=sheet, header=1)
                 df.columns = [str(c).strip() for c in df.columns]
+                self.rows_read += len(df)
+
+                # Client rows: a COD CENTRALIZADOR and not a TOTAL line
+                col = raw_column(df, df.values)
+                cod_cli = np.array(normalize_keys(col('COD CENTRALIZADOR')), dtype=object)
+                nom = np.char.strip(col('NOM CENTRALIZADOR', '').astype(str))
+                keep = np.flatnonzero((cod_cli != '') & (np.char.find(np.char.upper(nom), 'TOTAL') < 0))
+                text = lambda name: np.char.strip(col(name, '').astype(str))[keep].tolist()
+                cod_cli, nom = cod_cli[keep].tolist(), nom[keep].tolist()
+                cod_ven = np.array(normalize_keys(col('COD VENDEDOR')), dtype=object)[keep].tolist()
+                nom_ven, canal, zona = text('NOM VENDEDOR'), text('CANAL'), text('ZONA')
 
                 # ── Current month: ESTADO + fact/pend/total/promedio ─────────
                 if 'ESTADO' not in df.columns:
@@ -1331,38 +2928,12 @@ class SalesETL:
                         total_col = next((c for c in df.columns if 'TOTAL' in c.upper()
                                           and 'FACT' not in c.upper() and 'PEND' not in c.upper()), None)
 
-
-                    rows_cur = []
-                    for _, row in df.iterrows():
-                        cod_cli = normalize_key(row.get('COD CENTRALIZADOR'))
-                        if not cod_cli or pd.isna(cod_cli): continue
-                        nom = row.get('NOM CENTRALIZADOR', '')
-                        if pd.notna(nom) and 'TOTAL' in str(nom).upper(): continue
-
-                        estado = str(row.get('ESTADO', '')).strip()
-                        if 'COMPRADOR' in estado.upper() and 'SIN' not in estado.upper() and 'NO' not in estado.upper():
-                            estado_norm = 'COMPRADOR'
-                        elif 'SIN COMPRA' in estado.upper():
-                            estado_norm = 'SIN COMPRA'
-                        elif 'NO COMPRADOR' in estado.upper():
-                            estado_norm = 'NO COMPRADOR'
-                        else:
-                            estado_norm = estado or 'DESCONOCIDO'
-
-                        rows_cur.append((
-                            ym, sheet,
-                            normalize_key(row.get('COD VENDEDOR')),
-                            str(row.get('NOM VENDEDOR', '')).strip(),
-                            cod_cli,
-                            str(nom).strip(),
-                            str(row.get('CANAL', '')).strip(),
-                            str(row.get('ZONA', '')).strip(),
-                            estado_norm,
-                            coerce_numeric(row.get(fact_col))  if fact_col  else 0,
-                            coerce_numeric(row.get(pend_col))  if pend_col  else 0,
-                            coerce_numeric(row.get(total_col)) if total_col else 0,
-                            coerce_numeric(row.get(prom_col))  if prom_col  else 0,
-                        ))
+                    amount = lambda c: coerce_numerics(col(c))[keep].tolist() if c else [0] * len(keep)
+                    estado = normalize_estados(col('ESTADO'))[keep].tolist()
+                    rows_cur = list(zip(
+                        [ym] * len(keep), [sheet] * len(keep), cod_ven, nom_ven, cod_cli, nom, canal, zona,
+                        estado, amount(fact_col), amount(pend_col), amount(total_col), amount(prom_col),
+                    ))
 
                     self.conn.executemany("""
                         INSERT OR REPLACE INTO fact_lanzamiento_cobertura
@@ -1374,37 +2945,21 @@ class SalesETL:
                     logging.info(f"  {sheet}: {len(rows_cur)} rows")
 
                 # ── Historical months: one row per (ym_hist, sheet, cod_cliente) ────
-                hist_cols = []
-                for col in df.columns:
-                    ym_hist = col_to_ym(col)
-                    if ym_hist and ym_hist != ym:
-                        hist_cols.append((col, ym_hist))
-
-                rows_hist = []
-                for _, row in df.iterrows():
-                    cod_cli = normalize_key(row.get('COD CENTRALIZADOR'))
-                    if not cod_cli or pd.isna(cod_cli): continue
-                    nom = row.get('NOM CENTRALIZADOR', '')
-                    if pd.notna(nom) and 'TOTAL' in str(nom).upper(): continue
-
-                    cod_ven = normalize_key(row.get('COD VENDEDOR'))
-                    nom_ven = str(row.get('NOM VENDEDOR', '')).strip()
-                    canal   = str(row.get('CANAL', '')).strip()
-                    zona    = str(row.get('ZONA', '')).strip()
-
-                    for col, ym_hist in hist_cols:
-                        kg = coerce_numeric(row.get(col))
-                        if not kg or kg <= 0:
-                            continue
-                        rows_hist.append((
-                            ym_hist, sheet,
-                            cod_ven, nom_ven,
-                            cod_cli, str(nom).strip(),
-                            canal, zona,
-                            'HISTORIAL',       # estado
-                            kg,                # fact_feb = kg ese mes
-                            0, kg, 0,          # pend=0, total=kg, prom=0
-                        ))
+                # Month columns melted to (client row, month, kg); blank and zero cells dropped
+                hist_cols = [(c, col_to_ym(c)) for c in df.columns]
+                hist_cols = [(c, ym_hist) for c, ym_hist in hist_cols if ym_hist and ym_hist != ym]
+                wide = pd.DataFrame({j: coerce_numerics(col(c))[keep] for j, (c, _) in enumerate(hist_cols)},
+                                    index=pd.RangeIndex(len(keep)))
+                hist = wide.reset_index().melt(id_vars='index', var_name='col', value_name='kg')
+                hist = hist[hist['kg'] > 0].sort_values('index', kind='stable')  # row by row, like the sheet
+
+                rows_hist = [
+                    (hist_cols[j][1], sheet, cod_ven[i], nom_ven[i], cod_cli[i], nom[i], canal[i], zona[i],
+                     'HISTORIAL',       # estado
+                     kg,                # fact_feb = kg ese mes
+                     0, kg, 0)          # pend=0, total=kg, prom=0
+                    for i, j, kg in zip(hist['index'].tolist(), hist['col'].tolist(), hist['kg'].tolist())
+                ]
 
                 if rows_hist:
                     # Only clear the specific hist months we're about to write
@@ -1453,48 +3008,34 @@ class SalesETL:
             'VEGGIES':   'Veggies',
         }
         RB_LANZAMIENTOS = ['RB (Kids+Crunchies)', 'RB (Milanesitas)']
-
-        # Collect all active lanzamientos for this month
-        active_lanz = {r[0] for r in self.conn.execute(
-            "SELECT DISTINCT lanzamiento FROM fact_lanzamiento_cobertura WHERE year_month = ?", (ym,)
-        ).fetchall()}
-
-        def _upgrade(cat, lanz_name):
-            # Get actual kg per client for this category from fact_facturacion
-            buyers = self.conn.execute("""
-                SELECT f.cod_cliente, ROUND(SUM(f.cantidad), 2) as kg_real
+        launch_categories = list(CATEGORY_MAP.items()) + [('REBOZADOS', ln) for ln in RB_LANZAMIENTOS]
+
+        # Actual kg per (launch, client) from fact_facturacion, applied in one pass:
+        # upgrade non-buyers AND fill missing KG for existing COMPRADORs
+        # (fact_feb=0 means the month column wasn't found in the source Excel)
+        values = ', '.join(['(?, ?)'] * len(launch_categories))
+        changes = self.conn.total_changes  # cursor.rowcount is -1 for statements starting with WITH
+        self.conn.execute(f"""
+            WITH launch_category (categoria, lanzamiento) AS (VALUES {values}),
+            buyers AS (
+                SELECT lc.lanzamiento, f.cod_cliente, ROUND(SUM(f.cantidad), 2) AS kg_real
                 FROM fact_facturacion f
                 JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
-                WHERE f.year_month = ? AND p.categoria = ? AND f.cantidad > 0
-                GROUP BY f.cod_cliente
-            """, (ym, cat)).fetchall()
-            count = 0
-            for row in buyers:
-                cid, kg_real = row[0], row[1]
-                # Upgrade non-buyers AND fill missing KG for existing COMPRADORs
-                # (fact_feb=0 means the month column wasn't found in the source Excel)
-                cur = self.conn.execute("""
-                    UPDATE fact_lanzamiento_cobertura
-                    SET estado   = 'COMPRADOR',
-                        fact_feb = CASE WHEN fact_feb = 0 OR fact_feb IS NULL THEN ? ELSE fact_feb END,
-                        total_feb = CASE WHEN total_feb = 0 OR total_feb IS NULL THEN ? ELSE total_feb END
-                    WHERE cod_cliente = ? AND lanzamiento = ? AND year_month = ?
-                      AND (estado != 'COMPRADOR' OR fact_feb = 0 OR fact_feb IS NULL)
-                """, (kg_real, kg_real, cid, lanz_name, ym))
-                count += cur.rowcount
-            return count
-
-        updated = 0
-        for cat, lanz_name in CATEGORY_MAP.items():
-            if lanz_name not in active_lanz:
-                continue
-            updated += _upgrade(cat, lanz_name)
-
-        # REBOZADOS → both RB lanzamiento names
-        for ln in RB_LANZAMIENTOS:
-            if ln not in active_lanz:
-                continue
-            updated += _upgrade('REBOZADOS', ln)
+                JOIN launch_category lc ON lc.categoria = p.categoria
+                WHERE f.year_month = ? AND f.cantidad > 0
+                GROUP BY lc.lanzamiento, f.cod_cliente
+            )
+            UPDATE fact_lanzamiento_cobertura
+            SET estado    = 'COMPRADOR',
+                fact_feb  = CASE WHEN fact_feb = 0 OR fact_feb IS NULL THEN b.kg_real ELSE fact_feb END,
+                total_feb = CASE WHEN total_feb = 0 OR total_feb IS NULL THEN b.kg_real ELSE total_feb END
+            FROM buyers b
+            WHERE fact_lanzamiento_cobertura.year_month = ?
+              AND fact_lanzamiento_cobertura.lanzamiento = b.lanzamiento
+              AND fact_lanzamiento_cobertura.cod_cliente = b.cod_cliente
+              AND (estado != 'COMPRADOR' OR fact_feb = 0 OR fact_feb IS NULL)
+        """, [v for pair in launch_categories for v in pair] + [ym, ym])
+        updated = self.conn.total_changes - changes
 
         self.conn.commit()
         if updated:
@@ -1502,92 +3043,99 @@ class SalesETL:
 
 
 
-    def calculate_segmentation(self):
-        ym = self.target_month
+    def calculate_segmentation(self, ym=None):
+        """Portfolio tier per client for `ym` (default: target_month).
+
+        Set-based: one grouped query per score instead of five queries per
+        client. Only data up to `ym` is read (history before it, facturación
+        and launches up to it), so any past month can be recomputed and tiers
+        tracked over time.
+        """
+        ym = ym or self.target_month
         if not ym: return
         
         logging.info(f"Calculating Portfolio Segmentation for {ym}...")
         
-        # 1. Get all active clients for the month
-        clients = self.conn.execute("""
+        # 1. Get all active clients for the month (historico for months without avance)
+        clients = [r[0] for r in self.conn.execute("""
             SELECT DISTINCT cod_cliente 
             FROM fact_avance_cliente_vendedor_month 
             WHERE year_month = ?
-        """, (ym,)).fetchall()
+        """, (ym,))]
+        if not clients:
+            clients = [r[0] for r in self.conn.execute(
+                "SELECT DISTINCT cod_cliente FROM fact_cliente_historico WHERE year_month = ?", (ym,))]
         
         if not clients: return
-        
+
+        # --- VOL: average KG of the months before ym, plus the month's facturación ---
+        avg_kg = dict(self.conn.execute("""
+            SELECT cod_cliente, AVG(kg_vendidos) FROM fact_cliente_historico
+            WHERE year_month < ? GROUP BY cod_cliente
+        """, (ym,)).fetchall())
+        # Summed in rowid order, as the per-client SUM() visited them
+        curr_kg = {}
+        for cod_cli, cantidad in self.conn.execute(
+                "SELECT cod_cliente, cantidad FROM fact_facturacion WHERE year_month = ? ORDER BY rowid", (ym,)):
+            if cantidad is not None:
+                curr_kg[cod_cli] = curr_kg.get(cod_cli, 0) + cantidad
+
+        # --- MIX: distinct categories bought up to ym ---
+        cat_count = dict(self.conn.execute("""
+            SELECT f.cod_cliente, COUNT(DISTINCT p.categoria)
+            FROM fact_facturacion f
+            JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
+            WHERE f.year_month <= ?
+            GROUP BY f.cod_cliente
+        """, (ym,)).fetchall())
+
+        # --- LOYALTY: same launch category bought in several months ---
+        # Each pair of months with the same category is one repeat: n months → n(n-1)/2.
+        # Launches are 'Papas' and classification is 'PAPAS', hence UPPER()
+        repeats = dict(self.conn.execute("""
+            WITH launches AS (
+                SELECT DISTINCT UPPER(lanzamiento) AS lanzamiento
+                FROM fact_lanzamiento_cobertura WHERE year_month <= ?
+            ),
+            launch_purchases AS (
+                SELECT DISTINCT f.cod_cliente, f.year_month, UPPER(p.categoria) AS cat
+                FROM fact_facturacion f
+                JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
+                WHERE f.year_month <= ?
+                  AND (
+                       UPPER(p.categoria) IN (SELECT lanzamiento FROM launches)
+                       OR (UPPER(p.categoria) = 'EMBUTIDOS' AND 'CHORIZOS' IN (SELECT lanzamiento FROM launches))
+                       OR (UPPER(p.categoria) = 'PESCADOS' AND 'ATUN' IN (SELECT lanzamiento FROM launches))
+                  )
+            ),
+            months_per_cat AS (
+                SELECT cod_cliente, COUNT(*) AS n FROM launch_purchases GROUP BY cod_cliente, cat
+            )
+            SELECT cod_cliente, SUM(n * (n - 1) / 2) FROM months_per_cat GROUP BY cod_cliente
+        """, (ym, ym)).fetchall())
+
+        # Client name for chain detection (first avance row of the client)
+        names = dict(self.conn.execute("""
+            SELECT cod_cliente, nom_cliente FROM fact_avance_cliente_vendedor_month
+            WHERE rowid IN (SELECT MIN(rowid) FROM fact_avance_cliente_vendedor_month GROUP BY cod_cliente)
+        """).fetchall())
+
         rows_segmentation = []
-        
-        for c in clients:
-            cod_cli = c['cod_cliente']
-            
-            # --- VOL SCORE (Max 40) ---
-            # Average KG in last 12 months
-            avg_kg_row = self.conn.execute("""
-                SELECT AVG(kg_vendidos) as avg_kg 
-                FROM fact_cliente_historico 
-                WHERE cod_cliente = ?
-            """, (cod_cli,)).fetchone()
-            
-            avg_kg = avg_kg_row['avg_kg'] or 0
-            # If we have current month sales, include them in avg
-            curr_kg_row = self.conn.execute("SELECT SUM(cantidad) FROM fact_facturacion WHERE cod_cliente = ? AND year_month = ?", (cod_cli, ym)).fetchone()
-            curr_kg = curr_kg_row[0] or 0
-            
+        for cod_cli in clients:
+            avg = avg_kg.get(cod_cli) or 0
+            curr = curr_kg.get(cod_cli) or 0
             # Real avg
-            total_avg = (avg_kg + curr_kg) / 2 if avg_kg > 0 else curr_kg
+            total_avg = (avg + curr) / 2 if avg > 0 else curr
             vol_score = min(total_avg / 8000.0, 1.0) * 40 # 8k KG as AAA threshold
-            
-            # --- MIX SCORE (Max 30) ---
-            # Distinct categories in last 6 months
-            mix_row = self.conn.execute("""
-                SELECT COUNT(DISTINCT p.categoria) as cat_count
-                FROM fact_facturacion f
-                JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
-                WHERE f.cod_cliente = ?
-            """, (cod_cli,)).fetchone()
-            
-            cat_count = mix_row['cat_count'] or 0
-            mix_score = min(cat_count / 8.0, 1.0) * 30 # 8+ categories as AAA depth
-            
-            # --- LOYALTY SCORE (Max 30) ---
-            # Logic: Has the client bought the SAME launch category in consecutive months? 
-            # (Rotation detection)
-            # Use lower() for matching as launches are 'Papas' and classification is 'PAPAS'
-            loyalty_row = self.conn.execute("""
-                WITH launch_purchases AS (
-                    SELECT DISTINCT f.year_month, UPPER(p.categoria) as cat
-                    FROM fact_facturacion f
-                    JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
-                    WHERE f.cod_cliente = ?
-                      AND (
-                           UPPER(p.categoria) IN (SELECT UPPER(lanzamiento) FROM fact_lanzamiento_cobertura)
-                           OR (UPPER(p.categoria) = 'EMBUTIDOS' AND 'CHORIZOS' IN (SELECT UPPER(lanzamiento) FROM fact_lanzamiento_cobertura))
-                           OR (UPPER(p.categoria) = 'PESCADOS' AND 'ATUN' IN (SELECT UPPER(lanzamiento) FROM fact_lanzamiento_cobertura))
-                      )
-                )
-                SELECT COUNT(*) as repeat_count
-                FROM launch_purchases a
-                JOIN launch_purchases b ON a.cat = b.cat 
-                  AND (substr(a.year_month,1,4) || substr(a.year_month,6,2)) < (substr(b.year_month,1,4) || substr(b.year_month,6,2))
-            """, (cod_cli,)).fetchone()
-            
-            repeats = loyalty_row['repeat_count'] or 0
-            loyalty_score = min(repeats / 3.0, 1.0) * 30 # 3+ repeat purchases in launches
+            mix_score = min((cat_count.get(cod_cli) or 0) / 8.0, 1.0) * 30 # 8+ categories as AAA depth
+            loyalty_score = min((repeats.get(cod_cli) or 0) / 3.0, 1.0) * 30 # 3+ repeat purchases in launches
             
             total_score = vol_score + mix_score + loyalty_score
             
             # Define Tier (Slightly adjusted thresholds for realistic distribution)
             # PROACTIVE: Isolate National Chains from the strategic ranking
-            national_chains = ['LIBERTAD', 'DIARCO', 'CENCOSUD', 'CARREFOUR', 'WAL-MART', 
-                               'CHANGOMAS', 'MAXICONSUMO', 'VITAL', 'MAKRO', 'INC S.A.', 'GDN']
-            
-            # Get client name for chain detection
-            nom_cli_row = self.conn.execute("SELECT nom_cliente FROM fact_avance_cliente_vendedor_month WHERE cod_cliente = ? LIMIT 1", (cod_cli,)).fetchone()
-            nom_cli = nom_cli_row['nom_cliente'].upper() if nom_cli_row else ""
-            
-            is_national_chain = any(chain in nom_cli for chain in national_chains)
+            nom_cli = (names.get(cod_cli) or "").upper()
+            is_national_chain = any(chain in nom_cli for chain in NATIONAL_CHAINS)
             
             if is_national_chain:
                 tier = "CN" # Cadena Nacional
@@ -1599,15 +3147,13 @@ class SalesETL:
                 tier = "A"
             else: 
                 tier = "B"
-
-
             
             rows_segmentation.append((
                 cod_cli, ym, tier, round(total_score, 1),
                 round(vol_score, 1), round(mix_score, 1), round(loyalty_score, 1)
             ))
             
-        # Clean current month
+        # Clean the month
         self.conn.execute("DELETE FROM fact_client_segmentation WHERE year_month = ?", (ym,))
         
         self.conn.executemany("""
@@ -1619,24 +3165,244 @@ class SalesETL:
         self.conn.commit()
         logging.info(f"Segmentation completed: {len(rows_segmentation)} clients classified.")
 
-    def run_all(self):
+    def compute_forecasts(self):
+        """Persist the next-month forecast of every client in fact_forecast,
+        plus vendedor/jefe/zona rollups in fact_forecast_rollup.
+
+        Work is sharded by scope across a process pool: each shard is exactly
+        the /api/forecast?vendedor=X (or jefe=, zona=) computation, stored under
+        its (nivel, clave). The zone benchmark and launch engagement factors
+        depend on the scope, so a client gets a row in every scope it belongs to.
+        Rows of previous runs are kept for accuracy tracking.
+        """
+        import forecast_engine as fe
+
+        ym = self.target_month
+        if not ym: return
+        y, m = map(int, ym.split('-'))
+        next_m = m + 1 if m < 12 else 1
+        next_ym = f"{y if m < 12 else y + 1}-{next_m:02d}"
+        logging.info(f"Computing forecasts for {next_ym} (base {ym}) with {self.workers} worker(s)...")
+
+        av_rows = self.conn.execute("""
+            SELECT cod_cliente, COALESCE(cod_vendedor, '') as cod_vendedor,
+                   COALESCE(jefe, '') as jefe, COALESCE(zona, '') as zona
+            FROM fact_avance_cliente_vendedor_month
+            WHERE year_month = ?
+        """, (ym,)).fetchall()
+        if not av_rows: return
+
+        # Workers read the DB through their own connections
+        self.conn.commit()
+
+        scopes = self._forecast_scopes(av_rows)
+        rows_fc = self._forecast_rows(self.run_id, scopes, ym, next_ym, next_m)
+        scope_fc = {}
+        for r in rows_fc:
+            scope_fc[r[3], r[4]] = scope_fc.get((r[3], r[4]), 0) + r[6]
+
+        # Rollups: scope-level forecast on the summed history (what /api/insights
+        # shows) next to the sum of the scope's client forecasts
+        hm = fe.load_scope_history(self.conn, "1=1", [], ym)
+        rows_rollup = []
+        for nivel in ('vendedor', 'jefe', 'zona'):
+            col = 'cod_vendedor' if nivel == 'vendedor' else nivel
+            pairs = [(r[col], r['cod_cliente']) for r in av_rows if r[col]]
+            scope_hm = fe.rollup_matrix(hm, pairs)
+            f = fe.aggregate_factors(scope_hm, next_m)
+            members = {}
+            for k, cid in pairs:
+                members.setdefault(k, set()).add(cid)
+            for k, cids in members.items():
+                i = scope_hm.index[k]
+                if scope_hm.mask[i].any():
+                    p = fe.aggregate_payload(i, f)
+                else:
+                    p = {'forecast_kg': None, 'low_kg': None, 'high_kg': None, 'confidence': None}
+                rows_rollup.append((
+                    self.run_id, next_ym, ym, nivel, k,
+                    p['forecast_kg'], p['low_kg'], p['high_kg'], p['confidence'],
+                    round(scope_fc.get((nivel, k), 0), 0), len(cids),
+                ))
+
+        self._store_forecasts(rows_fc)
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO fact_forecast_rollup
+            (run_id, target_month, base_month, nivel, clave,
+             forecast_kg, low_kg, high_kg, confidence, clientes_forecast_kg, n_clientes)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        """, rows_rollup)
+        self.conn.commit()
+        logging.info(f"Forecasts stored: {len(rows_fc)} client rows, {len(rows_rollup)} rollups "
+                     f"({len(scopes)} vendedor/jefe/zona shards) for {next_ym}")
+
+    @staticmethod
+    def _forecast_scopes(av_rows):
+        """(nivel, clave) of every vendedor/jefe/zona the avance rows belong to."""
+        return [(nivel, k) for nivel, col in (('vendedor', 'cod_vendedor'), ('jefe', 'jefe'), ('zona', 'zona'))
+                for k in sorted({r[col] for r in av_rows if r[col]})]
+
+    def _forecast_rows(self, run_id, scopes, ym, next_ym, next_m, clients=None):
+        """Run one forecast shard per (nivel, clave) scope (process pool when
+        workers > 1) and return its fact_forecast rows: one per client, the
+        first avance row's (a no-history estimate is rebuilt per row on read)."""
+        import forecast_engine as fe
+
+        columns = {'vendedor': 'cod_vendedor', 'jefe': 'jefe', 'zona': 'zona'}
+        args = [(str(self.work_path), f"av.{columns[nivel]} = ?", [k], ym, next_m) for nivel, k in scopes]
+        if self.workers > 1 and len(scopes) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(scopes))) as pool:
+                results = list(pool.map(fe.forecast_shard, *zip(*args)))
+        else:
+            results = [fe.forecast_shard(*a) for a in args]
+
+        rows_fc = []
+        for (nivel, k), forecasts in zip(scopes, results):
+            seen = set()
+            for f in forecasts:
+                cid = f['cod_cliente']
+                if cid in seen or (clients is not None and cid not in clients):
+                    continue
+                seen.add(cid)
+                fx = f['factors']
+                rows_fc.append((
+                    run_id, next_ym, ym, nivel, k, cid,
+                    f['forecast_kg'], f['low_kg'], f['high_kg'], f['confidence'],
+                    f.get('hist_months', 0),
+                    fx.get('baseline_kg'), fx.get('trend'), fx.get('seasonality'), fx.get('recency'),
+                    fx.get('launch_engagement'), fx.get('zone_benchmark'), fx.get('note'),
+                ))
+        return rows_fc
+
+    def _store_forecasts(self, rows_fc):
+        """INSERT OR REPLACE rows of _forecast_rows(); the caller commits."""
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO fact_forecast
+            (run_id, target_month, base_month, nivel, clave, cod_cliente,
+             forecast_kg, low_kg, high_kg, confidence, hist_months,
+             baseline_kg, trend, seasonality, recency, launch_engagement, zone_benchmark, note)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, rows_fc)
+
+    def refresh_forecasts(self):
+        """Incremental variant of compute_forecasts for intra-month facturación reloads.
+
+        Only clients with changed cells in the target month are affected (their
+        venta_actual moved; the history the forecast is built on did not). The
+        vendedor/jefe/zona shards they belong to are re-run and their rows in the
+        latest persisted run are replaced, together with the clientes_forecast_kg
+        of those rollups. Falls back to a full compute_forecasts() when no run
+        exists yet.
+        """
+        import forecast_engine as fe
+
+        ym = self.target_month
+        if not ym: return
+        y, m = map(int, ym.split('-'))
+        next_m = m + 1 if m < 12 else 1
+        next_ym = f"{y if m < 12 else y + 1}-{next_m:02d}"
+
+        run_id = fe.latest_forecast_run(self.conn, ym, next_ym)
+        if run_id is None:
+            return self.compute_forecasts()
+        clients = {cli for (cym, _, cli) in self.changed_cells if cym == ym}
+        if not clients:
+            logging.info(f"Forecasts for {next_ym}: no changed clients, run {run_id} kept")
+            return
+
+        av_rows = self.conn.execute("""
+            SELECT cod_cliente, COALESCE(cod_vendedor, '') as cod_vendedor,
+                   COALESCE(jefe, '') as jefe, COALESCE(zona, '') as zona
+            FROM fact_avance_cliente_vendedor_month
+            WHERE year_month = ?
+        """, (ym,)).fetchall()
+        av_rows = [r for r in av_rows if r['cod_cliente'] in clients]
+        if not av_rows:
+            logging.info(f"Forecasts for {next_ym}: changed clients not in avance, run {run_id} kept")
+            return
+
+        self.conn.commit()
+        scopes = self._forecast_scopes(av_rows)
+        rows_fc = self._forecast_rows(run_id, scopes, ym, next_ym, next_m, clients)
+        # A client may drop out of a scope's payload (no history, no sales left)
+        members = sorted(clients)
+        for lo in range(0, len(members), 900):
+            chunk = members[lo:lo + 900]
+            self.conn.executemany(f"""
+                DELETE FROM fact_forecast
+                WHERE run_id = ? AND target_month = ? AND nivel = ? AND clave = ?
+                  AND cod_cliente IN ({','.join(['?'] * len(chunk))})
+            """, [[run_id, next_ym, nivel, k] + chunk for nivel, k in scopes])
+        self._store_forecasts(rows_fc)
+
+        cur = self.conn.executemany("""
+            UPDATE fact_forecast_rollup
+            SET clientes_forecast_kg = (
+                SELECT ROUND(COALESCE(SUM(f.forecast_kg), 0), 0)
+                FROM fact_forecast f
+                WHERE f.run_id = fact_forecast_rollup.run_id
+                  AND f.target_month = fact_forecast_rollup.target_month
+                  AND f.nivel = fact_forecast_rollup.nivel AND f.clave = fact_forecast_rollup.clave
+            )
+            WHERE run_id = ? AND target_month = ? AND nivel = ? AND clave = ?
+        """, [(run_id, next_ym, nivel, k) for nivel, k in scopes])
+        self.conn.commit()
+        logging.info(f"Forecasts refreshed in run {run_id}: {len(rows_fc)} client rows "
+                     f"({len(scopes)} vendedor/jefe/zona shards), {cur.rowcount} rollups for {next_ym}")
+
+    def update_facturacion_archive(self):
+        """Rewrite the Parquet partitions of the months this run changed (plus any
+        whose fingerprint no longer matches the archive manifest)."""
+        months = {cell[0] for cell in self.changed_cells}
+        facturacion_archive.update_archive(self.conn, self.archive_dir, changed_months=months, full=self.full)
+
+    def run_all(self, only=None, start_from=None):
+        """Run the stage graph (STAGES): the stages downstream of a new/modified
+        source file (all with --full), or part of it:
+          only=[stages]     just these stages, whether their inputs changed or not
+          start_from=stage  that stage and every stage downstream of it
+          resume=True       the stages the last run did not get through (it failed)
+        Partial runs leave etl_file_manifest alone, so the next regular run still
+        reprocesses the changed files.
+        """
         try:
             self.init_db()
-            self.start_run()
-            
-            self.process_dimensions()
-            self.process_facturacion()
-            self.process_avance_vendedor()
-            self.apply_vendor_aliases()   # Perotti → Gentile auto
-            self.sync_facturacion_to_avance() # Sync TXT KG to Avance table
-            self.update_premium_flag()
-            self.seed_objetivos()
-            self.process_category_sheets()
-            self.process_lanzamientos()
-            
-            self.calculate_segmentation() # NEW Portfolio Segmentation Logic
-            
-            self.end_run("SUCCESS", "ETL completed successfully.")
+            if self.resume:
+                dirty, plan, completed = self.restore_checkpoint(self.checkpoint)
+            else:
+                self.start_run()
+                dirty = self.detect_source_changes()
+                if any(self.alias_changes().values()):
+                    logging.info("Aliases: vendor_alias/client_alias changed, re-keying and reloading the avance")
+                    dirty |= {'aliases', 'avance'}
+                completed = set()
+                if only:
+                    self.forced = set(only)
+                elif start_from:
+                    self.forced = downstream_stages(start_from)
+                plan = self.forced or set(STAGES)
+                for name in STAGES:
+                    if name not in plan:
+                        self._after_stage(name, ran=False)
+                if self.forced:
+                    logging.info(f"Partial run: {', '.join(n for n in STAGES if n in plan)}")
+
+            self.run_stages(dirty, plan, completed)
+
+            if self.forced:
+                logging.info("Partial run: etl_file_manifest not updated")
+                message = f"Partial run: {', '.join(n for n in STAGES if n in plan)}."
+            else:
+                self.save_manifest()
+                if dirty or self.full:
+                    message = "ETL completed successfully."
+                else:
+                    message = "No source file changed since the last run."
+
+            self.publish()
+            self.end_run("SUCCESS", message)
+            self.conn.execute("DELETE FROM etl_run_checkpoint")
+            self.conn.commit()
 
             logging.info("--- ETL SUMMARY ---")
             logging.info(f"Run ID: {self.run_id}")
@@ -1645,8 +3411,96 @@ class SalesETL:
             
         except Exception as e:
             logging.error(f"ETL FAILED: {str(e)}")
-            self.end_run("FAILED", str(e))
+            if self.connection_open():  # else publish closed it: abandon_shadow records the failure
+                self.end_run("FAILED", str(e))
+            self.abandon_shadow(str(e))
+            raise
+        finally:
+            self.workbooks.close()
+
+    def run_incremental(self):
+        """Intra-month refresh after a partial Minerva/TXT load.
+
+        Only facturación (and the alias tables) count as changed: the stages
+        downstream of process_facturacion in the stage graph run as in a regular
+        run, with the cell-scoped INCREMENTAL_VARIANTS for the avance venta_actual
+        and the persisted forecasts. Other source files are not checked; the avance
+        is reloaded only when facturación removed sales of its month, as in
+        run_all. DESAVANCE alerts are computed from the avance table by the app,
+        so they follow the synced venta_actual.
+        """
+        try:
+            self.init_db()
+            self.start_run()
+            self.incremental = True
+            self.target_month = self.conn.execute(
+                "SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month"
+            ).fetchone()[0]
+
+            self.load_manifest()
+            dirty = set()
+            stale = [f.name for f in self.facturacion_files() if not self.is_unchanged(f)]
+            if stale:
+                logging.info(f"Manifest: facturacion changed ({', '.join(stale)})")
+                dirty.add('facturacion')
+            if any(self.alias_changes().values()):
+                logging.info("Aliases: vendor_alias/client_alias changed, re-keying")
+                dirty.add('aliases')
+            self.run_stages(dirty, downstream_stages('apply_aliases'))
+
+            self.save_manifest()
+            self.publish()
+            self.end_run("SUCCESS", f"Incremental refresh: {len(self.changed_cells)} cells changed.")
+            self.conn.execute("DELETE FROM etl_run_checkpoint")
+            self.conn.commit()
+            logging.info(f"--- INCREMENTAL REFRESH: {len(self.changed_cells)} cells changed "
+                         f"(month {self.target_month}, run {self.run_id}) ---")
+
+        except Exception as e:
+            logging.error(f"ETL FAILED: {str(e)}")
+            if self.connection_open():  # else publish closed it: abandon_shadow records the failure
+                self.end_run("FAILED", str(e))
+            self.abandon_shadow(str(e))
             raise
+        finally:
+            self.workbooks.close()
+
+def watch_and_load(data_dir, db_path, load, extra_dirs=(), quiet=5.0, interval=2.0, polling=False):
+    """--watch: call load() whenever ETL source files land in data_dir.
+
+    Changes are batched until nothing moved for `quiet` seconds, so files still
+    being copied are not read. A batch with source files triggers a regular run:
+    the file manifest limits it to the changed sources and the stages downstream
+    of them, and the generation it publishes tells the app to drop its caches.
+    Changes in extra_dirs (price lists: no stage loads them yet) only notify the
+    app. A failed load is logged and retried on the next change.
+    """
+    data_dir = Path(data_dir)
+    extra_dirs = [Path(d) for d in extra_dirs if Path(d).is_dir()]
+
+    def run():
+        try:
+            load()
+        except Exception as e:
+            logging.error(f"Watch: load failed ({e}); waiting for the next change")
+
+    watcher = open_watcher([data_dir, *extra_dirs], interval, polling)
+    try:
+        run()  # files dropped while nobody was watching
+        for batch in debounced_changes(watcher, quiet):
+            sources = sorted(p.name for p in batch
+                             if p.parent == data_dir and p.exists() and source_group(p.name))
+            if sources:
+                logging.info(f"Watch: {', '.join(sources)} changed, loading")
+                run()
+            elif any(d in p.parents for p in batch for d in extra_dirs):
+                generation = bump_generation(db_path)
+                logging.info(f"Watch: {len(batch)} file(s) changed outside the ETL sources, "
+                             f"app notified (generation {generation})")
+    except KeyboardInterrupt:
+        logging.info("Watch: stopped")
+    finally:
+        watcher.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sales Ops ETL Engine")
@@ -1655,16 +3509,110 @@ if __name__ == "__main__":
     parser.add_argument("--log-path", default="logs/etl.log", help="Log file path")
     parser.add_argument("--year", type=int, help="Override year for month detection")
     parser.add_argument("--export-json", action="store_true", help="Export JSON files after ETL")
+    parser.add_argument("--workers", type=int, help="Worker processes for parallel stages (default: CPU count)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only reload facturación and refresh the cells it changed (intra-month loads)")
+    parser.add_argument("--excel-engine", choices=["openpyxl", "calamine"],
+                        help="Excel reader (calamine is faster, requires python-calamine; default: openpyxl)")
+    parser.add_argument("--fuzzy-threshold", type=float,
+                        help="Match near-miss client names by trigram similarity (e.g. 0.85; default: off)")
+    parser.add_argument("--segment-months", nargs="+", metavar="YYYY-MM",
+                        help="Only recompute the portfolio segmentation of these months (tier history)")
+    parser.add_argument("--only", nargs="+", choices=list(STAGES), metavar="STAGE",
+                        help="Run only these stages, whether their inputs changed or not (see --stages)")
+    parser.add_argument("--from", dest="start_from", choices=list(STAGES), metavar="STAGE",
+                        help="Run STAGE and every stage downstream of it")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the last run, which failed, from the stage it failed in")
+    parser.add_argument("--stages", action="store_true", help="List the ETL stages and their dependencies and exit")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running: load new/changed source files as they land in --data-dir")
+    parser.add_argument("--watch-dirs", nargs="*", default=["PricesList"], metavar="DIR",
+                        help="--watch: other folders whose changes notify the app (default: PricesList)")
+    parser.add_argument("--debounce", type=float, default=5.0,
+                        help="--watch: seconds without changes before loading (default 5)")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="--watch: seconds between scans when polling (default 2)")
+    parser.add_argument("--poll", action="store_true", help="--watch: poll even where inotify is available")
+    parser.add_argument("--full", action="store_true",
+                        help="Reprocess every source file and stage, ignoring the file manifest")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Bulk-load mode: synchronous=OFF, one transaction per stage, deferred "
+                             "indexes and ANALYZE at the end (on the shadow copy)")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Write the live DB directly instead of building a shadow copy and swapping it in")
+    parser.add_argument("--keep-generations", type=int, default=KEEP_GENERATIONS,
+                        help=f"Previous DB generations kept in db/generations/ (default: {KEEP_GENERATIONS})")
+    parser.add_argument("--archive-dir",
+                        help="Keep a Parquet archive of fact_facturacion (partitioned by month) in this "
+                             "directory; only changed months are rewritten (requires pyarrow)")
+    parser.add_argument("--report", nargs="?", type=int, const=10, metavar="N",
+                        help="Compare per-stage timings of the last N runs (default 10), flag regressions and exit")
+    parser.add_argument("--regression-pct", type=float, default=25,
+                        help="--report: flag stages slower than the median of earlier runs by this %% (default 25)")
+    parser.add_argument("--generations", action="store_true", help="List the kept DB generations and exit")
+    parser.add_argument("--rollback", type=int, metavar="GEN",
+                        help="Make a kept DB generation live again and exit")
     
     args = parser.parse_args()
     
     setup_logging(args.log_path)
+
+    if args.report:
+        conn = sqlite3.connect(args.db_path)
+        try:
+            run_ids, report = stage_report(conn, args.report, args.regression_pct / 100)
+        except sqlite3.OperationalError:
+            run_ids, report = [], []  # no metrics recorded yet
+        conn.close()
+        if not report:
+            logging.info("No stage metrics recorded yet")
+        else:
+            logging.info(f"Stage wall time (s) over runs {run_ids[0]}..{run_ids[-1]}:")
+            logging.info(f"  {'stage':<28}" + ''.join(f"{r:>9}" for r in run_ids) + f"{'rows read':>12}{'written':>10}{'RSS MB':>8}")
+            for row in report:
+                walls = ''.join(f"{w:>9.2f}" if w is not None else f"{'-':>9}" for w in row['wall_s'])
+                flag = f"  ← REGRESSION (median {row['baseline_s']:.2f}s)" if row['regression'] else ""
+                logging.info(f"  {row['stage']:<28}{walls}{row['rows_read'] or 0:>12,}{row['rows_written'] or 0:>10,}"
+                             f"{row['peak_rss_mb'] or 0:>8.0f}{flag}")
+            regressions = [r['stage'] for r in report if r['regression']]
+            logging.info(f"{len(regressions)} regression(s)" + (f": {', '.join(regressions)}" if regressions else ""))
+        sys.exit(0)
+    if args.stages:
+        for name, spec in STAGES.items():
+            after = [n for n in STAGES if n in STAGE_DEPENDENCIES[name]]
+            sources = ', '.join(spec['sources']) if spec['sources'] is not None else 'every run'
+            logging.info(f"  {name:<28} sources: {sources:<42} after: {', '.join(after) or '-'}")
+        sys.exit(0)
+    if args.generations:
+        logging.info(f"{args.db_path}: generation {read_generation(args.db_path)} live")
+        for gen, path in list_generations(args.db_path):
+            logging.info(f"  generation {gen}: {path} ({path.stat().st_size / 1e6:.1f} MB)")
+        sys.exit(0)
+    if args.rollback is not None:
+        try:
+            rollback(args.db_path, args.rollback, keep=args.keep_generations)
+        except ValueError as e:
+            parser.error(str(e))
+        sys.exit(0)
+    if args.bulk and args.in_place:
+        parser.error("--bulk builds on a shadow copy; it cannot be combined with --in-place")
+    modes = [flag for flag, value in (("--only", args.only), ("--from", args.start_from), ("--resume", args.resume),
+                                      ("--incremental", args.incremental), ("--segment-months", args.segment_months),
+                                      ("--watch", args.watch))
+             if value]
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} cannot be combined")
+    if args.archive_dir and facturacion_archive.pa is None:
+        parser.error("--archive-dir requires pyarrow (pip install pyarrow)")
     
-    etl = SalesETL(args.data_dir, args.db_path, args.year)
-    etl.run_all()
-    
-    # Export JSON if requested
-    if args.export_json:
+    def make_etl():
+        return SalesETL(args.data_dir, args.db_path, args.year, workers=args.workers, full=args.full,
+                        excel_engine=args.excel_engine, fuzzy_threshold=args.fuzzy_threshold, bulk=args.bulk,
+                        shadow=not args.in_place, keep_generations=args.keep_generations,
+                        archive_dir=args.archive_dir, resume=args.resume)
+
+    def export_json():
         logging.info("=== Starting JSON Export ===")
         try:
             from export_json import JSONExporter
@@ -1675,3 +3623,30 @@ if __name__ == "__main__":
             logging.error(f"JSON export failed: {str(e)}")
             raise
 
+    if args.watch:
+        def load():
+            make_etl().run_all()
+            if args.export_json:
+                export_json()
+        watch_and_load(args.data_dir, args.db_path, load, extra_dirs=args.watch_dirs, quiet=args.debounce,
+                       interval=args.poll_interval, polling=args.poll)
+        sys.exit(0)
+
+    try:
+        etl = make_etl()
+    except ValueError as e:
+        parser.error(str(e))
+    if args.incremental:
+        etl.run_incremental()
+    elif args.segment_months:
+        etl.init_db()
+        for ym in args.segment_months:
+            with etl.stage_transaction():
+                etl.calculate_segmentation(ym)
+        etl.publish()
+    else:
+        etl.run_all(only=args.only, start_from=args.start_from)
+    
+    # Export JSON if requested
+    if args.export_json:
+        export_json()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Facturación Archive
+Columnar copy of fact_facturacion for analytics jobs: one Parquet file per month,
+joined with the product and client attributes, Hive-partitioned by year_month:
+
+  <archive_dir>/year_month=2026-02/part-0.parquet
+  <archive_dir>/_manifest.json      fingerprint of every archived month
+
+The ETL calls update_archive() at the end of each run. Only months whose
+fact_facturacion fingerprint (rows, kg, importe, premium rows) changed, that the
+run reloaded, or that are missing on disk are rewritten; a change in the product
+or client attributes rewrites every month. Files are written next to their final
+name and renamed into place, so readers never see a half-written partition.
+
+Readers load a month range with column projection; partitions outside the range
+are never opened and numeric columns reach pandas/NumPy without a copy.
+
+Requires pyarrow (optional dependency: only needed with etl.py --archive-dir).
+
+Usage:
+  update_archive(conn, 'archive/facturacion', changed_months={'2026-02'})
+  df = read_archive('archive/facturacion', '2025-06', '2026-02', columns=['cod_cliente', 'cantidad'])
+  arrays = read_archive_arrays('archive/facturacion', '2026-01', columns=['cantidad', 'importe'])
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only the archive needs it
+    pa = ds = pq = None
+
+MANIFEST_FILE = '_manifest.json'   # '_' prefix: ignored by pyarrow.dataset
+PARTITION = 'year_month'
+
+ARCHIVE_SQL = """
+    SELECT f.row_hash, f.fecha_emision, f.cod_cliente, f.cod_vendedor, f.cod_producto,
+           f.cantidad, f.importe, f.deposito, f.es_premium,
+           p.descripcion, p.categoria, p.subcategoria,
+           c.cliente_name, c.cod_centralizador, c.canal, c.frecuencia, c.ciudad, c.provincia
+    FROM fact_facturacion f
+    LEFT JOIN dim_product_classification p ON p.cod_producto = f.cod_producto
+    LEFT JOIN dim_clients c ON c.cliente_id = f.cod_cliente
+    WHERE f.year_month = ?
+    ORDER BY f.fecha_emision, f.cod_cliente, f.row_hash
+"""
+
+# Attribute columns taken from the dimensions: any change rewrites every month
+DIMENSION_SQL = {
+    'dim_product_classification': "SELECT cod_producto, descripcion, categoria, subcategoria "
+                                  "FROM dim_product_classification ORDER BY cod_producto",
+    'dim_clients': "SELECT cliente_id, cliente_name, cod_centralizador, canal, frecuencia, ciudad, provincia "
+                   "FROM dim_clients ORDER BY cliente_id",
+}
+
+FINGERPRINT_SQL = """
+    SELECT year_month, COUNT(*), ROUND(TOTAL(cantidad), 6), ROUND(TOTAL(importe), 2), TOTAL(es_premium)
+    FROM fact_facturacion
+    WHERE year_month IS NOT NULL
+    GROUP BY year_month
+"""
+
+STRING_COLUMNS = ('row_hash', 'cod_cliente', 'cod_vendedor', 'cod_producto', 'deposito',
+                  'descripcion', 'categoria', 'subcategoria', 'cliente_name', 'cod_centralizador',
+                  'canal', 'frecuencia', 'ciudad', 'provincia')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("The facturación archive requires pyarrow (pip install pyarrow)")
+
+
+def archive_schema():
+    """Fixed schema, so months with all-NULL attributes still unify with the rest."""
+    _require_pyarrow()
+    return pa.schema(
+        [('row_hash', pa.string()), ('fecha_emision', pa.timestamp('ms'))]
+        + [(c, pa.string()) for c in ('cod_cliente', 'cod_vendedor', 'cod_producto', 'deposito')]
+        + [('cantidad', pa.float64()), ('importe', pa.float64()), ('es_premium', pa.int8())]
+        + [(c, pa.string()) for c in STRING_COLUMNS[5:]]
+    )
+
+
+def partition_dir(archive_dir, year_month):
+    return Path(archive_dir) / f"{PARTITION}={year_month}"
+
+
+def load_manifest(archive_dir):
+    try:
+        return json.loads((Path(archive_dir) / MANIFEST_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return {'dimensions': None, 'months': {}}
+
+
+def _save_manifest(archive_dir, manifest):
+    path = Path(archive_dir) / MANIFEST_FILE
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp, path)
+
+
+def dimension_digest(conn):
+    """md5 of the archived product/client attributes."""
+    digest = hashlib.md5()
+    for sql in DIMENSION_SQL.values():
+        for row in conn.execute(sql):
+            digest.update('\x1f'.join('\x00' if v is None else str(v) for v in row).encode())
+            digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def month_fingerprints(conn):
+    """{year_month: [rows, kg, importe, premium rows]} of fact_facturacion."""
+    return {r[0]: list(r[1:]) for r in conn.execute(FINGERPRINT_SQL)}
+
+
+def month_frame(conn, year_month):
+    """The archived rows of one month, typed like archive_schema()."""
+    df = pd.read_sql_query(ARCHIVE_SQL, conn, params=(year_month,))
+    df['fecha_emision'] = pd.to_datetime(df['fecha_emision'], errors='coerce')
+    df['es_premium'] = df['es_premium'].fillna(0).astype('int8')
+    return df
+
+
+def write_month(conn, archive_dir, year_month):
+    """(Re)write the partition of one month. Returns the rows written."""
+    _require_pyarrow()
+    df = month_frame(conn, year_month)
+    table = pa.Table.from_pandas(df, schema=archive_schema(), preserve_index=False)
+    target_dir = partition_dir(archive_dir, year_month)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target = target_dir / 'part-0.parquet'
+    tmp = target_dir / '.part-0.parquet.tmp'   # '.' prefix: ignored by readers
+    pq.write_table(table, tmp, compression='zstd')
+    os.replace(tmp, target)
+    return table.num_rows
+
+
+def update_archive(conn, archive_dir, changed_months=(), full=False):
+    """Bring archive_dir in line with fact_facturacion, rewriting only the
+    months that changed (all of them with full=True or new dimension
+    attributes). Returns {'written': {month: rows}, 'removed': [months]}."""
+    _require_pyarrow()
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(archive_dir)
+    fingerprints = month_fingerprints(conn)
+    digest = dimension_digest(conn)
+    rewrite_all = full or digest != manifest.get('dimensions')
+    archived = manifest.get('months', {})
+
+    stale = sorted(
+        ym for ym, fp in fingerprints.items()
+        if rewrite_all or ym in changed_months or archived.get(ym) != fp
+        or not (partition_dir(archive_dir, ym) / 'part-0.parquet').exists()
+    )
+    removed = sorted(ym for ym in archived if ym not in fingerprints)
+
+    written = {}
+    for ym in stale:
+        written[ym] = write_month(conn, archive_dir, ym)
+        archived[ym] = fingerprints[ym]
+    for ym in removed:
+        shutil.rmtree(partition_dir(archive_dir, ym), ignore_errors=True)
+        del archived[ym]
+    _save_manifest(archive_dir, {'dimensions': digest, 'months': archived})
+
+    logging.info(f"Facturación archive: {len(written)} month(s) rewritten ({sum(written.values())} rows), "
+                 f"{len(removed)} removed, {len(fingerprints) - len(written)} unchanged in {archive_dir}")
+    return {'written': written, 'removed': removed}
+
+
+def archive_dataset(archive_dir):
+    _require_pyarrow()
+    partitioning = ds.partitioning(pa.schema([(PARTITION, pa.string())]), flavor='hive')
+    return ds.dataset(archive_dir, format='parquet', partitioning=partitioning)
+
+
+def read_archive_table(archive_dir, start=None, end=None, columns=None):
+    """pyarrow Table of the months start..end (YYYY-MM, inclusive, either open).
+    Partitions outside the range are pruned; only `columns` are read."""
+    expr = None
+    if start:
+        expr = ds.field(PARTITION) >= start
+    if end:
+        upper = ds.field(PARTITION) <= end
+        expr = upper if expr is None else expr & upper
+    return archive_dataset(archive_dir).to_table(columns=columns, filter=expr)
+
+
+def read_archive(archive_dir, start=None, end=None, columns=None):
+    """DataFrame of a month range. Columns are not consolidated into blocks and
+    the Arrow buffers are released as they convert, so null-free numeric columns
+    are handed to pandas without a copy."""
+    table = read_archive_table(archive_dir, start, end, columns)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_archive_arrays(archive_dir, start=None, end=None, columns=None):
+    """{column: numpy array} of a month range. Null-free numeric columns in a
+    single chunk are zero-copy views of the Arrow buffers (read-only)."""
+    table = read_archive_table(archive_dir, start, end, columns)
+    arrays = {}
+    for name in table.column_names:
+        col = table.column(name)
+        if col.num_chunks == 1:
+            col = col.chunk(0)
+        arrays[name] = col.to_numpy(zero_copy_only=False)
+    return arrays
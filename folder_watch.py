@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Folder Watch
+Change notifications for the ETL watch mode (etl.py --watch):
+
+  - InotifyWatcher: Linux inotify through libc (ctypes, no extra package),
+    recursive; one blocking read per batch of events
+  - PollingWatcher: fallback everywhere else, compares (size, mtime) of every
+    file each `interval` seconds
+
+Both hand out the set of files created/modified/moved/deleted since the last
+call. debounced_changes() groups them into batches, yielded once nothing has
+changed for `quiet` seconds, so a file still being copied (a large TXT over the
+network, Excel writing its temp file) is never picked up half-written.
+
+Usage:
+  watcher = open_watcher(['data', 'PricesList'])
+  for paths in debounced_changes(watcher, quiet=5):
+      ...
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Editor/browser/copy temporaries: never loaded, never worth a run
+TEMP_PREFIXES = ('~$', '.')
+TEMP_SUFFIXES = ('.tmp', '.part', '.crdownload', '.swp', '~')
+
+
+def is_temporary(path):
+    name = Path(path).name
+    return name.startswith(TEMP_PREFIXES) or name.endswith(TEMP_SUFFIXES)
+
+
+def snapshot(dirs):
+    """{path: (size, mtime_ns)} of every file under dirs."""
+    files = {}
+    for d in dirs:
+        for root, _, names in os.walk(d):
+            for name in names:
+                path = Path(root) / name
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class PollingWatcher:
+    def __init__(self, dirs, interval=2.0):
+        self.dirs = [Path(d) for d in dirs]
+        self.interval = interval
+        self._files = snapshot(self.dirs)
+
+    def wait(self, timeout=None):
+        """Files changed since the last call, waiting up to `timeout` seconds
+        (None: until something changes)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = snapshot(self.dirs)
+            changed = {p for p in files.keys() | self._files.keys() if files.get(p) != self._files.get(p)}
+            self._files = files
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            pause = self.interval if deadline is None else min(self.interval, max(deadline - time.monotonic(), 0))
+            time.sleep(pause)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = [Path(d) for d in dirs]
+        self._paths = {}  # watch descriptor → directory
+        for d in self.dirs:
+            self._watch_tree(d)
+
+    def _watch_tree(self, directory):
+        for root, _, _ in os.walk(directory):
+            wd = self._add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {root}")
+            self._paths[wd] = Path(root)
+
+    def wait(self, timeout=None):
+        """Files changed since the last call, waiting up to `timeout` seconds
+        (None: until something changes)."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning("Watch: inotify queue overflow, rescanning the watched folders")
+                    changed.update(snapshot(self.dirs))
+                    continue
+                if wd not in self._paths or not name:
+                    continue
+                path = self._paths[wd] / os.fsdecode(name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and path.is_dir():
+                        self._watch_tree(path)
+                        changed.update(snapshot([path]))
+                    continue
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(dirs, interval=2.0, polling=False):
+    """inotify where available (Linux), else polling every `interval` seconds."""
+    if not polling:
+        try:
+            watcher = InotifyWatcher(dirs)
+            logging.info(f"Watch: inotify on {', '.join(map(str, dirs))}")
+            return watcher
+        except (OSError, AttributeError) as e:  # no inotify in this libc / watch limit reached
+            logging.info(f"Watch: inotify unavailable ({e}), polling instead")
+    logging.info(f"Watch: polling {', '.join(map(str, dirs))} every {interval:g}s")
+    return PollingWatcher(dirs, interval)
+
+
+def debounced_changes(watcher, quiet=5.0):
+    """Yield sets of changed files (temporaries left out), each once nothing has
+    changed for `quiet` seconds."""
+    while True:
+        batch = {p for p in watcher.wait() if not is_temporary(p)}
+        while batch:
+            more = watcher.wait(quiet)
+            if not more:
+                yield batch
+                break
+            batch.update(p for p in more if not is_temporary(p))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Forecast Backtesting Harness
+Replays the /api/forecast algorithm (forecast_engine) at every historical
+month of fact_cliente_historico — rolling origin: forecast month t using only
+months < t — and scores it against what each client actually bought.
+
+Metrics (overall and by tier, vendedor and zona):
+  - MAPE: mean |forecast - actual| / actual, over client-months with actual > 0
+  - WAPE: Σ|forecast - actual| / Σactual
+  - BIAS: Σ(forecast - actual) / Σactual  (positive = over-forecast)
+
+The launch factor is neutral (1.0) in the replay: launch engagement is only
+known for the current month. The zone benchmark uses each client's zona.
+
+Usage:
+  python forecast_backtest.py --db-path db/app.db
+  python forecast_backtest.py --origins 24 --output backtest.json
+  python forecast_backtest.py --grid trend_cap=0.2,0.3,0.4 --grid season_hi=1.3,1.5 --workers 4
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from forecast_engine import DEFAULT_PARAMS, HistoryMatrix, client_factors
+
+
+def rolling_origin(hm, zona_idx, params=None, origins=24, min_history=3):
+    """Forecast every client at each of the last `origins` months.
+
+    zona_idx: int array (clients,) grouping rows for the zone benchmark.
+    Returns (forecast, actual, client_row, origin_col) flat arrays, one entry
+    per (origin, client) with at least `min_history` months before the origin.
+    """
+    n_months = len(hm.months)
+    first = max(1, n_months - origins)
+    vals = np.where(hm.mask, hm.values, 0.0)
+    n_zonas = int(zona_idx.max()) + 1 if len(zona_idx) else 0
+    onehot = np.zeros((n_zonas, len(hm)))
+    onehot[zona_idx, np.arange(len(hm))] = 1.0
+
+    # Zone monthly averages over the full history (each origin only looks at
+    # columns < t, so no future data leaks into the benchmark)
+    num = onehot @ vals
+    den = onehot @ hm.mask.astype(np.float64)
+    zone_avg = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+
+    out_f, out_a, out_c, out_t = [], [], [], []
+    for t in range(first, n_months):
+        sub = HistoryMatrix(hm.clients, hm.months[:t], hm.values[:, :t], hm.mask[:, :t])
+        rows = np.flatnonzero(sub.mask.sum(axis=1) >= min_history)
+        if not len(rows):
+            continue
+        f = client_factors(sub, int(hm.month_nums[t]), params=params,
+                           zone_avg=zone_avg[zona_idx, :t])
+        out_f.append(np.maximum(f['forecast'][rows], 0.0))
+        out_a.append(vals[rows, t])
+        out_c.append(rows)
+        out_t.append(np.full(len(rows), t))
+
+    if not out_f:
+        empty = np.zeros(0)
+        return empty, empty, empty.astype(int), empty.astype(int)
+    return (np.concatenate(out_f), np.concatenate(out_a),
+            np.concatenate(out_c), np.concatenate(out_t))
+
+
+def error_metrics(forecast, actual, groups, labels):
+    """MAPE / WAPE / BIAS per group (groups: int codes into labels)."""
+    n_groups = len(labels)
+    err = forecast - actual
+    abs_err = np.abs(err)
+    sum_a = np.bincount(groups, actual, n_groups)
+    sum_abs = np.bincount(groups, abs_err, n_groups)
+    sum_err = np.bincount(groups, err, n_groups)
+    count = np.bincount(groups, minlength=n_groups)
+    pos = actual > 0
+    ape = np.bincount(groups[pos], abs_err[pos] / actual[pos], n_groups)
+    n_pos = np.bincount(groups[pos], minlength=n_groups)
+
+    result = []
+    for g, label in enumerate(labels):
+        if not count[g]:
+            continue
+        result.append({
+            'grupo': label,
+            'n': int(count[g]),
+            'actual_kg': round(float(sum_a[g]), 0),
+            'mape': round(float(ape[g] / n_pos[g] * 100), 1) if n_pos[g] else None,
+            'wape': round(float(sum_abs[g] / sum_a[g] * 100), 1) if sum_a[g] else None,
+            'bias': round(float(sum_err[g] / sum_a[g] * 100), 1) if sum_a[g] else None,
+        })
+    return result
+
+
+# Worker state for parameter sweeps: the history is shipped once per process
+_SWEEP = {}
+
+
+def _init_sweep(hm, zona_idx, origins, min_history):
+    _SWEEP.update(hm=hm, zona_idx=zona_idx, origins=origins, min_history=min_history)
+
+
+def _evaluate(params):
+    f, a, _, _ = rolling_origin(_SWEEP['hm'], _SWEEP['zona_idx'], params,
+                                _SWEEP['origins'], _SWEEP['min_history'])
+    overall = error_metrics(f, a, np.zeros(len(f), dtype=int), ['TOTAL'])
+    return {'params': params, **(overall[0] if overall else {})}
+
+
+class ForecastBacktester:
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.hm = None
+        self.attrs = {}
+
+    def load(self):
+        """Full history matrix plus tier / vendedor / zona per client."""
+        rows = self.conn.execute("""
+            SELECT cod_cliente, year_month, kg_vendidos FROM fact_cliente_historico
+            WHERE kg_vendidos > 0
+        """).fetchall()
+        self.hm = HistoryMatrix.from_rows(rows)
+        logging.info(f"History: {len(self.hm)} clients × {len(self.hm.months)} months")
+
+        # Latest avance row per client (highest objetivo) for vendedor / zona
+        av = {}
+        for r in self.conn.execute("""
+            SELECT cod_cliente, cod_vendedor, zona FROM fact_avance_cliente_vendedor_month
+            WHERE year_month = (SELECT MAX(year_month) FROM fact_avance_cliente_vendedor_month)
+            ORDER BY objetivo DESC
+        """):
+            av.setdefault(r['cod_cliente'], (r['cod_vendedor'], r['zona']))
+        hist_ven = dict(self.conn.execute("""
+            SELECT cod_cliente, cod_vendedor FROM fact_cliente_historico
+            GROUP BY cod_cliente HAVING year_month = MAX(year_month)
+        """).fetchall())
+        tiers = dict(self.conn.execute("""
+            SELECT cod_cliente, tier FROM fact_client_segmentation
+            GROUP BY cod_cliente HAVING year_month = MAX(year_month)
+        """).fetchall())
+
+        vendedor, zona, tier = [], [], []
+        for c in self.hm.clients:
+            ven, zon = av.get(c, (hist_ven.get(c), None))
+            vendedor.append(ven or 'SIN VENDEDOR')
+            zona.append(zon or 'SIN ZONA')
+            tier.append(tiers.get(c) or 'SIN TIER')
+        self.attrs = {'tier': np.array(tier), 'vendedor': np.array(vendedor), 'zona': np.array(zona)}
+        return self.hm
+
+    def run(self, params=None, origins=24, min_history=3):
+        """Backtest one parameter set; metrics overall and by tier / vendedor / zona."""
+        if self.hm is None:
+            self.load()
+        _, zona_idx = np.unique(self.attrs['zona'], return_inverse=True)
+
+        t0 = time.perf_counter()
+        f, a, rows, cols = rolling_origin(self.hm, zona_idx, params, origins, min_history)
+        elapsed = time.perf_counter() - t0
+
+        result = {
+            'params': dict(DEFAULT_PARAMS, **(params or {})),
+            'origins': sorted({self.hm.months[t] for t in cols.tolist()}),
+            'evaluations': int(len(f)),
+            'seconds': round(elapsed, 3),
+            'total': error_metrics(f, a, np.zeros(len(f), dtype=int), ['TOTAL']),
+        }
+        for dim in ('tier', 'vendedor', 'zona'):
+            labels, codes = np.unique(self.attrs[dim], return_inverse=True)
+            result[f'by_{dim}'] = error_metrics(f, a, codes[rows], list(labels))
+        result['by_origin'] = error_metrics(f, a, cols, list(self.hm.months))
+        return result
+
+    def sweep(self, grid, origins=24, min_history=3, workers=None):
+        """Evaluate every combination of `grid` ({param: [values]}) in parallel.
+        Returns overall metrics per combination, best WAPE first."""
+        if self.hm is None:
+            self.load()
+        _, zona_idx = np.unique(self.attrs['zona'], return_inverse=True)
+        names = sorted(grid)
+        combos = [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+        logging.info(f"Sweeping {len(combos)} parameter combinations on {workers or os.cpu_count()} worker(s)")
+
+        init = (self.hm, zona_idx, origins, min_history)
+        if workers == 1:
+            _init_sweep(*init)
+            results = [_evaluate(c) for c in combos]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep, initargs=init) as pool:
+                results = list(pool.map(_evaluate, combos))
+        return sorted(results, key=lambda r: (r.get('wape') is None, r.get('wape')))
+
+
+def parse_grid(specs):
+    """['trend_cap=0.2,0.3', 'season_hi=1.3,1.5'] → {'trend_cap': [0.2, 0.3], ...}"""
+    grid = {}
+    for spec in specs or []:
+        name, _, values = spec.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_PARAMS:
+            raise ValueError(f"Unknown parameter '{name}'. Available: {sorted(DEFAULT_PARAMS)}")
+        cast = int if isinstance(DEFAULT_PARAMS[name], int) else float
+        grid[name] = [cast(v) for v in values.split(',') if v.strip()]
+    return grid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the next-month forecast algorithm")
+    parser.add_argument("--db-path", default="db/app.db", help="SQLite database path")
+    parser.add_argument("--origins", type=int, default=24, help="Number of historical months to replay")
+    parser.add_argument("--min-history", type=int, default=3, help="Min. months of history before an origin")
+    parser.add_argument("--grid", action="append", help="Parameter sweep, e.g. trend_cap=0.2,0.3 (repeatable)")
+    parser.add_argument("--workers", type=int, help="Worker processes for --grid (default: CPU count)")
+    parser.add_argument("--output", help="Write the full result as JSON")
+    parser.add_argument("--log-level", default="INFO", help="Logging level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s [%(levelname)s] %(message)s'
+    )
+
+    bt = ForecastBacktester(args.db_path)
+    if args.grid:
+        result = bt.sweep(parse_grid(args.grid), args.origins, args.min_history, args.workers)
+        for r in result[:10]:
+            logging.info(f"WAPE {r.get('wape')}%  MAPE {r.get('mape')}%  BIAS {r.get('bias')}%  ← {r['params']}")
+    else:
+        result = bt.run(None, args.origins, args.min_history)
+        tot = result['total'][0] if result['total'] else {}
+        logging.info(f"{result['evaluations']} client-months over {len(result['origins'])} origins "
+                     f"in {result['seconds']}s → WAPE {tot.get('wape')}%  MAPE {tot.get('mape')}%  BIAS {tot.get('bias')}%")
+        for row in result['by_tier']:
+            logging.info(f"  tier {row['grupo']:<8} n={row['n']:<6} WAPE {row['wape']}%  MAPE {row['mape']}%  BIAS {row['bias']}%")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        logging.info(f"✓ Backtest written to {args.output}")
@@ -0,0 +1,776 @@
+#!/usr/bin/env python3
+"""
+Vectorized next-month forecast engine.
+
+Implements the BASELINE × TREND × SEASONALITY × RECENCY × LAUNCH × ZONE
+algorithm used by /api/forecast over a clients × months NumPy matrix, so a
+whole scope (vendedor, jefe or zona) is forecast from a single history query
+instead of one fact_cliente_historico query per client.
+
+Layout:
+  - HistoryMatrix: clients × months kg matrix plus a "month present" mask
+  - load_scope_history(): one query → HistoryMatrix for a filter scope
+  - client_factors(): every factor and the ±1σ band as arrays
+  - scope_monthly_avg(): the zone benchmark series, from the same matrix
+  - forecast_scope(): the /api/forecast client payload (list of dicts)
+  - aggregate_factors() / rollup_matrix(): scope-level forecast used by
+    /api/insights and the vendedor/jefe/zona rollups
+  - forecast_shard() / read_persisted_*(): the post-ETL fact_forecast stage
+  - CategoryCube / category_forecast(): client × category forecasts from
+    fact_facturacion, rolled up to the vendedor_objetivos obj_* targets
+"""
+
+import time
+
+import numpy as np
+
+# Tunable constants of the algorithm (see forecast_backtest.py for sweeps).
+# Defaults reproduce the hand-tuned values of /api/forecast.
+DEFAULT_PARAMS = {
+    'baseline_window': 6,   # trimmed mean over the last N present months
+    'trend_window': 3,      # least-squares slope over the last N months
+    'trend_cap': 0.30,      # ±30% max trend adjustment
+    'season_lo': 0.65,      # seasonality clip range
+    'season_hi': 1.50,
+    'launch_weight': 0.08,  # up to +8% for the top launch buyer
+    'zone_weight': 0.05,    # ±5% zone benchmark correction
+}
+
+
+class HistoryMatrix:
+    """Monthly kg per client, densified into a (clients × months) matrix.
+
+    `values` holds kg_vendidos (0.0 where the month is missing) and `mask`
+    is True only for months present in fact_cliente_historico. Months are
+    sorted ascending ('YYYY-MM'), so row order equals chronological order.
+    """
+
+    def __init__(self, clients, months, values, mask):
+        self.clients = clients
+        self.months = months
+        self.values = values
+        self.mask = mask
+        self.index = {c: i for i, c in enumerate(clients)}
+        self.month_nums = np.array([int(m[5:7]) for m in months], dtype=np.int64)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from (cod_cliente, year_month, kg) tuples."""
+        rows = list(rows)
+        if not rows:
+            return cls([], [], np.zeros((0, 0)), np.zeros((0, 0), dtype=bool))
+        cods = np.array([r[0] for r in rows], dtype=object)
+        yms = np.array([r[1] for r in rows], dtype=object)
+        kgs = np.array([r[2] or 0.0 for r in rows], dtype=np.float64)
+
+        clients, ci = np.unique(cods.astype(str), return_inverse=True)
+        months, mi = np.unique(yms.astype(str), return_inverse=True)
+
+        values = np.zeros((len(clients), len(months)), dtype=np.float64)
+        mask = np.zeros((len(clients), len(months)), dtype=bool)
+        values[ci, mi] = kgs
+        mask[ci, mi] = True
+        return cls(list(clients), list(months), values, mask)
+
+    def __len__(self):
+        return len(self.clients)
+
+
+def load_scope_history(conn, where_av, av_params, cur_ym):
+    """Load the kg > 0 history of every client in the avance scope with one query."""
+    rows = conn.execute(f"""
+        SELECT h.cod_cliente, h.year_month, h.kg_vendidos
+        FROM fact_cliente_historico h
+        WHERE h.kg_vendidos > 0
+          AND h.cod_cliente IN (
+              SELECT av.cod_cliente FROM fact_avance_cliente_vendedor_month av
+              WHERE {where_av} AND av.year_month = ?
+          )
+    """, list(av_params) + [cur_ym]).fetchall()
+    return HistoryMatrix.from_rows(rows)
+
+
+def _pack_right(values, mask):
+    """Right-align present months per row, keeping chronological order.
+
+    The algorithm works on each client's list of *present* months ("last 6
+    values", "last 3 values"), not on calendar months, so packing turns every
+    "last k values" into a plain column slice.
+    Returns (packed_values, packed_month_idx, packed_valid).
+    """
+    order = np.argsort(mask, axis=1, kind='stable')
+    packed = np.take_along_axis(values, order, axis=1)
+    valid = np.take_along_axis(mask, order, axis=1)
+    return np.where(valid, packed, 0.0), order, valid
+
+
+def _window(packed, valid, k):
+    """Last k present values per row (left-padded with invalid slots)."""
+    m = packed.shape[1]
+    if m >= k:
+        return packed[:, -k:], valid[:, -k:]
+    pad = k - m
+    n = packed.shape[0]
+    return (np.hstack([np.zeros((n, pad)), packed]),
+            np.hstack([np.zeros((n, pad), dtype=bool), valid]))
+
+
+def _exact_sum(vals, valid):
+    """Row sums with Neumaier compensation, column by column.
+
+    statistics.mean() sums exactly, so a plain float sum can land on the other
+    side of a .5 rounding tie (716.5 → 717 instead of 716). The loop runs over
+    months (a handful of columns) and is vectorized over all clients.
+    """
+    s = np.zeros(vals.shape[0])
+    c = np.zeros(vals.shape[0])
+    for j in range(vals.shape[1]):
+        x = np.where(valid[:, j], vals[:, j], 0.0)
+        t = s + x
+        c += np.where(np.abs(s) >= np.abs(x), (s - t) + x, (x - t) + s)
+        s = t
+    return s + c
+
+
+def _masked_mean(vals, valid):
+    cnt = valid.sum(axis=1)
+    tot = _exact_sum(vals, valid)
+    return np.where(cnt > 0, tot / np.maximum(cnt, 1), 0.0), cnt
+
+
+def trimmed_baseline(packed, valid, window=6):
+    """Trimmed mean of the last `window` values (drop min and max when >= 4 values)."""
+    w, wv = _window(packed, valid, window)
+    cnt = wv.sum(axis=1)
+    # Sort each window ascending (invalid slots → +inf at the end) so the
+    # trimmed set is simply positions 1 .. cnt-2
+    srt = np.sort(np.where(wv, w, np.inf), axis=1)
+    pos = np.arange(srt.shape[1])[None, :]
+    middle = (pos >= 1) & (pos <= (cnt - 2)[:, None])
+    trimmed, _ = _masked_mean(np.where(middle, srt, 0.0), middle)
+    plain, _ = _masked_mean(w, wv)
+    return np.where(cnt >= 4, trimmed, plain)
+
+
+def trend_factor(packed, valid, baseline, cap=0.30, window=3):
+    """1 + least-squares slope of the last `window` values over baseline, capped ±cap."""
+    w, wv = _window(packed, valid, window)
+    n3 = wv.sum(axis=1)
+    # x positions of the valid slots are 0..n3-1 (invalid slots sit on the left)
+    x = np.arange(window)[None, :] - (window - n3)[:, None]
+    xm = (n3 - 1) / 2.0
+    ym, _ = _masked_mean(w, wv)
+    dx = np.where(wv, x - xm[:, None], 0.0)
+    dy = np.where(wv, w - ym[:, None], 0.0)
+    num = (dx * dy).sum(axis=1)
+    den = (dx * dx).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(den > 0, num / np.where(den > 0, den, 1.0), 0.0)
+        ratio = np.where(baseline > 0, slope / np.where(baseline > 0, baseline, 1.0), 0.0)
+    return np.where(n3 >= 2, 1.0 + np.clip(ratio, -cap, cap), 1.0)
+
+
+def season_factor(values, mask, month_nums, target_month_num, all_mean, lo=0.65, hi=1.50):
+    """Mean of same-calendar-month values over the overall mean, clipped [lo, hi]."""
+    same = mask & (values > 0) & (month_nums[None, :] == target_month_num)
+    same_mean, same_cnt = _masked_mean(values, same)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        raw = same_mean / np.where(all_mean > 0, all_mean, 1.0)
+    return np.where((same_cnt > 0) & (all_mean > 0), np.clip(raw, lo, hi), 1.0)
+
+
+def recency_factor(packed, valid):
+    """Penalise zeros among the last 2 values: 1.0 / 0.80 / 0.60."""
+    w, wv = _window(packed, valid, 2)
+    zeros = (wv & (w == 0)).sum(axis=1)
+    return np.select([zeros == 0, zeros == 1], [1.0, 0.80], 0.60)
+
+
+def zone_factor(packed, valid, order, zone_avg, client_avg_3m, weight=0.05):
+    """±weight correction from the client's last-3 average against the scope
+    average of the same months. zone_avg is aligned to HistoryMatrix.months:
+    one series for the whole scope (1-D) or one per row (2-D)."""
+    if zone_avg is None or not np.any(zone_avg):
+        return np.ones(packed.shape[0])
+    if zone_avg.ndim == 2:
+        z = np.take_along_axis(zone_avg, order, axis=1)
+    else:
+        z = zone_avg[order]
+    zw, zv = _window(np.where(valid, z, 0.0), valid, 3)
+    zone_3m, _ = _masked_mean(zw, zv)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = client_avg_3m / np.where(zone_3m > 0, zone_3m, 1.0)
+    return np.where(zone_3m > 0, 1.0 + weight * np.clip(ratio - 1, -1, 1), 1.0)
+
+
+def sample_std(values, mask, all_mean, baseline):
+    """Sample standard deviation of present values (baseline × 0.20 when n < 2)."""
+    n = mask.sum(axis=1)
+    dev = np.where(mask, values - all_mean[:, None], 0.0)
+    # Corrected two-pass: subtract the residual of the (rounded) mean
+    ss = _exact_sum(dev * dev, mask) - _exact_sum(dev, mask) ** 2 / np.maximum(n, 1)
+    var = np.maximum(ss, 0.0) / np.maximum(n - 1, 1)
+    return np.where(n >= 2, np.sqrt(var), baseline * 0.20)
+
+
+def scope_monthly_avg(hm, weights):
+    """Per-month AVG(kg) of the scope, as the historico ⋈ avance join computes it.
+
+    weights[i] is the number of avance rows of hm.clients[i] in the scope
+    (the join repeats a client's history once per avance row).
+    Returns {year_month: avg_kg} for months with at least one sale.
+    """
+    if len(hm) == 0:
+        return {}
+    w = np.asarray(weights, dtype=np.float64)[:, None]
+    num = (np.where(hm.mask, hm.values, 0.0) * w).sum(axis=0)
+    den = (hm.mask * w).sum(axis=0)
+    return {m: float(num[j] / den[j]) for j, m in enumerate(hm.months) if den[j] > 0}
+
+
+def client_factors(hm, target_month_num, launch_counts=None, zone_avg_map=None,
+                   params=None, zone_avg=None):
+    """Compute every forecast factor for all rows of a HistoryMatrix at once.
+
+    launch_counts: {cod_cliente: n_launches COMPRADOR this month}
+    zone_avg_map:  {year_month: avg kg of the scope}
+    zone_avg:      alternatively, a ready (months,) or (clients × months) array
+    params:        overrides of DEFAULT_PARAMS
+    Returns a dict of 1-D arrays aligned to hm.clients.
+    """
+    p = dict(DEFAULT_PARAMS, **(params or {}))
+    n_rows = len(hm)
+    if n_rows == 0:
+        return {k: np.zeros(0) for k in (
+            'n', 'baseline', 'trend', 'season', 'recency', 'launch', 'zone',
+            'forecast', 'std', 'confidence')}
+
+    values, mask = hm.values, hm.mask
+    packed, order, valid = _pack_right(values, mask)
+    n = mask.sum(axis=1)
+
+    baseline = trimmed_baseline(packed, valid, p['baseline_window'])
+    trend = trend_factor(packed, valid, baseline, p['trend_cap'], p['trend_window'])
+    all_mean, _ = _masked_mean(values, mask)
+    all_mean = np.where(n > 0, all_mean, baseline)
+    season = season_factor(values, mask, hm.month_nums, target_month_num, all_mean,
+                           p['season_lo'], p['season_hi'])
+    recency = recency_factor(packed, valid)
+
+    if launch_counts:
+        n_lz = np.array([launch_counts.get(c, 0) for c in hm.clients], dtype=np.float64)
+        max_launches = max(launch_counts.values(), default=1)
+        launch = 1.0 + p['launch_weight'] * (n_lz / max(max_launches, 1))
+    else:
+        launch = np.ones(n_rows)
+
+    if zone_avg is None and zone_avg_map:
+        zone_avg = np.array([zone_avg_map.get(m, 0) or 0 for m in hm.months], dtype=np.float64)
+    w3, v3 = _window(packed, valid, 3)
+    client_avg_3m, _ = _masked_mean(w3, v3)
+    zone = zone_factor(packed, valid, order, zone_avg, client_avg_3m, p['zone_weight'])
+
+    forecast = baseline * trend * season * recency * launch * zone
+    std = sample_std(values, mask, all_mean, baseline)
+
+    return {
+        'n': n,
+        'baseline': baseline,
+        'trend': trend,
+        'season': season,
+        'recency': recency,
+        'launch': launch,
+        'zone': zone,
+        'forecast': forecast,
+        'std': std,
+        'confidence': np.minimum(85, 30 + 5 * n),
+    }
+
+
+def _client_payload(client, i, f):
+    """Round one row of client_factors() exactly like the original per-client loop."""
+    forecast_kg = max(0, round(float(f['forecast'][i]), 0))
+    std = float(f['std'][i])
+    return {
+        'cod_cliente': client['cod_cliente'],
+        'nom_cliente': client['nom_cliente'],
+        'tier': client['tier'],
+        'forecast_kg': forecast_kg,
+        'low_kg': max(0, round(forecast_kg - std, 0)),
+        'high_kg': round(forecast_kg + std, 0),
+        'confidence': int(f['confidence'][i]),
+        'objetivo_kg': client['objetivo'],
+        'venta_actual': client['venta_actual'],
+        'hist_months': int(f['n'][i]),
+        'factors': {
+            'baseline_kg': round(float(f['baseline'][i]), 0),
+            'trend': round(float(f['trend'][i]), 3),
+            'seasonality': round(float(f['season'][i]), 3),
+            'recency': float(f['recency'][i]),
+            'launch_engagement': round(float(f['launch'][i]), 3),
+            'zone_benchmark': round(float(f['zone'][i]), 3),
+        }
+    }
+
+
+def _no_history_payload(client):
+    fc = round(client['venta_actual'], 0)
+    return {
+        'cod_cliente': client['cod_cliente'],
+        'nom_cliente': client['nom_cliente'],
+        'tier': client['tier'],
+        'forecast_kg': fc,
+        'low_kg': round(fc * 0.75, 0),
+        'high_kg': round(fc * 1.25, 0),
+        'confidence': 30,
+        'factors': {'note': 'sin historial — estimado desde mes actual'},
+        'objetivo_kg': client['objetivo'],
+        'venta_actual': client['venta_actual'],
+    }
+
+
+def scope_inputs(conn, where_av, av_params, cur_ym):
+    """Fetch everything a scope forecast needs: clients, history matrix,
+    per-month scope average and launch engagement counts (3 queries)."""
+    av_params = list(av_params)
+    clients = conn.execute(f"""
+        SELECT av.cod_cliente, av.nom_cliente, av.objetivo, av.venta_actual,
+               s.tier, s.score
+        FROM fact_avance_cliente_vendedor_month av
+        LEFT JOIN fact_client_segmentation s
+            ON av.cod_cliente = s.cod_cliente AND av.year_month = s.year_month
+        WHERE {where_av} AND av.year_month = ?
+    """, av_params + [cur_ym]).fetchall()
+
+    hm = load_scope_history(conn, where_av, av_params, cur_ym)
+
+    # Zone-level monthly average for benchmark, derived from the matrix
+    # instead of re-joining fact_cliente_historico against the avance table
+    weights = np.zeros(len(hm))
+    for c in clients:
+        i = hm.index.get(c['cod_cliente'])
+        if i is not None:
+            weights[i] += 1
+    zone_avg_map = scope_monthly_avg(hm, weights)
+
+    # Launch engagement count per client (active in lanzamientos this month)
+    launch_rows = conn.execute(f"""
+        SELECT lz.cod_cliente, COUNT(DISTINCT lz.lanzamiento) as n_launches
+        FROM fact_lanzamiento_cobertura lz
+        WHERE lz.year_month = ?
+          AND lz.estado = 'COMPRADOR'
+          AND lz.cod_cliente IN (
+              SELECT av.cod_cliente FROM fact_avance_cliente_vendedor_month av
+              WHERE {where_av} AND av.year_month = ?
+          )
+        GROUP BY lz.cod_cliente
+    """, [cur_ym] + av_params + [cur_ym]).fetchall()
+    launch_map = {r[0]: r[1] for r in launch_rows}
+
+    return clients, hm, zone_avg_map, launch_map
+
+
+def forecast_scope(conn, where_av, av_params, cur_ym, target_month_num):
+    """Per-client next-month forecast for every avance row in scope.
+
+    Returns the same list of dicts (same order, same rounding) that the
+    per-client loop in /api/forecast produced, unsorted.
+    """
+    clients, hm, zone_avg_map, launch_map = scope_inputs(conn, where_av, av_params, cur_ym)
+    f = client_factors(hm, target_month_num, launch_map, zone_avg_map)
+
+    forecasts = []
+    for client in clients:
+        i = hm.index.get(client['cod_cliente'])
+        if i is None:
+            # No history: use current venta_actual as single data point
+            if client['venta_actual'] and client['venta_actual'] > 0:
+                forecasts.append(_no_history_payload(client))
+            continue
+        if f['baseline'][i] <= 0:
+            continue
+        forecasts.append(_client_payload(client, i, f))
+    return forecasts
+
+
+# ── Scope-level (aggregate) forecast ─────────────────────────────────────────
+
+def aggregate_factors(hm, target_month_num, params=None):
+    """Scope-level variant used by the "next month" block of /api/insights.
+
+    Each row of `hm` is a scope's monthly total (SUM kg). Same BASELINE ×
+    TREND × SEASONALITY, no launch/zone terms, and RECENCY is 0.85 when the
+    last value is empty.
+    """
+    p = dict(DEFAULT_PARAMS, **(params or {}))
+    if len(hm) == 0:
+        return {k: np.zeros(0) for k in ('n', 'baseline', 'trend', 'season', 'recency',
+                                          'forecast', 'std', 'confidence')}
+    values, mask = hm.values, hm.mask
+    packed, _, valid = _pack_right(values, mask)
+    n = mask.sum(axis=1)
+
+    baseline = trimmed_baseline(packed, valid, p['baseline_window'])
+    trend = trend_factor(packed, valid, baseline, p['trend_cap'], p['trend_window'])
+    all_mean, _ = _masked_mean(values, mask)
+    all_mean = np.where(n > 0, all_mean, baseline)
+    season = season_factor(values, mask, hm.month_nums, target_month_num, all_mean,
+                           p['season_lo'], p['season_hi'])
+    recency = np.where(packed[:, -1] > 0, 1.0, 0.85) if packed.shape[1] else np.ones(len(hm))
+
+    return {
+        'n': n,
+        'baseline': baseline,
+        'trend': trend,
+        'season': season,
+        'recency': recency,
+        'forecast': baseline * trend * season * recency,
+        'std': sample_std(values, mask, all_mean, baseline),
+        'confidence': np.minimum(85, 30 + 5 * n),
+    }
+
+
+def aggregate_payload(i, f):
+    forecast_kg = round(max(0, float(f['forecast'][i])), 0)
+    std = float(f['std'][i])
+    return {
+        'forecast_kg': forecast_kg,
+        'low_kg': round(max(0, forecast_kg - std), 0),
+        'high_kg': round(forecast_kg + std, 0),
+        'confidence': int(f['confidence'][i]),
+    }
+
+
+def scope_next_month(conn, where, params, cur_ym, target_month_num):
+    """Live aggregate forecast for one scope (None when it has no history)."""
+    rows = conn.execute(f"""
+        SELECT 'scope', h.year_month, SUM(h.kg_vendidos) as kg
+        FROM fact_cliente_historico h
+        JOIN fact_avance_cliente_vendedor_month av
+          ON h.cod_cliente = av.cod_cliente AND av.year_month = ?
+        WHERE {where} AND h.kg_vendidos > 0
+        GROUP BY h.year_month ORDER BY h.year_month
+    """, [cur_ym] + list(params)).fetchall()
+    hm = HistoryMatrix.from_rows(rows)
+    if len(hm) == 0:
+        return None
+    return aggregate_payload(0, aggregate_factors(hm, target_month_num))
+
+
+def rollup_matrix(hm, pairs):
+    """Sum client rows of `hm` into scope rows.
+
+    pairs: iterable of (scope_key, cod_cliente), one per avance row — a client
+    listed twice in a scope counts twice, exactly like the SQL join.
+    Returns a HistoryMatrix whose `clients` are the scope keys.
+    """
+    keys = sorted({k for k, _ in pairs})
+    kidx = {k: j for j, k in enumerate(keys)}
+    weights = np.zeros((len(keys), len(hm)))
+    for k, cod in pairs:
+        i = hm.index.get(cod)
+        if i is not None:
+            weights[kidx[k], i] += 1
+    values = weights @ np.where(hm.mask, hm.values, 0.0)
+    mask = (weights @ hm.mask.astype(np.float64)) > 0
+    return HistoryMatrix(keys, hm.months, values, mask)
+
+
+# ── Persisted forecasts (fact_forecast / fact_forecast_rollup) ───────────────
+
+def forecast_shard(db_path, where_av, av_params, cur_ym, target_month_num):
+    """Process-pool entry point: forecast one vendedor/jefe/zona scope from its
+    own connection."""
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return forecast_scope(conn, where_av, av_params, cur_ym, target_month_num)
+    finally:
+        conn.close()
+
+
+def latest_forecast_run(conn, cur_ym, next_ym):
+    """run_id of the newest persisted forecast of next_ym built on cur_ym data."""
+    try:
+        row = conn.execute("""
+            SELECT MAX(run_id) FROM fact_forecast_rollup
+            WHERE target_month = ? AND base_month = ?
+        """, (next_ym, cur_ym)).fetchone()
+    except Exception:
+        return None  # table not created yet (ETL older than the forecast stage)
+    return row[0] if row else None
+
+
+def read_persisted_forecast(conn, run_id, nivel, clave, where_av, av_params, cur_ym, next_ym):
+    """/api/forecast payload from the fact_forecast rows of one vendedor/jefe/zona
+    scope: one entry per avance row in scope, as forecast_scope() returns it.
+    None when the run has no rows for the scope (compute it live)."""
+    stored = conn.execute("""
+        SELECT 1 FROM fact_forecast
+        WHERE run_id = ? AND target_month = ? AND nivel = ? AND clave = ? LIMIT 1
+    """, (run_id, next_ym, nivel, clave)).fetchone()
+    if stored is None:
+        return None
+    rows = conn.execute(f"""
+        SELECT av.cod_cliente, av.nom_cliente, av.objetivo, av.venta_actual, s.tier,
+               ff.forecast_kg, ff.low_kg, ff.high_kg, ff.confidence, ff.hist_months,
+               ff.baseline_kg, ff.trend, ff.seasonality, ff.recency,
+               ff.launch_engagement, ff.zone_benchmark, ff.note
+        FROM fact_avance_cliente_vendedor_month av
+        JOIN fact_forecast ff
+            ON ff.cod_cliente = av.cod_cliente AND ff.run_id = ? AND ff.target_month = ?
+           AND ff.nivel = ? AND ff.clave = ?
+        LEFT JOIN fact_client_segmentation s
+            ON av.cod_cliente = s.cod_cliente AND av.year_month = s.year_month
+        WHERE {where_av} AND av.year_month = ?
+        ORDER BY av.rowid
+    """, [run_id, next_ym, nivel, clave] + list(av_params) + [cur_ym]).fetchall()
+
+    forecasts = []
+    for r in rows:
+        if r['note']:
+            # Estimated from venta_actual, which is per avance row
+            if r['venta_actual'] and r['venta_actual'] > 0:
+                forecasts.append(_no_history_payload(r))
+            continue
+        forecasts.append({
+            'cod_cliente': r['cod_cliente'],
+            'nom_cliente': r['nom_cliente'],
+            'tier': r['tier'],
+            'forecast_kg': r['forecast_kg'],
+            'low_kg': r['low_kg'],
+            'high_kg': r['high_kg'],
+            'confidence': r['confidence'],
+            'objetivo_kg': r['objetivo'],
+            'venta_actual': r['venta_actual'],
+            'hist_months': r['hist_months'],
+            'factors': {
+                'baseline_kg': r['baseline_kg'],
+                'trend': r['trend'],
+                'seasonality': r['seasonality'],
+                'recency': r['recency'],
+                'launch_engagement': r['launch_engagement'],
+                'zone_benchmark': r['zone_benchmark'],
+            },
+        })
+    return forecasts
+
+
+def read_persisted_rollup(conn, run_id, nivel, clave, next_ym):
+    """Aggregate next-month forecast of one vendedor/jefe/zona, or None."""
+    row = conn.execute("""
+        SELECT forecast_kg, low_kg, high_kg, confidence FROM fact_forecast_rollup
+        WHERE run_id = ? AND target_month = ? AND nivel = ? AND clave = ?
+    """, (run_id, next_ym, nivel, clave)).fetchone()
+    return dict(row) if row else None
+
+
+# ── Category forecasts (client × category × month) ───────────────────────────
+
+# The 10 focus categories of vendedor_objetivos, in display order
+CATEGORY_OBJECTIVES = {
+    'HG': 'obj_hg',
+    'SCH': 'obj_sch',
+    'UNT': 'obj_unt',
+    'RB': 'obj_rb',
+    'SJ': 'obj_sj',
+    'GRASA': 'obj_grasa',
+    'CARNE PICADA': 'obj_picada',
+    'PAPAS': 'obj_papas',
+    'ATUN': 'obj_atun',
+    'CHORIZOS': 'obj_chorizos',
+}
+
+# dim_product_classification (alias p) → focus category, NULL when none applies
+CATEGORY_CASE_SQL = """
+    CASE 
+        WHEN UPPER(p.categoria) LIKE '%HAMBURGUESA%' THEN 'HG'
+        WHEN UPPER(p.categoria) LIKE '%SALCHICHA%' THEN 'SCH'
+        WHEN UPPER(p.categoria) LIKE '%REBOZADO%' OR UPPER(p.descripcion) LIKE '%REBOZADO%' THEN 'RB'
+        WHEN UPPER(p.descripcion) LIKE '%SOJA%' OR UPPER(p.categoria) LIKE '%SOJA%' THEN 'SJ'
+        WHEN UPPER(p.descripcion) LIKE '%GRASA%' THEN 'GRASA'
+        WHEN UPPER(p.descripcion) LIKE '%PICADA%' THEN 'CARNE PICADA'
+        WHEN UPPER(p.categoria) LIKE '%PAPA%' THEN 'PAPAS'
+        WHEN UPPER(p.categoria) = 'PESCADOS' OR UPPER(p.descripcion) LIKE '%ATUN%' THEN 'ATUN'
+        WHEN UPPER(p.categoria) = 'EMBUTIDOS' OR UPPER(p.descripcion) LIKE '%CHORIZO%' THEN 'CHORIZOS'
+        WHEN UPPER(p.categoria) = 'UNTABLES' 
+             AND (UPPER(p.descripcion) LIKE '%JALAPEÑO%' OR UPPER(p.descripcion) LIKE '%JAPALEÑO%' OR UPPER(p.descripcion) LIKE '%CHILE%') THEN 'UNT'
+        ELSE NULL
+    END
+"""
+
+
+class CategoryCube:
+    """Sparse (client, category, month) kg cube.
+
+    Only the (client, category) pairs that bought at least once are stored:
+    pair p is client `pair_client[p]` × category `pair_cat[p]`, and its
+    monthly series is row p of the dense `values` / `mask` block, so the whole
+    cube goes through aggregate_factors() as one batch. A month counts as
+    present for every category of a client that bought anything that month —
+    a category skipped in an active month is a real 0, not a missing value.
+    """
+
+    def __init__(self, clients, categories, months, pair_client, pair_cat, values, mask):
+        self.clients = clients
+        self.categories = categories
+        self.months = months
+        self.pair_client = pair_client
+        self.pair_cat = pair_cat
+        self.values = values
+        self.mask = mask
+
+    @classmethod
+    def from_rows(cls, rows, categories):
+        """Build from (cod_cliente, category or None, year_month, kg) tuples.
+        Rows with category None only mark the client active that month."""
+        rows = list(rows)
+        if not rows:
+            return cls([], list(categories), [], np.zeros(0, dtype=np.int64),
+                       np.zeros(0, dtype=np.int64), np.zeros((0, 0)), np.zeros((0, 0), dtype=bool))
+        cods = np.array([str(r[0]) for r in rows])
+        cats = np.array([r[1] or '' for r in rows])
+        yms = np.array([str(r[2]) for r in rows])
+        kgs = np.array([r[3] or 0.0 for r in rows], dtype=np.float64)
+
+        clients, ci = np.unique(cods, return_inverse=True)
+        months, mi = np.unique(yms, return_inverse=True)
+        cat_index = {c: k for k, c in enumerate(categories)}
+        ki = np.array([cat_index.get(c, -1) for c in cats], dtype=np.int64)
+
+        active = np.zeros((len(clients), len(months)), dtype=bool)
+        active[ci, mi] = True
+
+        has_cat = ki >= 0
+        pair_key = ci[has_cat] * len(categories) + ki[has_cat]
+        pairs, pi = np.unique(pair_key, return_inverse=True)
+        pair_client = pairs // len(categories)
+        pair_cat = pairs % len(categories)
+
+        values = np.zeros((len(pairs), len(months)), dtype=np.float64)
+        np.add.at(values, (pi, mi[has_cat]), kgs[has_cat])
+        mask = active[pair_client]
+        return cls(list(clients), list(categories), list(months), pair_client, pair_cat, values, mask)
+
+    def __len__(self):
+        return len(self.pair_client)
+
+    def batch(self, lo, hi):
+        """Pairs lo..hi as a HistoryMatrix (rows keyed by pair number)."""
+        return HistoryMatrix(list(range(lo, hi)), self.months,
+                             self.values[lo:hi], self.mask[lo:hi])
+
+
+def load_category_cube(conn, where_av, av_params, cur_ym, months_back=24):
+    """One aggregate query over fact_facturacion ⋈ dim_product_classification
+    for the clients of a scope: the `months_back` complete months before cur_ym."""
+    y, m = map(int, cur_ym.split('-'))
+    first = (y * 12 + m - 1) - months_back
+    first_ym = f"{first // 12}-{first % 12 + 1:02d}"
+    rows = conn.execute(f"""
+        SELECT f.cod_cliente, {CATEGORY_CASE_SQL} as categoria, f.year_month, SUM(f.cantidad) as kg
+        FROM fact_facturacion f
+        LEFT JOIN dim_product_classification p ON f.cod_producto = p.cod_producto
+        WHERE f.year_month >= ? AND f.year_month < ? AND f.cantidad > 0
+          AND f.cod_cliente IN (
+              SELECT av.cod_cliente FROM fact_avance_cliente_vendedor_month av
+              WHERE {where_av} AND av.year_month = ?
+          )
+        GROUP BY f.cod_cliente, categoria, f.year_month
+    """, [first_ym, cur_ym] + list(av_params) + [cur_ym]).fetchall()
+    return CategoryCube.from_rows(rows, list(CATEGORY_OBJECTIVES))
+
+
+def category_forecast(conn, where_av, av_params, cur_ym, target_month_num,
+                      months_back=24, budget_s=10.0, batch_size=20000):
+    """Client × category next-month forecast for a scope, rolled up per vendor
+    against the vendedor_objetivos obj_* columns.
+
+    Pairs are forecast in batches with aggregate_factors() (BASELINE × TREND ×
+    SEASONALITY × RECENCY). When `budget_s` runs out, the remaining pairs get
+    the plain 3-month mean and the result is flagged `truncated`.
+    """
+    t0 = time.perf_counter()
+    cube = load_category_cube(conn, where_av, av_params, cur_ym, months_back)
+
+    n_pairs = len(cube)
+    forecast = np.zeros(n_pairs)
+    std = np.zeros(n_pairs)
+    done = 0
+    while done < n_pairs and time.perf_counter() - t0 < budget_s:
+        hi = min(done + batch_size, n_pairs)
+        f = aggregate_factors(cube.batch(done, hi), target_month_num)
+        forecast[done:hi] = np.maximum(f['forecast'], 0)
+        std[done:hi] = f['std']
+        done = hi
+    truncated = done < n_pairs
+    if truncated:
+        packed, _, valid = _pack_right(cube.values[done:], cube.mask[done:])
+        mean3, _ = _masked_mean(*_window(packed, valid, 3))
+        forecast[done:] = mean3
+
+    # Primary vendor per client (highest objetivo)
+    av_rows = conn.execute(f"""
+        SELECT av.cod_cliente, COALESCE(av.cod_vendedor, '') as cod_vendedor, av.nom_vendedor
+        FROM fact_avance_cliente_vendedor_month av
+        WHERE {where_av} AND av.year_month = ?
+        ORDER BY av.cod_cliente, av.objetivo DESC, av.cod_vendedor
+    """, list(av_params) + [cur_ym]).fetchall()
+    primary, vendor_names = {}, {}
+    for r in av_rows:
+        primary.setdefault(r['cod_cliente'], r['cod_vendedor'])
+        vendor_names.setdefault(r['cod_vendedor'], r['nom_vendedor'])
+
+    vendors = sorted(set(primary.values()))
+    vidx = {v: j for j, v in enumerate(vendors)}
+    n_cat = len(cube.categories)
+    client_vendor = np.array([vidx[primary.get(c, '')] if primary.get(c, '') in vidx else -1
+                              for c in cube.clients], dtype=np.int64)
+    pair_vendor = client_vendor[cube.pair_client] if n_pairs else np.zeros(0, dtype=np.int64)
+    keep = pair_vendor >= 0
+    cell = pair_vendor[keep] * n_cat + cube.pair_cat[keep]
+    by_vendor = np.bincount(cell, forecast[keep], len(vendors) * n_cat).reshape(len(vendors), n_cat)
+    # Independent client errors: variances add up
+    var_vendor = np.bincount(cell, std[keep] ** 2, len(vendors) * n_cat).reshape(len(vendors), n_cat)
+
+    obj_cols = ', '.join(CATEGORY_OBJECTIVES.values())
+    objetivos = {}
+    if vendors:
+        ph = ','.join(['?'] * len(vendors))
+        for r in conn.execute(f"""
+            SELECT cod_vendedor, {obj_cols} FROM vendedor_objetivos WHERE cod_vendedor IN ({ph})
+        """, vendors).fetchall():
+            objetivos[r['cod_vendedor']] = r
+
+    vendedores = []
+    for j, ven in enumerate(vendors):
+        obj_row = objetivos.get(ven)
+        cats = {}
+        for k, (cat, col) in enumerate(CATEGORY_OBJECTIVES.items()):
+            fc = round(float(by_vendor[j, k]), 0)
+            sd = float(np.sqrt(var_vendor[j, k]))
+            obj = (obj_row[col] or 0) if obj_row else 0
+            cats[cat] = {
+                'forecast_kg': fc,
+                'low_kg': round(max(0, fc - sd), 0),
+                'high_kg': round(fc + sd, 0),
+                'objetivo_kg': obj,
+                'proj_pct_of_obj': round(fc / obj * 100, 1) if obj else None,
+            }
+        vendedores.append({'cod_vendedor': ven, 'nom_vendedor': vendor_names.get(ven), 'categorias': cats})
+
+    clientes = {}
+    for p in np.flatnonzero(forecast > 0):
+        cod = cube.clients[cube.pair_client[p]]
+        clientes.setdefault(cod, {})[cube.categories[cube.pair_cat[p]]] = round(float(forecast[p]), 0)
+
+    return {
+        'categorias': list(CATEGORY_OBJECTIVES),
+        'meses_historia': cube.months,
+        'vendedores': vendedores,
+        'clientes': [{'cod_cliente': c, 'categorias': v} for c, v in sorted(clientes.items())],
+        'pairs': n_pairs,
+        'truncated': truncated,
+        'elapsed_s': round(time.perf_counter() - t0, 3),
+    }
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Objective Allocation
+Spreads each vendor's monetary targets (vendedor_objetivos.objetivo_pesos /
+objetivo_premium_pesos) over the vendor's clients in fact_avance_cliente_vendedor_month.
+Shared by the ETL (calculate_monetary_objectives) and the API (POST
+/api/objetivos/mensual, PUT /api/crm/ponderacion) so every path allocates the same way.
+
+Per client:
+  - proportion = crm_cliente_ponderacion.ponderacion_pct / 100 when the client has a
+    custom ponderación for the month, else objetivo / base_kg
+  - base_kg    = SUM(objetivo > 0) of the vendor's clients that month, falling back to
+    vendedor_objetivos.objetivo_kg when no client has a KG objective
+  - proportion is capped at 100% to prevent overflow
+  - objetivo_pesos = objetivo_pesos_vendedor * proportion (same for premium)
+
+Clients without a KG objective and without a custom ponderación keep their values.
+The whole distribution is one UPDATE ... FROM over a CTE, whatever the vendor size.
+
+Usage:
+  allocate_monetary_objectives(conn, '2026-02')                  # every vendor
+  allocate_monetary_objectives(conn, '2026-02', cod_vendedor)    # one vendor
+"""
+
+ALLOCATION_SQL = """
+    WITH vendor AS (
+        SELECT vo.cod_vendedor,
+               vo.objetivo_pesos AS pesos,
+               COALESCE(vo.objetivo_premium_pesos, 0) AS premium,
+               COALESCE((SELECT SUM(av.objetivo) FROM fact_avance_cliente_vendedor_month av
+                         WHERE av.cod_vendedor = vo.cod_vendedor AND av.year_month = :ym
+                           AND av.objetivo > 0), 0) AS sum_kg,
+               COALESCE(vo.objetivo_kg, 0) AS objetivo_kg
+        FROM vendedor_objetivos vo
+        WHERE vo.objetivo_pesos != 0
+          AND (:cod_vendedor IS NULL OR vo.cod_vendedor = :cod_vendedor)
+    ),
+    base AS (
+        SELECT cod_vendedor, pesos, premium,
+               CASE WHEN sum_kg != 0 THEN sum_kg ELSE objetivo_kg END AS base_kg
+        FROM vendor
+    ),
+    alloc AS (
+        SELECT av.rowid AS av_rowid, b.pesos, b.premium,
+               MIN(COALESCE(cp.ponderacion_pct / 100.0, av.objetivo / b.base_kg), 1.0) AS proportion
+        FROM fact_avance_cliente_vendedor_month av
+        JOIN base b ON b.cod_vendedor = av.cod_vendedor
+        LEFT JOIN crm_cliente_ponderacion cp
+               ON cp.cod_cliente = av.cod_cliente AND cp.year_month = av.year_month
+        WHERE av.year_month = :ym
+          AND (cp.ponderacion_pct IS NOT NULL OR (b.base_kg != 0 AND av.objetivo != 0))
+    )
+    UPDATE fact_avance_cliente_vendedor_month
+    SET objetivo_pesos = alloc.pesos * alloc.proportion,
+        objetivo_premium_pesos = alloc.premium * alloc.proportion
+    FROM alloc
+    WHERE fact_avance_cliente_vendedor_month.rowid = alloc.av_rowid
+"""
+
+
+def allocate_monetary_objectives(conn, year_month, cod_vendedor=None):
+    """Allocate pesos/premium targets for year_month (optionally one vendor).
+    Returns the number of client rows updated; the caller commits."""
+    before = conn.total_changes
+    # rowcount stays -1 for statements starting with WITH, so count via total_changes
+    conn.execute(ALLOCATION_SQL, {'ym': year_month, 'cod_vendedor': cod_vendedor})
+    return conn.total_changes - before